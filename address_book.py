@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+# An experiment only has a few hundred distinct peer addresses against
+# millions of trace rows, so they are resolved once per experiment into an
+# address book and the rows only look the result up by their categorical code
+
+
+def address_ip(address):
+    # 'ip:port' -> 'ip'
+    return address.split(':')[0]
+
+
+def region_dtype(ips_to_regions):
+    # One region dictionary for the whole experiment, from parse_ip_to_region
+    return pd.CategoricalDtype(sorted(set(ips_to_regions.values())))
+
+
+def as_categorical(values):
+    if isinstance(values, pd.Series):
+        values = values.array
+    if not isinstance(values, pd.Categorical):
+        values = pd.Categorical(values)
+    return values
+
+
+def build_address_book(addresses, ips_to_regions):
+    # The experiment's address book, built once from its distinct 'ip:port'
+    # addresses, e.g. the categories of the experiment-wide msg.ip_address
+    # dtype. Each address is split and looked up in ips_to_regions once.
+    # Returns the addresses and, indexed by address code, the codes of their
+    # target IP and region along with the dtypes of both. Unknown IPs get a
+    # missing region
+    addresses = pd.Index(np.asarray(addresses, dtype=str))
+    ips = pd.Index([address_ip(address) for address in addresses])
+    ip_categories, ip_codes = np.unique(ips, return_inverse=True)
+    regions = pd.Categorical(ips.map(ips_to_regions), dtype=region_dtype(ips_to_regions))
+    return {
+        'addresses': addresses,
+        'target_ip': (ip_codes.reshape(-1), pd.CategoricalDtype(ip_categories.astype(str))),
+        'target_region': (regions.codes, regions.dtype),
+    }
+
+
+def lookup_addresses(book, ip_addresses):
+    # Target IP and region columns of ip_addresses, by code when they share
+    # the book's address dictionary. Missing or unknown addresses stay missing
+    ip_addresses = as_categorical(ip_addresses)
+    if ip_addresses.categories.equals(book['addresses']):
+        codes = ip_addresses.codes
+    else:
+        codes = book['addresses'].get_indexer(np.asarray(ip_addresses, dtype=object))
+    columns = {}
+    for column in ('target_ip', 'target_region'):
+        values, dtype = book[column]
+        # Missing addresses have code -1, appending -1 keeps them missing
+        columns[column] = pd.Categorical.from_codes(np.r_[values, -1][codes], dtype=dtype)
+    return columns
@@ -0,0 +1,133 @@
+import argparse
+import os
+import threading
+from contextlib import nullcontext
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+import pandas as pd
+
+from compute_speed import total_regions_speeds_from_cube, total_speeds_from_cube
+from instrumentation import stage, start_run, write_report
+from latency_sketch import merge_sketches
+from out_of_core import budget_pool_size
+from parse_jsonl import list_validator_dirs
+from parse_validators_regions import parse_ip_to_region
+from plot_latency import sketch_summary, stream_experiment_sketches
+from rollups import experiment_rollups
+
+# The experiments we usually compare: QUIC vs TM-native, BBR vs Reno and stream counts
+BATCH_EXPERIMENTS = [
+    'quic_0.5mb_32streams',
+    'quic_0.5mb_1stream',
+    'tm_native_no_bbr',
+    'traces_tm_native_reno',
+    'traces_quic_increasing_number_of_streams',
+    'traces_quic_bench_4streams_5mb',
+    'traces_tm_native_bbr_500bytes',
+    'traces_tm_native_bbr_2mb',
+    'traces_tm_native_bbr_5mb',
+    'traces_tm_native_long_running_10mb_intervals',
+    'traces_tm_native_bbr_52_validators',
+    'traces_quic_52_validators',
+]
+
+SPEED_COLUMNS = ['upload_speed_mbps', 'download_speed_mbps']
+LATENCY_COLUMNS = ['count', 'mean', 'p50', 'p90', 'p99', 'max']
+COMPARISON_COLUMNS = ['experiment', 'scope', 'name', 'region'] + SPEED_COLUMNS + \
+    [f'latency_{column}_ms' if column != 'count' else 'latency_count' for column in LATENCY_COLUMNS]
+
+
+def latency_summary(sketches, key_func, name):
+    # Latency stats in ms of the validator to peer sketches merged by key_func
+    summary = sketch_summary(merge_sketches(sketches, key_func), [name])
+    if summary.empty:
+        return pd.DataFrame(columns=[name] + LATENCY_COLUMNS)
+    return summary
+
+
+# Out-of-core builds run one at a time, so the budget bounds them all together
+OUT_OF_CORE_LOCK = threading.Lock()
+
+
+def compare_experiment(experiment_path, ips_to_regions, pool=None, memory_budget_mb=None):
+    # One row per validator and per region of the experiment with its upload
+    # and download speeds and the latency stats of the messages it measured
+    experiment = os.path.basename(os.path.normpath(experiment_path))
+    with OUT_OF_CORE_LOCK if memory_budget_mb is not None else nullcontext():
+        traffic_rollups = experiment_rollups(experiment_path, ips_to_regions, memory_budget_mb, pool)
+    with stage(f'compare {experiment}', 'aggregate'):
+        validator_speeds = total_speeds_from_cube(traffic_rollups)
+        region_speeds = total_regions_speeds_from_cube(traffic_rollups)
+
+    sketches = stream_experiment_sketches(experiment_path, list_validator_dirs(experiment_path), pool)
+    validator_latency = latency_summary(sketches, lambda key: key[0], 'validator')
+    region_latency = latency_summary(sketches, lambda key: ips_to_regions.get(key[0], 'Unknown'), 'region')
+
+    validators = validator_speeds[['validator'] + SPEED_COLUMNS].astype({'validator': str}) \
+        .merge(validator_latency, on='validator', how='outer').rename(columns={'validator': 'name'})
+    validators.insert(1, 'region', validators['name'].map(ips_to_regions).fillna('Unknown'))
+    regions = region_speeds[['region'] + SPEED_COLUMNS].astype({'region': str}) \
+        .merge(region_latency, on='region', how='outer').assign(name=lambda df: df['region'])
+    comparison = pd.concat([validators.assign(scope='validator'), regions.assign(scope='region')],
+                           ignore_index=True)
+    comparison = comparison[['scope', 'name', 'region'] + SPEED_COLUMNS + LATENCY_COLUMNS]
+    comparison = comparison.rename(columns={column: f'latency_{column}_ms' if column != 'count' else 'latency_count'
+                                            for column in LATENCY_COLUMNS})
+    comparison.insert(0, 'experiment', experiment)
+    return comparison
+
+
+def compare_experiments(experiment_paths, ips_to_regions, processes=None, memory_budget_mb=None):
+    # Analyses the experiments concurrently, each in its own thread of the
+    # parent, all sharing one long-lived pool of workers for the trace files.
+    # With a memory budget the rollups are folded out of core on that pool,
+    # one experiment at a time, and the pool is sized to the budget.
+    # Returns the comparison rows of every experiment
+    if not experiment_paths:
+        return pd.DataFrame(columns=COMPARISON_COLUMNS)
+    processes = processes or max(cpu_count() - 1, 1)
+    if memory_budget_mb is not None:
+        processes = budget_pool_size(memory_budget_mb, processes)
+    with Pool(processes=processes) as pool, ThreadPool(len(experiment_paths)) as threads:
+        comparisons = threads.map(
+            lambda experiment_path: compare_experiment(experiment_path, ips_to_regions, pool, memory_budget_mb),
+            experiment_paths)
+    return pd.concat(comparisons, ignore_index=True)
+
+
+def comparison_pivot(comparison, column):
+    # One row per validator or region, one column per experiment
+    return comparison.pivot_table(index=['scope', 'name'], columns='experiment', values=column, observed=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the speeds and latencies of several experiments")
+    parser.add_argument('experiments', nargs='*', default=BATCH_EXPERIMENTS)
+    parser.add_argument('--regions', default='list.txt', help="validator list with regions")
+    parser.add_argument('--processes', type=int, help="size of the shared worker pool")
+    parser.add_argument('--memory-budget-mb', type=int, help="build the rollups out of core within this budget")
+    parser.add_argument('--output-dir', default='plots/comparison')
+    args = parser.parse_args()
+
+    experiments = [experiment for experiment in args.experiments if os.path.isdir(experiment)]
+    for experiment in sorted(set(args.experiments) - set(experiments)):
+        print(f"skipping {experiment}, not found")
+
+    if not experiments:
+        parser.exit(1, "no experiment found\n")
+
+    ips_to_regions = parse_ip_to_region(args.regions)
+    print("finished parsing list with regions")
+
+    start_run('batch ' + ' '.join(experiments))
+    comparison = compare_experiments(experiments, ips_to_regions, args.processes, args.memory_budget_mb)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_file = os.path.join(args.output_dir, "experiment_comparison.csv")
+    comparison.to_csv(output_file, index=False)
+    print(f"Comparison saved at {output_file}")
+    for column in SPEED_COLUMNS + ['latency_p50_ms']:
+        print(column)
+        print(comparison_pivot(comparison, column).to_string())
+    write_report(os.path.join(args.output_dir, "run_report_"+pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')+".json"))
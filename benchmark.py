@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+from multiprocessing import Process
+
+import pandas as pd
+
+from compute_speed import plot_region_speeds, plot_speed_progression_from_cube, plot_speed_progression_per_peer, \
+    plot_speeds, speed_progression_per_peer_from_cube, total_regions_speeds_from_cube, total_speeds_from_cube
+from downsample import PLOT_WIDTH_POINTS
+from generate_traces import generate_experiment
+from instrumentation import RSS_UNIT, measure
+from parse_jsonl import list_validator_dirs, process_experiment_data
+from plot_latency import latency_matrices, stream_experiment_sketches
+from rollups import build_rollup_pyramid
+from traffic_cube import build_traffic_cube
+
+# Experiment sizes benchmarked by default, from a quick smoke run to a 52 validator testnet
+BENCHMARK_SIZES = {
+    'small': {'num_validators': 4, 'num_peers': 3, 'duration': 60, 'sample_rate': 10},
+    'medium': {'num_validators': 16, 'num_peers': 8, 'duration': 300, 'sample_rate': 20},
+    'large': {'num_validators': 52, 'num_peers': 16, 'duration': 600, 'sample_rate': 20},
+}
+
+# A stage slower than the baseline by more than this factor, and by more than
+# MIN_REGRESSION_S so that timer noise on tiny stages does not count, is a regression
+REGRESSION_FACTOR = 1.2
+MIN_REGRESSION_S = 0.1
+
+def run_stage(results, stage_name, func, *args, **kwargs):
+    # Times one pipeline stage. workers_peak_rss is the largest pool worker
+    # seen so far, the workers of a stage can only raise it
+    with measure(stage_name) as record:
+        value = func(*args, **kwargs)
+    results.append({
+        'stage': stage_name,
+        'wall_s': record['wall_s'],
+        'cpu_s': record['cpu_s'],
+        'workers_cpu_s': record['workers_cpu_s'],
+        'peak_rss_mb': record['peak_rss_mb'],
+        'workers_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * RSS_UNIT / 2**20,
+    })
+    print(f"{stage_name}: {record['wall_s']:.2f}s, peak RSS {record['peak_rss_mb']:.0f}MB")
+    return value
+
+
+def benchmark_pipeline(work_dir, size, plots=True):
+    # Generates an experiment of the given size and runs every stage of main.py
+    # and plot_latency.py over it, without any cache
+    results = []
+    experiment_path = os.path.join(work_dir, 'experiment')
+    output_dir = os.path.join(work_dir, 'plots') + '/'
+    os.makedirs(output_dir, exist_ok=True)
+    ips_to_regions, lines = run_stage(results, 'generate', generate_experiment, experiment_path,
+                                      os.path.join(work_dir, 'list.txt'), **size)
+
+    received_df, sent_df = run_stage(results, 'ingest', process_experiment_data, experiment_path,
+                                     ips_to_regions, use_cache=False)
+    cube = run_stage(results, 'cube', build_traffic_cube, sent_df, received_df)
+    del received_df, sent_df
+    pyramid = run_stage(results, 'rollups', build_rollup_pyramid, cube)
+    total_speeds = run_stage(results, 'total_speeds', total_speeds_from_cube, pyramid)
+    region_speeds = run_stage(results, 'region_speeds', total_regions_speeds_from_cube, pyramid)
+    download_speeds = run_stage(results, 'peer_progression', speed_progression_per_peer_from_cube,
+                                pyramid, 'received', interval='10S')
+
+    if plots:
+        run_stage(results, 'plot_speeds', plot_speeds, total_speeds, output_dir)
+        run_stage(results, 'plot_region_speeds', plot_region_speeds, region_speeds, output_dir)
+        run_stage(results, 'plot_progression', plot_speed_progression_from_cube, pyramid, output_dir,
+                  max_points=PLOT_WIDTH_POINTS)
+        run_stage(results, 'plot_peer_progression', plot_speed_progression_per_peer, download_speeds,
+                  ips_to_regions, output_dir + 'download_speeds/', max_points=PLOT_WIDTH_POINTS)
+
+    sketches = run_stage(results, 'latency_sketches', stream_experiment_sketches, experiment_path,
+                         list_validator_dirs(experiment_path))
+    run_stage(results, 'latency_matrix', latency_matrices, sketches, ips_to_regions)
+
+    for result in results:
+        result['lines'] = lines
+        result['rows_per_s'] = lines / result['wall_s'] if result['stage'] == 'ingest' else None
+    return results
+
+
+def benchmark_size_process(name, size, plots, result_file):
+    # Runs in its own process so that the peak RSS of one size does not carry over to the next
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = benchmark_pipeline(work_dir, size, plots)
+    for result in results:
+        result.update({'size': name, **size})
+    with open(result_file, 'w') as f:
+        json.dump(results, f)
+
+
+def run_benchmarks(sizes, plots=True):
+    results = []
+    with tempfile.TemporaryDirectory() as result_dir:
+        for name, size in sizes.items():
+            print(f"benchmarking {name}: {size}")
+            result_file = os.path.join(result_dir, f"{name}.json")
+            process = Process(target=benchmark_size_process, args=(name, size, plots, result_file))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f"Benchmark {name} failed with exit code {process.exitcode}")
+            with open(result_file) as f:
+                results.extend(json.load(f))
+    return pd.DataFrame(results)
+
+
+def compare_to_baseline(results, baseline):
+    # Wall time ratio of every (size, stage) also present in the baseline run
+    merged = results.merge(baseline[['size', 'stage', 'wall_s']], on=['size', 'stage'], suffixes=('', '_baseline'))
+    merged['ratio'] = merged['wall_s'] / merged['wall_s_baseline']
+    merged['regression'] = (merged['ratio'] > REGRESSION_FACTOR) & \
+        (merged['wall_s'] - merged['wall_s_baseline'] > MIN_REGRESSION_S)
+    return merged[['size', 'stage', 'wall_s_baseline', 'wall_s', 'ratio', 'regression']]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time every pipeline stage on synthetic experiments")
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(BENCHMARK_SIZES))
+    parser.add_argument('--no-plots', action='store_true', help="skip the rendering stages")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = run_benchmarks({name: BENCHMARK_SIZES[name] for name in args.sizes}, plots=not args.no_plots)
+    results.to_json(args.output, orient='records', indent=2)
+    print(results[['size', 'stage', 'wall_s', 'peak_rss_mb', 'workers_peak_rss_mb']].to_string(index=False))
+    print(f"results saved at {args.output}")
+
+    if args.baseline:
+        comparison = compare_to_baseline(results, pd.read_json(args.baseline))
+        print(comparison.to_string(index=False))
+        if comparison['regression'].any():
+            print(f"stages slower than {REGRESSION_FACTOR}x the baseline: "
+                  f"{', '.join(comparison[comparison['regression']]['stage'].unique())}")
+            sys.exit(1)
@@ -0,0 +1,186 @@
+import os
+
+import numpy as np
+import pandas as pd
+from matplotlib import pyplot as plt
+
+from traces import load_table
+
+# Percentiles reported for the lags of the nodes behind the proposer
+PROPAGATION_QUANTILES = {
+    'p50': 0.5,
+    'p90': 0.9,
+    'p99': 0.99,
+}
+
+
+def segment_starts(keys):
+    # Start index of every run of equal values in a sorted array
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+
+def segment_quantile(values, starts, counts, q):
+    # Linear interpolation quantile of every segment of values, each segment
+    # must already be sorted, as np.quantile does for a single array
+    position = q * (counts - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, counts - 1)
+    low_values = values[starts + lower]
+    return low_values + (values[starts + upper] - low_values) * (position - lower)
+
+
+def segment_summary(keys, values):
+    # Count, mean, quantiles and max of values per key, keys and values sorted by (key, value)
+    starts = segment_starts(keys)
+    counts = np.diff(np.r_[starts, len(keys)])
+    summary = {
+        'nodes': counts,
+        'mean_lag_s': np.add.reduceat(values, starts) / counts,
+    }
+    for name, q in PROPAGATION_QUANTILES.items():
+        summary[f'{name}_lag_s'] = segment_quantile(values, starts, counts, q)
+    summary['max_lag_s'] = values[starts + counts - 1]
+    return keys[starts], summary
+
+
+def first_sightings(heights, times, nodes):
+    # Earliest record of every (height, node), as arrays sorted by height then node
+    order = np.lexsort((times, nodes, heights))
+    heights, times, nodes = heights[order], times[order], nodes[order]
+    first = np.r_[True, (heights[1:] != heights[:-1]) | (nodes[1:] != nodes[:-1])]
+    return heights[first], times[first], nodes[first]
+
+
+def empty_propagation(node_regions=None):
+    # Results of block_propagation when no node recorded a block, e.g. when
+    # load_table found no consensus_block table
+    summary = ['mean_lag_s'] + [f'{name}_lag_s' for name in PROPAGATION_QUANTILES] + ['max_lag_s']
+    per_height = pd.DataFrame(columns=['height', 'first_seen', 'last_seen', 'spread_s', 'from_proposer', 'nodes']
+                              + summary)
+    node_lags = pd.DataFrame(columns=['height', 'node', 'lag_s'] + (['region'] if node_regions is not None else []))
+    per_region = pd.DataFrame(columns=['region', 'samples'] + summary) if node_regions is not None else None
+    return per_height, node_lags, per_region
+
+
+def block_propagation(blocks, node_regions=None, node_addresses=None, time_column='timestamp',
+                      proposer_column='proposer'):
+    # Joins the consensus_block records of all nodes on height and measures,
+    # for every block, how long after the proposer each node saw it. blocks
+    # is a load_table frame with height, the time column and node. When
+    # node_addresses ({node: validator address}) identifies the proposer's
+    # node and it has a record for the height, lags are measured from the
+    # proposer's record, otherwise from the first node that saw the block.
+    # All joins are done on columnar arrays sorted once by height, so the
+    # cost is O(n log n) in the number of records whatever the node count.
+    # Returns the per-height, per-node and per-region frames
+    blocks = blocks.dropna(subset=['height', time_column])
+    if blocks.empty:
+        return empty_propagation(node_regions)
+    node_column = blocks['node'].astype('category')
+    node_codes = node_column.cat.codes.to_numpy()
+    node_names = np.asarray(node_column.cat.categories)
+    heights, times, nodes = first_sightings(
+        blocks['height'].to_numpy(dtype=np.int64),
+        blocks[time_column].to_numpy(dtype='datetime64[ns]').view(np.int64),
+        node_codes,
+    )
+
+    starts = segment_starts(heights)
+    counts = np.diff(np.r_[starts, len(heights)])
+    first_seen = np.minimum.reduceat(times, starts)
+    last_seen = np.maximum.reduceat(times, starts)
+    reference = first_seen.copy()
+    has_proposer = np.zeros(len(starts), dtype=bool)
+
+    if node_addresses is not None and proposer_column in blocks.columns:
+        # Proposer of every height as a node code, -1 if its address is unknown
+        address_codes = {node_addresses[node]: code for code, node in enumerate(node_names)
+                         if node in node_addresses}
+        proposers = blocks[[proposer_column]].assign(height=blocks['height'].to_numpy(dtype=np.int64))
+        proposers = proposers.drop_duplicates('height').set_index('height')[proposer_column]
+        proposer_codes = proposers.map(address_codes).reindex(heights[starts]).fillna(-1).to_numpy(dtype=np.int64)
+        # Rows where the node is the proposer of their height give its time
+        is_proposer = nodes == np.repeat(proposer_codes, counts)
+        segment = np.repeat(np.arange(len(starts)), counts)
+        reference[segment[is_proposer]] = times[is_proposer]
+        has_proposer[segment[is_proposer]] = True
+
+    lags = (times - np.repeat(reference, counts)) / 1e9
+    node_lags = pd.DataFrame({
+        'height': heights,
+        'node': pd.Categorical.from_codes(nodes, node_names),
+        'lag_s': lags,
+    })
+    if node_regions is not None:
+        regions = pd.Series(node_names).map(node_regions).fillna('Unknown')
+        node_lags['region'] = pd.Categorical(regions.to_numpy()[nodes])
+
+    # Per height percentiles, lags sorted within each height
+    order = np.lexsort((lags, heights))
+    height_keys, summary = segment_summary(heights[order], lags[order])
+    per_height = pd.DataFrame({
+        'height': height_keys,
+        'first_seen': pd.to_datetime(first_seen, utc=True),
+        'last_seen': pd.to_datetime(last_seen, utc=True),
+        'spread_s': (last_seen - first_seen) / 1e9,
+        'from_proposer': has_proposer,
+        **summary,
+    })
+
+    per_region = None
+    if node_regions is not None:
+        region_codes = node_lags['region'].cat.codes.to_numpy()
+        order = np.lexsort((lags, region_codes))
+        region_keys, summary = segment_summary(region_codes[order], lags[order])
+        per_region = pd.DataFrame({
+            'region': node_lags['region'].cat.categories[region_keys],
+            **summary,
+        }).rename(columns={'nodes': 'samples'})
+
+    return per_height, node_lags, per_region
+
+
+def load_block_propagation(root, chainID, node_regions=None, node_addresses=None, node_ids=None,
+                           time_column='timestamp'):
+    # Loads only the columns the analysis needs from every node's consensus_block table
+    columns = ['height', time_column]
+    if node_addresses is not None:
+        columns.append('proposer')
+    blocks = load_table(root, chainID, 'consensus_block', columns=columns, node_ids=node_ids)
+    return block_propagation(blocks, node_regions, node_addresses, time_column)
+
+
+def plot_propagation_per_height(per_height, output_dir):
+    # Lag percentiles and the first to last seen spread of every block
+    os.makedirs(output_dir, exist_ok=True)
+    plt.figure(figsize=(16, 9))
+    for name in list(PROPAGATION_QUANTILES) + ['max']:
+        plt.plot(per_height['height'], per_height[f'{name}_lag_s'], label=name, linewidth=1)
+    plt.plot(per_height['height'], per_height['spread_s'], label='spread', linewidth=1, linestyle='--')
+    plt.title('Block Propagation per Height')
+    plt.xlabel('Height')
+    plt.ylabel('Lag (s)')
+    plt.legend()
+    plt.tight_layout()
+    output_file = os.path.join(output_dir, "block_propagation_per_height.png")
+    plt.savefig(output_file, bbox_inches='tight')
+    plt.close()
+    print(f"Plot saved at {output_file}")
+
+
+if __name__ == '__main__':
+    root = "/home/evan/traces/quic"
+    chainID = "1"
+    output_dir = "plots/block_propagation_" + chainID
+
+    # node directory -> region, e.g. from parse_validators_regions when the nodes are named by IP
+    node_regions = None
+
+    per_height, node_lags, per_region = load_block_propagation(root, chainID, node_regions)
+    os.makedirs(output_dir, exist_ok=True)
+    per_height.to_csv(os.path.join(output_dir, "propagation_per_height.csv"), index=False)
+    if per_region is not None:
+        per_region.to_csv(os.path.join(output_dir, "propagation_per_region.csv"), index=False)
+        print(per_region)
+    print(per_height.describe())
+    plot_propagation_per_height(per_height, output_dir)
@@ -0,0 +1,198 @@
+import bisect
+import gzip
+import io
+import os
+import struct
+
+# zstandard is only needed for .zst traces, isal only makes .gz ones faster
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+# Archived traces keep their name with one of these suffixes, e.g. msg_latency.jsonl.zst
+COMPRESSION_SUFFIXES = {
+    '.gz': 'gzip',
+    '.zst': 'zstd',
+}
+
+# Threads decompressing gzip blocks or seekable zstd frames
+DECOMPRESS_THREADS = min(os.cpu_count() or 1, 8)
+
+# Decompressed bytes of seekable zstd frames decoded at once, in parallel
+READAHEAD_BYTES = 64 * 1024 * 1024
+
+# Seek table of the zstd seekable format, a skippable frame at the end of the
+# file, see contrib/seekable_format in the zstd repository
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER = struct.Struct('<IBI')
+
+
+def compression(path):
+    # 'gzip', 'zstd' or None for a plain file
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1])
+
+
+def find_trace_file(directory, file_name):
+    # The plain trace file, or else its archive, None if there is neither
+    for suffix in ('',) + tuple(COMPRESSION_SUFFIXES):
+        path = os.path.join(directory, file_name + suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read_seek_table(f):
+    # [(compressed offset, compressed size, decompressed offset, decompressed
+    # size)] of every frame of a seekable zstd file, None if it has no seek table
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size < SEEK_TABLE_FOOTER.size + 8:
+        return None
+    f.seek(size - SEEK_TABLE_FOOTER.size)
+    num_frames, descriptor, magic = SEEK_TABLE_FOOTER.unpack(f.read(SEEK_TABLE_FOOTER.size))
+    if magic != SEEKABLE_MAGIC:
+        return None
+    entry_size = 12 if descriptor & 0x80 else 8
+    table_size = num_frames * entry_size
+    f.seek(size - SEEK_TABLE_FOOTER.size - table_size - 8)
+    header = f.read(8)
+    if len(header) < 8 or struct.unpack('<II', header) != (SKIPPABLE_MAGIC, table_size + SEEK_TABLE_FOOTER.size):
+        return None
+    table = f.read(table_size)
+
+    frames = []
+    compressed_offset = decompressed_offset = 0
+    for i in range(num_frames):
+        compressed_size, decompressed_size = struct.unpack_from('<II', table, i * entry_size)
+        frames.append((compressed_offset, compressed_size, decompressed_offset, decompressed_size))
+        compressed_offset += compressed_size
+        decompressed_offset += decompressed_size
+    return frames
+
+
+class SeekableZstdReader(io.RawIOBase):
+    # Random access reader of a seekable zstd file. Reads decompress the
+    # frames ahead of the position READAHEAD_BYTES at a time, the frames of a
+    # batch are independent so zstandard decompresses them on several threads
+
+    def __init__(self, path, frames, threads=DECOMPRESS_THREADS):
+        super().__init__()
+        self.file = open(path, 'rb')
+        self.frames = frames
+        self.frame_starts = [frame[2] for frame in frames]
+        self.size = frames[-1][2] + frames[-1][3] if frames else 0
+        self.threads = threads
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.position = 0
+        self.buffer = b''
+        self.buffer_start = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, b):
+        if self.position >= self.size:
+            return 0
+        if not self.buffer_start <= self.position < self.buffer_start + len(self.buffer):
+            self.load(self.position)
+        start = self.position - self.buffer_start
+        n = min(len(b), len(self.buffer) - start)
+        b[:n] = self.buffer[start:start + n]
+        self.position += n
+        return n
+
+    def load(self, position):
+        # Decompresses the frames from the one holding position onwards
+        first = bisect.bisect_right(self.frame_starts, position) - 1
+        last = first + 1
+        total = self.frames[first][3]
+        while last < len(self.frames) and total + self.frames[last][3] <= READAHEAD_BYTES:
+            total += self.frames[last][3]
+            last += 1
+
+        batch = self.frames[first:last]
+        self.file.seek(batch[0][0])
+        data = self.file.read(sum(frame[1] for frame in batch))
+        base = batch[0][0]
+        segments = [data[offset - base:offset - base + size] for offset, size, _, _ in batch]
+        sizes = struct.pack(f'<{len(batch)}Q', *(frame[3] for frame in batch))
+        results = self.decompressor.multi_decompress_to_buffer(segments, decompressed_sizes=sizes,
+                                                               threads=self.threads)
+        self.buffer = b''.join(results[i].tobytes() for i in range(len(results)))
+        self.buffer_start = batch[0][2]
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def require_zstandard(path):
+    if zstandard is None:
+        raise ImportError(f"Reading {path} requires the zstandard package: pip install zstandard")
+
+
+def open_trace(path):
+    # Opens a trace file for binary reading, decompressing archives on the fly.
+    # The result can be iterated by line and read in blocks like a plain file
+    kind = compression(path)
+    if kind == 'gzip':
+        if igzip_threaded is not None:
+            return igzip_threaded.open(path, 'rb', threads=DECOMPRESS_THREADS)
+        return gzip.open(path, 'rb')
+    if kind == 'zstd':
+        require_zstandard(path)
+        with open(path, 'rb') as f:
+            frames = read_seek_table(f)
+        if frames:
+            return io.BufferedReader(SeekableZstdReader(path, frames))
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True,
+                                                            closefd=True)
+        return io.BufferedReader(reader)
+    return open(path, 'rb')
+
+
+def skip_to(f, offset):
+    # Moves a trace opened by open_trace to offset, streams that cannot seek
+    # are read up to it
+    if offset == 0:
+        return
+    if f.seekable():
+        f.seek(offset)
+        return
+    while offset > 0:
+        skipped = len(f.read(min(offset, 1 << 20)))
+        if not skipped:
+            break
+        offset -= skipped
+
+
+def has_random_access(path):
+    # Plain files and seekable zstd archives can be bisected, other archives
+    # can only be read from the start
+    kind = compression(path)
+    if kind is None:
+        return True
+    if kind == 'zstd' and zstandard is not None:
+        with open(path, 'rb') as f:
+            return bool(read_seek_table(f))
+    return False
@@ -8,20 +8,45 @@ import matplotlib.dates as mdates
 import matplotlib.cm as cm
 from multiprocessing import Pool, cpu_count
 import functools
+import tempfile
 
-def plot_speed_progression_per_peer(speed_data, ips_to_regions, output_dir):
+from downsample import downsample_groups, downsample_series
+from instrumentation import add_worker_records, worker_stage
+from layout import iter_pairs, sort_canonical
+from rollups import resolve_cube
+from throughput import cumulative_series, fixed_windows, rolling_sums, sample_gaps, window_throughput
+from traffic_cube import ACTIONS, build_traffic_cube, cube_slice
+
+def plot_speed_progression_per_peer(speed_data, ips_to_regions, output_dir, max_points=None, downsample_method='lttb'):
+    # max_points optionally reduces each target peer's series before drawing, see downsample.py
     # Ensure the output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
-    # Get unique validators (source peers)
-    validators = speed_data['validator'].unique()
-
-    # Use multiprocessing Pool to parallelize plotting for each validator
-    with Pool(processes=cpu_count()) as pool:
-        pool.map(functools.partial(_plot_validator_speed_progression, speed_data, ips_to_regions, output_dir), validators)
-
-def _plot_validator_speed_progression(speed_data, ips_to_regions, output_dir, validator):
-    validator_data = speed_data[speed_data['validator'] == validator]
+    with tempfile.TemporaryDirectory() as slice_dir:
+        # Partition the data by validator (source peer) once, each worker only reads its own slice file.
+        # In canonical order every validator, and every peer within it, is a contiguous slice
+        speed_data = sort_canonical(speed_data)
+        tasks = []
+        for validator, validator_data in iter_pairs(speed_data, ['validator']):
+            slice_file = os.path.join(slice_dir, f"{validator}.arrow")
+            validator_data.reset_index(drop=True).to_feather(slice_file)
+            tasks.append((validator, slice_file))
+
+        # Use multiprocessing Pool to parallelize plotting for each validator
+        with Pool(processes=cpu_count()) as pool:
+            add_worker_records(pool.map(functools.partial(_plot_validator_speed_progression, ips_to_regions,
+                                                           output_dir, max_points, downsample_method), tasks))
+
+def _plot_validator_speed_progression(ips_to_regions, output_dir, max_points, downsample_method, task):
+    validator, slice_file = task
+    with worker_stage(f"render speed progression {validator}", 'render',
+                      bytes_read=os.path.getsize(slice_file)) as record:
+        record['rows'] = _render_validator_speed_progression(ips_to_regions, output_dir, max_points,
+                                                             downsample_method, validator, slice_file)
+    return record
+
+def _render_validator_speed_progression(ips_to_regions, output_dir, max_points, downsample_method, validator, slice_file):
+    validator_data = pd.read_feather(slice_file)
 
     # Get the region of the validator
     validator_region = ips_to_regions.get(validator, 'Unknown')
@@ -29,17 +54,17 @@ def _plot_validator_speed_progression(speed_data, ips_to_regions, output_dir, va
     # Create figure and axis objects
     fig, ax = plt.subplots(figsize=(16, 9), dpi=480)
 
-    # Get unique target peers for this validator
-    target_peers = validator_data['msg.peer_id'].unique()
+    # Split the validator's data by target peer, the slice file is in canonical order
+    target_peers = list(iter_pairs(validator_data, ['msg.peer_id']))
 
     # Generate a color map with enough colors
     num_lines = len(target_peers)
     colors = cm.get_cmap('nipy_spectral', num_lines)
 
-    for idx, target_peer in enumerate(target_peers):
-        peer_data = validator_data[validator_data['msg.peer_id'] == target_peer]
+    for idx, (target_peer, peer_data) in enumerate(target_peers):
         label = f"{peer_data['target_ip'].iloc[0]} ({peer_data['target_region'].iloc[0]})"
         color = colors(idx)
+        peer_data = downsample_series(peer_data, 'msg.time', 'speed_mbps', max_points, downsample_method)
         ax.plot(peer_data['msg.time'], peer_data['speed_mbps'], label=label, color=color, linewidth=2)
 
     ax.set_title(f"Speed Progression for Validator {validator} ({validator_region})")
@@ -67,26 +92,38 @@ def _plot_validator_speed_progression(speed_data, ips_to_regions, output_dir, va
     output_file = os.path.join(output_dir, f"speed_progression_{validator}.png")
     fig.savefig(output_file, bbox_inches='tight')
     plt.close(fig)
+    return len(validator_data)
+
+# Functions the per-peer plots run, their source versions the memoized renders (see stage_cache.code_version)
+PER_PEER_PLOT_FUNCTIONS = (plot_speed_progression_per_peer, _plot_validator_speed_progression,
+                           _render_validator_speed_progression)
 
 def calculate_speed_progression_per_peer(df, interval='10S'):
-    # Convert timestamps to datetime if not already done
-    df['msg.time'] = pd.to_datetime(df['msg.time'])
+    return speed_progression_per_peer_from_cube(build_traffic_cube(None, df), interval=interval)
 
-    # Ensure 'msg.bytes' is numeric
-    df['msg.bytes'] = pd.to_numeric(df['msg.bytes'], errors='coerce')
+def speed_progression_per_peer_from_cube(cube, direction=None, interval='10S'):
+    # cube may also be a rollup pyramid
+    cube = cube_slice(resolve_cube(cube, interval), direction)
 
-    # Set 'msg.time' as index
-    df = df.set_index('msg.time')
+    # Set the bucket start as index
+    df = cube.set_index('bucket')
 
-    # Group data by validator (source peer), target peer (msg.peer_id), and time intervals
+    # Group data by validator (source peer), target peer (msg.peer_id), and time intervals.
+    # The cube is in canonical order, so the groups come out sorted without sorting them
     grouped = df.groupby([
         'validator',
         'msg.peer_id',
         pd.Grouper(freq=interval)
-    ])
-
-    # Sum the bytes in each interval
-    speed_data = grouped['msg.bytes'].sum().reset_index()
+    ], observed=True, sort=False)
+
+    # Sum the bytes in each interval, the target IP and region for labeling
+    # were resolved through the experiment's address book when the cube was built
+    speed_data = grouped.agg(
+        bytes=('bytes', 'sum'),
+        target_ip=('target_ip', 'first'),
+        target_region=('target_region', 'first'),
+    ).reset_index()
+    speed_data = speed_data.rename(columns={'bucket': 'msg.time', 'bytes': 'msg.bytes'})
 
     # Calculate the actual duration of each interval in seconds
     interval_duration = pd.to_timedelta(interval).total_seconds()
@@ -98,60 +135,58 @@ def calculate_speed_progression_per_peer(df, interval='10S'):
     speed_data.replace([np.inf, -np.inf], np.nan, inplace=True)
     speed_data.dropna(subset=['speed_mbps'], inplace=True)
 
-    # Merge with target IP and region for labeling
-    peer_info = df[['msg.peer_id', 'target_ip', 'target_region']].drop_duplicates()
-    speed_data = speed_data.merge(peer_info, on='msg.peer_id', how='left')
-
-    return speed_data
+    return speed_data[['validator', 'msg.peer_id', 'msg.time', 'msg.bytes', 'speed_mbps', 'target_ip',
+                       'target_region']]
 
 def calculate_speed_progression(df, action, interval='10S'):
-    # Convert timestamps to datetime
-    df['msg.time'] = pd.to_datetime(df['msg.time'])
-
-    # Resample data for each validator into specified time intervals
-    resampled = (
-        df.set_index('msg.time')
-        .groupby('validator')
-        .resample(interval)
-        .agg(
-            total_bytes=('msg.bytes', 'sum'),
-            region=('region', 'first')
-        )
-        .reset_index()
-    )
-
-    # Calculate elapsed time in seconds for each interval
-    resampled['time_diff'] = resampled.groupby('validator')['msg.time'].diff().dt.total_seconds()
-
-    # Calculate speed in Mbps
-    resampled['speed_mbps'] = (resampled['total_bytes'] * 8) / (resampled['time_diff'] * 1_000_000)
-
-    # Filter out invalid rows (e.g., NaN or infinite speeds due to zero time_diff)
-    resampled = resampled.dropna(subset=['speed_mbps'])
+    return speed_progression_from_cube(build_traffic_cube(None, df), action=action, interval=interval)
+
+def speed_progression_from_cube(cube, direction=None, action=None, interval='10S'):
+    # cube may also be a rollup pyramid
+    cube = cube_slice(resolve_cube(cube, interval), direction)
+
+    # Bytes of each validator per interval, every interval lasts exactly interval
+    # so the first one of a validator and the idle ones are kept
+    # A validator has a single region, it is carried along as a series key
+    series = cumulative_series(cube, ['validator', 'region'], 'bucket', 'bytes')
+    resampled = window_throughput(series, *fixed_windows(series, interval)).rename(columns={
+        'window_start': 'msg.time',
+        'bytes': 'total_bytes',
+        'duration_s': 'time_diff',
+    })
+    # The region follows the bytes, as in the original resampled frame
+    resampled = resampled[['validator', 'msg.time', 'total_bytes', 'region', 'time_diff', 'speed_mbps']]
 
     # Add action type (send/receive) for clarity in plotting
-    resampled['action'] = action
+    resampled['action'] = action if action is not None else ACTIONS.get(direction)
 
     return resampled
 
-def plot_speed_progression(sent_df, received_df, output_dir):
+def plot_speed_progression(sent_df, received_df, output_dir, max_points=None, downsample_method='lttb'):
+    plot_speed_progression_from_cube(build_traffic_cube(sent_df, received_df), output_dir,
+                                     max_points=max_points, downsample_method=downsample_method)
+
+def plot_speed_progression_from_cube(cube, output_dir, interval='10S', max_points=None, downsample_method='lttb'):
+    # max_points optionally reduces each validator and action series before drawing, see downsample.py
     # Ensure the output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
     # Calculate speed progression for sent and received data
-    sent_speeds = calculate_speed_progression(sent_df, action='Send')
-    received_speeds = calculate_speed_progression(received_df, action='Receive')
+    sent_speeds = speed_progression_from_cube(cube, 'sent', interval=interval)
+    received_speeds = speed_progression_from_cube(cube, 'received', interval=interval)
 
-    received_speeds['validator_with_region'] = received_speeds['validator'] + ' (' + received_speeds['region'] + ')'
-    sent_speeds['validator_with_region'] = sent_speeds['validator'] + ' (' + sent_speeds['region'] + ')'
+    received_speeds['validator_with_region'] = received_speeds['validator'].astype(str) + ' (' + received_speeds['region'].astype(str) + ')'
+    sent_speeds['validator_with_region'] = sent_speeds['validator'].astype(str) + ' (' + sent_speeds['region'].astype(str) + ')'
 
     # Combine data for plotting
     progression = pd.concat([sent_speeds, received_speeds])
+    progression = downsample_groups(progression, ['validator_with_region', 'action'], 'msg.time', 'speed_mbps',
+                                    max_points, downsample_method)
 
     # Plot the speed progression
     plt.figure(figsize=(16, 9), dpi=480)
     sns.lineplot(data=progression, x='msg.time', y='speed_mbps', hue='validator_with_region', style='action')
-    plt.title('Speed Progression Over Time (Every 10 Seconds)')
+    plt.title(f'Speed Progression Over Time (Every {pd.to_timedelta(interval).total_seconds():g} Seconds)')
     plt.xlabel('Time')
     plt.ylabel('Speed (Mbps)')
     plt.legend(title='Validator and Action', bbox_to_anchor=(1.05, 1), loc='upper left')
@@ -160,28 +195,23 @@ def plot_speed_progression(sent_df, received_df, output_dir):
     plt.savefig(output_file, bbox_inches='tight')
     plt.close()
 
-def calculate_total_speeds(sent_df, received_df):
-    # Convert timestamps to datetime
-    sent_df['msg.time'] = pd.to_datetime(sent_df['msg.time'])
-    received_df['msg.time'] = pd.to_datetime(received_df['msg.time'])
-
-    # Calculate total bytes sent and received
-    sent_agg = sent_df.groupby('validator').agg(
-        total_bytes_sent=('msg.bytes', 'sum'),
-        start_time_sent=('msg.time', 'min'),
-        end_time_sent=('msg.time', 'max'),
-        region = ('region', 'first')
-    ).reset_index()
-
-    received_agg = received_df.groupby('validator').agg(
-        total_bytes_received=('msg.bytes', 'sum'),
-        start_time_received=('msg.time', 'min'),
-        end_time_received=('msg.time', 'max'),
-        region = ('region', 'first')
-    ).reset_index()
-
+def aggregate_totals(cube, key, direction, with_region):
+    # Total bytes and first/last timestamps per key for one direction
+    aggregations = {
+        f'total_bytes_{direction}': ('bytes', 'sum'),
+        f'start_time_{direction}': ('first_time', 'min'),
+        f'end_time_{direction}': ('last_time', 'max'),
+    }
+    if with_region:
+        aggregations['region'] = ('region', 'first')
+    # Validators are already in order in the canonical cube, regions are not
+    return cube_slice(resolve_cube(cube), direction).groupby(
+        key, observed=True, sort=key != 'validator'
+    ).agg(**aggregations).reset_index()
+
+def totals_to_speeds(sent_agg, received_agg, key):
     # Merge sent and received data
-    total_speeds = pd.merge(sent_agg, received_agg, on='validator', how='outer')
+    total_speeds = pd.merge(sent_agg, received_agg, on=key, how='outer')
 
     # Calculate total time in seconds for sending and receiving
     total_speeds['total_time_sent'] = (total_speeds['end_time_sent'] - total_speeds['start_time_sent']).dt.total_seconds()
@@ -193,39 +223,26 @@ def calculate_total_speeds(sent_df, received_df):
 
     return total_speeds
 
-def calculate_total_regions_speeds(sent_df, received_df):
-    # Convert timestamps to datetime
-    sent_df['msg.time'] = pd.to_datetime(sent_df['msg.time'])
-    received_df['msg.time'] = pd.to_datetime(received_df['msg.time'])
-
-    # Calculate total bytes sent and received
-    sent_agg = sent_df.groupby('region').agg(
-        total_bytes_sent=('msg.bytes', 'sum'),
-        start_time_sent=('msg.time', 'min'),
-        end_time_sent=('msg.time', 'max')
-    ).reset_index()
-
-    received_agg = received_df.groupby('region').agg(
-        total_bytes_received=('msg.bytes', 'sum'),
-        start_time_received=('msg.time', 'min'),
-        end_time_received=('msg.time', 'max')
-    ).reset_index()
-
-    # Merge sent and received data
-    total_speeds = pd.merge(sent_agg, received_agg, on='region', how='outer')
+def calculate_total_speeds(sent_df, received_df):
+    return total_speeds_from_cube(build_traffic_cube(sent_df, received_df))
 
-    # Calculate total time in seconds for sending and receiving
-    total_speeds['total_time_sent'] = (total_speeds['end_time_sent'] - total_speeds['start_time_sent']).dt.total_seconds()
-    total_speeds['total_time_received'] = (total_speeds['end_time_received'] - total_speeds['start_time_received']).dt.total_seconds()
+def total_speeds_from_cube(cube):
+    # Calculate total bytes sent and received per validator
+    sent_agg = aggregate_totals(cube, 'validator', 'sent', with_region=True)
+    received_agg = aggregate_totals(cube, 'validator', 'received', with_region=True)
+    return totals_to_speeds(sent_agg, received_agg, 'validator')
 
-    # Calculate upload and download speeds in Mbps
-    total_speeds['upload_speed_mbps'] = (total_speeds['total_bytes_sent'] * 8) / (total_speeds['total_time_sent'] * 1_000_000)
-    total_speeds['download_speed_mbps'] = (total_speeds['total_bytes_received'] * 8) / (total_speeds['total_time_received'] * 1_000_000)
+def calculate_total_regions_speeds(sent_df, received_df):
+    return total_regions_speeds_from_cube(build_traffic_cube(sent_df, received_df))
 
-    return total_speeds
+def total_regions_speeds_from_cube(cube):
+    # Calculate total bytes sent and received per region
+    sent_agg = aggregate_totals(cube, 'region', 'sent', with_region=False)
+    received_agg = aggregate_totals(cube, 'region', 'received', with_region=False)
+    return totals_to_speeds(sent_agg, received_agg, 'region')
 
 def plot_speeds(total_speeds, output_dir):
-    total_speeds['validator_with_region'] = total_speeds['validator'] + ' (' + total_speeds['region_x'] + ')'
+    total_speeds['validator_with_region'] = total_speeds['validator'].astype(str) + ' (' + total_speeds['region_x'].astype(str) + ')'
     # Melt data for plotting
     plot_data = total_speeds.melt(id_vars=['validator_with_region'], value_vars=['upload_speed_mbps', 'download_speed_mbps'],
                                   var_name='Speed Type', value_name='Speed (Mbps)')
@@ -264,16 +281,27 @@ def calculate_mean_speeds(total_speeds):
     mean_download_speed = total_speeds['download_speed_mbps'].mean()
     return mean_upload_speed, mean_download_speed
 
-def compute_speeds(df, action):
+def compute_speeds(df, action, window=None):
+    # Speed of every sample from the bytes since the previous sample of the
+    # same peer, or with window (e.g. '1s') from the bytes of the peer in the
+    # trailing window. Samples are sorted per (validator, peer) once, see throughput.py
     # Convert timestamps to datetime
     df['msg.time'] = pd.to_datetime(df['msg.time'])
+    series = cumulative_series(df, ['validator', 'msg.peer_id'])
 
-    # Compute time differences between consecutive messages from the same peer
-    df['time_diff'] = df.groupby(['validator', 'msg.peer_id'])['msg.time'].diff().dt.total_seconds()
+    # Time differences between consecutive messages from the same peer, back in the rows' order
+    time_diff = np.empty(len(df))
+    time_diff[series['order']] = sample_gaps(series)
+    df['time_diff'] = time_diff
 
     # Use 'msg.bytes' directly as the amount of bytes transferred in each interval
     # Compute speed (bytes per second)
-    df['speed_bytes_per_sec'] = df['msg.bytes'] / df['time_diff']
+    if window is None:
+        df['speed_bytes_per_sec'] = df['msg.bytes'] / df['time_diff']
+    else:
+        window_bytes = np.empty(len(df))
+        window_bytes[series['order']] = rolling_sums(series, window)
+        df['speed_bytes_per_sec'] = window_bytes / pd.to_timedelta(window).total_seconds()
 
     # Remove NaN or infinite values resulting from any division issues
     df = df.replace([np.inf, -np.inf], np.nan).dropna(subset=['speed_bytes_per_sec'])
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+# Width in pixels of the speed progression figures (16in at 480dpi), more
+# points per series than this can never show up as distinct vertices
+PLOT_WIDTH_POINTS = 16 * 480
+
+
+def as_float(values):
+    # Datetimes, tz-aware ones included, are downsampled on their nanosecond timestamps
+    if pd.api.types.is_datetime64_any_dtype(values):
+        values = pd.Series(values).to_numpy(dtype='datetime64[ns]')
+    values = np.asarray(values)
+    if values.dtype.kind == 'M':
+        return values.view(np.int64).astype(np.float64)
+    return values.astype(np.float64)
+
+
+def lttb_indices(x, y, max_points):
+    # Largest-Triangle-Three-Buckets: keeps the first and last points and, for
+    # every bucket in between, the point forming the largest triangle with the
+    # point kept in the previous bucket and the average of the next bucket
+    n = len(x)
+    if max_points >= n or max_points < 3:
+        return np.arange(n)
+    x = as_float(x)
+    y = as_float(y)
+
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    indices = np.empty(max_points, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    previous = 0
+    for bucket in range(max_points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = end, edges[bucket + 2] if bucket + 2 < len(edges) else n
+        next_x = x[next_start:next_end].mean()
+        next_y = y[next_start:next_end].mean()
+
+        # Twice the triangle areas, the constant factor does not change the argmax
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        indices[bucket + 1] = previous
+    return indices
+
+
+def minmax_indices(x, y, max_points):
+    # Min/max envelope: keeps the lowest and the highest point of each of
+    # max_points / 2 equally sized buckets, so spikes and stalls stay visible
+    n = len(x)
+    if max_points >= n or max_points < 2:
+        return np.arange(n)
+    y = as_float(y)
+
+    num_buckets = max_points // 2
+    buckets = np.arange(n) * num_buckets // n
+    order = np.lexsort((y, buckets))
+    starts = np.searchsorted(buckets[order], np.arange(num_buckets))
+    ends = np.append(starts[1:], n) - 1
+    return np.unique(np.concatenate([order[starts], order[ends]]))
+
+
+DOWNSAMPLERS = {
+    'lttb': lttb_indices,
+    'minmax': minmax_indices,
+}
+
+
+def downsample_series(df, x, y, max_points=PLOT_WIDTH_POINTS, method='lttb'):
+    # Returns the rows of a single series, sorted by x, reduced to about max_points
+    if max_points is None or len(df) <= max_points:
+        return df
+    if method not in DOWNSAMPLERS:
+        raise ValueError(f"Unknown downsampling method: {method}")
+    df = df.sort_values(x)
+    indices = DOWNSAMPLERS[method](df[x], df[y], max_points)
+    return df.iloc[indices]
+
+
+def downsample_groups(df, by, x, y, max_points=PLOT_WIDTH_POINTS, method='lttb'):
+    # Downsamples every series of a long-format frame separately
+    if max_points is None:
+        return df
+    groups = [
+        downsample_series(group, x, y, max_points, method)
+        for _, group in df.groupby(by, observed=True, sort=False)
+    ]
+    if not groups:
+        return df
+    return pd.concat(groups)
@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from parse_jsonl import TRACE_FILES
+
+# Regions the validators are spread over, round robin
+REGIONS = ['nyc1', 'nyc3', 'sfo3', 'tor1', 'ams3', 'lon1', 'fra1', 'blr1', 'sgp1', 'syd1']
+
+DEFAULT_START = np.datetime64('2024-12-09T20:00:00', 'ns')
+
+# Seconds of traces generated at once per file, memory does not depend on the duration
+CHUNK_SECONDS = 60
+
+P2P_PORT = 26656
+
+LIST_HEADER = "ID  Name  Public IPv4  Private IPv4  Public IPv6  Memory  VCPUs  Disk  Region  Image  VPC UUID  Status  Tags  Features  Volumes\n"
+
+
+def validator_ip(index):
+    return f"10.{index // 62500}.{index // 250 % 250}.{index % 250 + 1}"
+
+
+def peer_id(seed, index):
+    # 40 hex chars, like the tendermint node IDs
+    return np.random.default_rng([seed, index, 1]).bytes(20).hex()
+
+
+def peer_indices(index, num_validators, num_peers):
+    # Ring neighbours on both sides, so with an even num_peers every
+    # connection is seen from both ends (sent at one, received at the other)
+    num_peers = min(num_peers, num_validators - 1)
+    offsets = []
+    step = 1
+    while len(offsets) < num_peers:
+        offsets.append(step)
+        if len(offsets) < num_peers:
+            offsets.append(-step)
+        step += 1
+    return [(index + offset) % num_validators for offset in offsets]
+
+
+def region_latency_ms(seed, regions):
+    # Symmetric base one-way latency between regions, a few ms within a region
+    rng = np.random.default_rng([seed, 2])
+    latency = rng.uniform(10, 150, (len(regions), len(regions)))
+    latency = (latency + latency.T) / 2
+    np.fill_diagonal(latency, rng.uniform(0.5, 3, len(regions)))
+    return latency
+
+
+def format_times(ns):
+    # RFC3339 with nanoseconds and the trailing zeros trimmed, as Go writes them
+    values = np.datetime_as_string(ns.astype('datetime64[ns]'), unit='ns')
+    values = np.char.rstrip(np.char.rstrip(values, '0'), '.')
+    return np.char.add(values, 'Z')
+
+
+def write_regions_file(regions_file, num_validators):
+    # Same layout as the droplet listing parse_ip_to_region reads
+    with open(regions_file, 'w') as f:
+        f.write(LIST_HEADER)
+        for index in range(num_validators):
+            f.write(f"{400000000 + index}  validator-{index}  {validator_ip(index)}  10.110.0.{index % 250 + 2}"
+                    f"    8192  4  160  {REGIONS[index % len(REGIONS)]}  Ubuntu 22.04 (LTS) x64"
+                    f"  00000000-0000-0000-0000-000000000000  active  celestia  droplet_agent,private_networking\n")
+    return {validator_ip(index): REGIONS[index % len(REGIONS)] for index in range(num_validators)}
+
+
+def chunk_samples(rng, num_peers, rate, chunk_start, chunk_ns):
+    # Poisson arrivals of every peer within one chunk, sorted by time
+    counts = rng.poisson(rate * chunk_ns / 1e9, num_peers)
+    peers = np.repeat(np.arange(num_peers), counts)
+    times = chunk_start + rng.integers(0, chunk_ns, len(peers))
+    order = np.argsort(times, kind='stable')
+    return times[order], peers[order]
+
+
+def write_timed_bytes(f, rng, params, validator, table, peers, chunk_start, chunk_ns):
+    times, peer_codes = chunk_samples(rng, len(peers['ids']), params['sample_rate'], chunk_start, chunk_ns)
+    if len(times) == 0:
+        return 0
+    # Block parts and mempool messages, mostly small with a long tail
+    sizes = np.maximum(rng.lognormal(8, 1.5, len(times)).astype(np.int64), 1)
+    stamps = format_times(times)
+    ids = peers['ids'][peer_codes]
+    addresses = peers['addresses'][peer_codes]
+    f.writelines(
+        f'{{"chain_id":"{params["chain_id"]}","node_id":"{validator}","table":"{table}","timestamp":"{stamp}",'
+        f'"msg":{{"time":"{stamp}","bytes":{size},"peer_id":"{peer}","ip_address":"{address}:{P2P_PORT}"}}}}\n'
+        for stamp, size, peer, address in zip(stamps, sizes, ids, addresses)
+    )
+    return len(times)
+
+
+def write_msg_latency(f, rng, params, validator, peers, chunk_start, chunk_ns):
+    send_times, peer_codes = chunk_samples(rng, len(peers['ids']), params['latency_rate'], chunk_start, chunk_ns)
+    if len(send_times) == 0:
+        return 0
+    # Base latency of the region pair with exponential jitter, the clocks of
+    # the two ends are skewed so small latencies can come out negative
+    latency = peers['latency_ms'][peer_codes] * (1 + rng.exponential(0.1, len(send_times)))
+    skew = peers['skew_ns'][peer_codes]
+    receive_times = send_times + (latency * 1e6).astype(np.int64) + skew
+    sends = format_times(send_times)
+    receives = format_times(receive_times)
+    ids = peers['ids'][peer_codes]
+    addresses = peers['addresses'][peer_codes]
+    f.writelines(
+        f'{{"chain_id":"{params["chain_id"]}","node_id":"{validator}","table":"msg_latency","timestamp":"{receive}",'
+        f'"msg":{{"peer_id":"{peer}","ip_address":"{address}","send_time":"{send}","receive_time":"{receive}"}}}}\n'
+        for send, receive, peer, address in zip(sends, receives, ids, addresses)
+    )
+    return len(send_times)
+
+
+def generate_validator(task):
+    # Pool worker, writes the three trace files of one validator
+    experiment_path, index, params = task
+    num_validators = params['num_validators']
+    seed = params['seed']
+    validator = validator_ip(index)
+    regions = REGIONS[:min(num_validators, len(REGIONS))]
+    base_latency = region_latency_ms(seed, regions)
+    clock_skew_ms = np.random.default_rng([seed, 3]).normal(0, 2, num_validators)
+
+    neighbours = peer_indices(index, num_validators, params['num_peers'])
+    peers = {
+        'ids': np.array([peer_id(seed, peer) for peer in neighbours]),
+        'addresses': np.array([validator_ip(peer) for peer in neighbours]),
+        'latency_ms': np.array([base_latency[index % len(regions), peer % len(regions)] for peer in neighbours]),
+        'skew_ns': np.array([(clock_skew_ms[index] - clock_skew_ms[peer]) * 1e6 for peer in neighbours], dtype=np.int64),
+    }
+
+    validator_dir = os.path.join(experiment_path, validator)
+    os.makedirs(validator_dir, exist_ok=True)
+    rng = np.random.default_rng([seed, index, 4])
+    start = int(np.datetime64(params['start'], 'ns').astype(np.int64))
+    duration_ns = int(params['duration'] * 1e9)
+    chunk_ns = CHUNK_SECONDS * 1_000_000_000
+
+    lines = 0
+    files = {table: open(os.path.join(validator_dir, file_name), 'w') for table, file_name in TRACE_FILES.items()}
+    files['latency'] = open(os.path.join(validator_dir, 'msg_latency.jsonl'), 'w')
+    try:
+        for chunk_start in range(start, start + duration_ns, chunk_ns):
+            chunk_length = min(chunk_ns, start + duration_ns - chunk_start)
+            for direction in TRACE_FILES:
+                lines += write_timed_bytes(files[direction], rng, params, validator, f"timed_{direction}_bytes",
+                                           peers, chunk_start, chunk_length)
+            lines += write_msg_latency(files['latency'], rng, params, validator, peers, chunk_start, chunk_length)
+    finally:
+        for f in files.values():
+            f.close()
+    return lines
+
+
+def generate_experiment(experiment_path, regions_file, num_validators=10, num_peers=8, duration=60,
+                        sample_rate=10, latency_rate=1, start=DEFAULT_START, seed=0, chain_id='synthetic'):
+    # Writes an experiment directory with one folder per validator holding
+    # timed_sent_bytes.jsonl, timed_received_bytes.jsonl and msg_latency.jsonl
+    # in the tracer's schema, plus the matching regions file. sample_rate and
+    # latency_rate are per peer and per second, duration is in seconds.
+    # Returns ips_to_regions and the number of lines written
+    os.makedirs(experiment_path, exist_ok=True)
+    ips_to_regions = write_regions_file(regions_file, num_validators)
+    params = {
+        'num_validators': num_validators,
+        'num_peers': num_peers,
+        'duration': duration,
+        'sample_rate': sample_rate,
+        'latency_rate': latency_rate,
+        'start': str(start),
+        'seed': seed,
+        'chain_id': chain_id,
+    }
+    tasks = [(experiment_path, index, params) for index in range(num_validators)]
+    with Pool(processes=min(max(cpu_count() - 1, 1), len(tasks))) as pool:
+        lines = sum(pool.map(generate_validator, tasks))
+    with open(os.path.join(experiment_path, 'generator.json'), 'w') as f:
+        json.dump(params, f, indent=2)
+    return ips_to_regions, lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic trace experiment")
+    parser.add_argument('experiment_path')
+    parser.add_argument('--regions-file', default='list.txt')
+    parser.add_argument('--validators', type=int, default=10)
+    parser.add_argument('--peers', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=60, help="seconds")
+    parser.add_argument('--sample-rate', type=float, default=10, help="timed bytes samples per peer per second")
+    parser.add_argument('--latency-rate', type=float, default=1, help="msg_latency samples per peer per second")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    _, lines = generate_experiment(args.experiment_path, args.regions_file, args.validators, args.peers,
+                                   args.duration, args.sample_rate, args.latency_rate, seed=args.seed)
+    print(f"wrote {lines} lines for {args.validators} validators to {args.experiment_path}")
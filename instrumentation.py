@@ -0,0 +1,213 @@
+import cProfile
+import json
+import os
+import platform
+import re
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from multiprocessing import cpu_count
+
+# ru_maxrss is in KiB on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# Stage and worker records of the current run, see start_run. Pool workers
+# measure themselves with worker_stage and the parent adds their records
+RUN = {
+    'name': None,
+    'started': None,
+    'start_time': None,
+    'stages': [],
+    'workers': [],
+    'profile_stages': set(),
+    'profile_dir': None,
+}
+
+# Records of the measurements in progress, outermost first, per thread so
+# that experiments analysed concurrently by batch.py do not nest in each other
+LOCAL = threading.local()
+
+# Number of measurements in progress per thread of this process. The high
+# water mark is shared by all threads, a measurement only resets it while
+# no other thread is measuring
+MEASURING = {'lock': threading.Lock(), 'threads': {}}
+
+
+def reset_measuring():
+    # A forked worker starts without the parent's threads or their measurements
+    MEASURING['lock'] = threading.Lock()
+    MEASURING['threads'] = {}
+
+
+os.register_at_fork(after_in_child=reset_measuring)
+
+
+def reset_peak_rss():
+    # Linux lets a process reset its high water mark, elsewhere the peak is
+    # the one since the process started
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+
+def children_cpu():
+    # CPU time of the reaped child processes, pool workers count once the pool is closed
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def start_run(name, profile_stages=(), profile_dir=None):
+    # Starts collecting a new run. Stages named in profile_stages run under
+    # cProfile and their stats are dumped to profile_dir
+    RUN.update({
+        'name': name,
+        'started': datetime.now(timezone.utc).isoformat(),
+        'start_time': time.perf_counter(),
+        'stages': [],
+        'workers': [],
+        'profile_stages': set(profile_stages),
+        'profile_dir': profile_dir,
+    })
+
+
+def active_records():
+    if not hasattr(LOCAL, 'records'):
+        LOCAL.records = []
+    return LOCAL.records
+
+
+def profiled(name):
+    # A profiled name also covers the stages it prefixes, 'parse' profiles
+    # every 'parse <direction> <validator>' worker. Workers see the profiled
+    # stages of the run they were forked from
+    return any(name == prefix or name.startswith(prefix + ' ') for prefix in RUN['profile_stages'])
+
+
+@contextmanager
+def measure(name, category=None, rows=None, bytes_read=None):
+    # Measures the enclosed block. The yielded record can be updated with
+    # rows and bytes_read once they are known. Measurements nest, an outer
+    # one keeps the highest peak RSS of the ones it encloses
+    # A forked pool worker inherits the parent's measurements, they do not enclose its own
+    active = active_records()
+    active[:] = [outer for outer in active if outer['pid'] == os.getpid()]
+    record = {'stage': name, 'category': category, 'pid': os.getpid(), 'nested': bool(active),
+              'rows': rows, 'bytes_read': bytes_read}
+    for outer in active:
+        outer['peak_rss'] = max(outer['peak_rss'], peak_rss())
+    # With measurements running in other threads, e.g. batch.py, resetting
+    # would lose their peaks. The peak is then the process' since its last
+    # reset, which the record marks with peak_rss_scope 'process'
+    thread = threading.get_ident()
+    with MEASURING['lock']:
+        threads = MEASURING['threads']
+        if any(count for other, count in threads.items() if other != thread):
+            record['peak_rss_scope'] = 'process'
+        else:
+            reset_peak_rss()
+            record['peak_rss_scope'] = 'stage'
+        threads[thread] = threads.get(thread, 0) + 1
+    record['peak_rss'] = 0
+    active.append(record)
+
+    profiler = None
+    if profiled(name):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    wall, cpu, children = time.perf_counter(), time.process_time(), children_cpu()
+    try:
+        yield record
+    finally:
+        wall_s = time.perf_counter() - wall
+        if profiler is not None:
+            profiler.disable()
+            profile_dir = RUN['profile_dir'] or '.'
+            os.makedirs(profile_dir, exist_ok=True)
+            file_name = re.sub(r'[^\w.-]+', '_', name)
+            record['profile'] = os.path.join(profile_dir, f"{file_name}_{os.getpid()}.prof")
+            profiler.dump_stats(record['profile'])
+
+        active.pop()
+        with MEASURING['lock']:
+            MEASURING['threads'][thread] -= 1
+            if not MEASURING['threads'][thread]:
+                del MEASURING['threads'][thread]
+        record['peak_rss'] = max(record['peak_rss'], peak_rss())
+        for outer in active:
+            outer['peak_rss'] = max(outer['peak_rss'], record['peak_rss'])
+            if record['peak_rss_scope'] == 'process':
+                outer['peak_rss_scope'] = 'process'
+        record.update({
+            'wall_s': wall_s,
+            'cpu_s': time.process_time() - cpu,
+            'workers_cpu_s': children_cpu() - children,
+            'peak_rss_mb': record.pop('peak_rss') / 2**20,
+            'rows_per_s': record['rows'] / wall_s if record['rows'] is not None and wall_s > 0 else None,
+        })
+
+
+@contextmanager
+def stage(name, category=None, rows=None, bytes_read=None):
+    # A stage of the run, category tells parsing, aggregation and rendering apart
+    with measure(name, category, rows, bytes_read) as record:
+        yield record
+    RUN['stages'].append(record)
+    print(f"{name}: {record['wall_s']:.2f}s wall, {record['cpu_s'] + record['workers_cpu_s']:.2f}s CPU, "
+          f"peak RSS {record['peak_rss_mb']:.0f}MB{' (process)' if record['peak_rss_scope'] == 'process' else ''}")
+
+
+def worker_stage(name, category=None, rows=None, bytes_read=None):
+    # Same as stage for code running in a pool worker, the worker returns the
+    # record with its result and the parent passes it to add_worker_records
+    return measure(name, category, rows, bytes_read)
+
+
+def add_worker_records(records):
+    RUN['workers'].extend(record for record in records if record is not None)
+
+
+def category_totals(records):
+    totals = {}
+    for record in records:
+        category = record['category'] or 'other'
+        totals[category] = totals.get(category, 0) + record['wall_s']
+    return totals
+
+
+def run_report():
+    # Stages are listed in the order they finished, nested ones before the
+    # stage enclosing them
+    top_level = [record for record in RUN['stages'] if not record['nested']]
+    return {
+        'run': RUN['name'],
+        'started': RUN['started'],
+        'wall_s': time.perf_counter() - RUN['start_time'] if RUN['start_time'] is not None else None,
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': cpu_count()},
+        'categories': category_totals(top_level),
+        'stages': RUN['stages'],
+        'workers': RUN['workers'],
+    }
+
+
+def write_report(output_file):
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    with open(output_file, 'w') as f:
+        json.dump(run_report(), f, indent=2)
+    print(f"Run report saved at {output_file}")
+    return output_file
@@ -0,0 +1,110 @@
+import math
+
+import numpy as np
+
+# Quantiles reported next to the mean
+SUMMARY_QUANTILES = {
+    'p50': 0.5,
+    'p90': 0.9,
+    'p99': 0.99,
+}
+
+
+class LatencySketch:
+    # Mergeable quantile sketch over latencies in ms. Values go to logarithmic
+    # buckets (as in DDSketch), so any quantile is within relative_accuracy of
+    # the true value while memory only grows with the log of the value range.
+    # Count, sum, min and max are kept exactly. Negative values, which clock
+    # skew between validators can produce, get their own mirrored buckets
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        self.zero += int((values == 0).sum())
+        self.add_to_store(self.positive, values[values > 0])
+        self.add_to_store(self.negative, -values[values < 0])
+        return self
+
+    def add_to_store(self, store, magnitudes):
+        if len(magnitudes) == 0:
+            return
+        keys, counts = np.unique(np.ceil(np.log(magnitudes) / self.log_gamma).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            store[key] = store.get(key, 0) + count
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different relative accuracies")
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def bucket_value(self, key):
+        # Midpoint of the bucket in the sense of relative error
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return math.nan
+        rank = q * (self.count - 1)
+        seen = 0
+        # Most negative values first, then zeros, then positive values
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return max(-self.bucket_value(key), self.min)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return min(self.bucket_value(key), self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count else math.nan
+
+    def summary(self):
+        summary = {'count': self.count, 'mean': self.mean()}
+        for name, q in SUMMARY_QUANTILES.items():
+            summary[name] = self.quantile(q)
+        summary['max'] = self.max if self.count else math.nan
+        return summary
+
+
+def merge_sketches(sketches, key_func):
+    # Combines {key: sketch} into {key_func(key): sketch}, e.g. per-pair
+    # sketches into per-region or whole-network ones. Inputs are not modified
+    merged = {}
+    for key, sketch in sketches.items():
+        new_key = key_func(key)
+        if new_key not in merged:
+            merged[new_key] = LatencySketch(sketch.relative_accuracy)
+        merged[new_key].merge(sketch)
+    return merged
@@ -0,0 +1,123 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Ingested frames and cubes are kept in one canonical order, by (direction,
+# validator, peer, time), so that the rows of every (validator, peer) pair are
+# contiguous. A pair is then a slice of the frame found through pair_offsets,
+# and passes over the pairs need neither a filter nor a re-sort
+PAIR_KEYS = ['direction', 'validator', 'msg.peer_id']
+
+
+def to_ns(times):
+    # Integer UTC nanoseconds of a datetime column
+    return pd.DatetimeIndex(times).as_unit('ns').asi8
+
+
+def key_arrays(df, time_column, keys=PAIR_KEYS):
+    # Integer sort keys of the present key columns, most significant first,
+    # then the time. Categoricals sort by their code, i.e. dictionary order
+    arrays = []
+    for key in keys:
+        if key not in df.columns:
+            continue
+        if isinstance(df[key].dtype, pd.CategoricalDtype):
+            arrays.append(df[key].cat.codes.to_numpy())
+        else:
+            arrays.append(pd.factorize(df[key], sort=True)[0])
+    if time_column is not None:
+        arrays.append(to_ns(df[time_column]))
+    return arrays
+
+
+def is_sorted(arrays):
+    # Whether the rows are in lexicographic order of arrays, in one pass
+    if not arrays or len(arrays[0]) < 2:
+        return True
+    tied = np.ones(len(arrays[0]) - 1, dtype=bool)
+    for values in arrays:
+        if (tied & (values[1:] < values[:-1])).any():
+            return False
+        tied &= values[1:] == values[:-1]
+    return True
+
+
+def canonical_order(arrays):
+    # Row order sorting arrays lexicographically, None if already sorted
+    if is_sorted(arrays):
+        return None
+    return np.lexsort(arrays[::-1])
+
+
+def sort_canonical(df, time_column='msg.time', keys=PAIR_KEYS):
+    # df in canonical order. Frames already in order, e.g. read back from a
+    # cache, are only checked
+    order = canonical_order(key_arrays(df, time_column, keys))
+    if order is None:
+        return df
+    return df.take(order).reset_index(drop=True)
+
+
+def pair_offsets(df, keys=PAIR_KEYS):
+    # [start, stop) row range of every run of equal keys of a canonical frame,
+    # one row per pair with its keys, in order
+    keys = [key for key in keys if key in df.columns]
+    arrays = key_arrays(df, None, keys)
+    if not len(df):
+        return pd.DataFrame(columns=keys + ['start', 'stop'])
+    boundary = np.zeros(len(df), dtype=bool)
+    boundary[0] = True
+    for values in arrays:
+        boundary[1:] |= values[1:] != values[:-1]
+    starts = np.flatnonzero(boundary)
+    offsets = df[keys].iloc[starts].reset_index(drop=True)
+    offsets['start'] = starts
+    offsets['stop'] = np.r_[starts[1:], len(df)]
+    return offsets
+
+
+def offset_positions(offsets):
+    # Row positions of the [start, stop) ranges of some offsets, in order
+    starts = offsets['start'].to_numpy(dtype=np.int64)
+    lengths = offsets['stop'].to_numpy(dtype=np.int64) - starts
+    if not len(lengths):
+        return np.array([], dtype=np.int64)
+    # Every range continues the count where the previous one stopped
+    shifts = starts - np.r_[0, np.cumsum(lengths)[:-1]]
+    return np.arange(lengths.sum()) + np.repeat(shifts, lengths)
+
+
+def offsets_path(data_path):
+    # The pair offsets of a stored frame live next to it
+    root, ext = os.path.splitext(data_path)
+    return root + '.offsets' + ext
+
+
+def store_offsets(df, data_path, keys=PAIR_KEYS):
+    # Writes the pair offsets of a canonical frame stored at data_path
+    offsets = pair_offsets(df, keys)
+    offsets.to_parquet(offsets_path(data_path), index=False)
+    return offsets
+
+
+def load_offsets(data_path, rows):
+    # The stored pair offsets of the frame at data_path, which has rows rows.
+    # None if they are missing or were written for another version of it
+    try:
+        offsets = pd.read_parquet(offsets_path(data_path))
+    except (OSError, ValueError):
+        return None
+    if (offsets['stop'].iloc[-1] if len(offsets) else 0) != rows:
+        return None
+    return offsets
+
+
+def iter_pairs(df, keys=PAIR_KEYS):
+    # (keys, rows) of every pair of a canonical frame, the rows are slices
+    # of df. Same as groupby(keys, sort=False) without hashing or copying
+    offsets = pair_offsets(df, keys)
+    key_columns = [key for key in keys if key in df.columns]
+    for row in offsets.itertuples(index=False):
+        key = tuple(row[:len(key_columns)])
+        yield key[0] if len(key) == 1 else key, df.iloc[row.start:row.stop]
@@ -1,9 +1,15 @@
 # Press the green button in the gutter to run the script.
 import pandas as pd
 
-from compute_speed import compute_speeds, resample_speeds, calculate_total_speeds, plot_speeds, calculate_total_regions_speeds, plot_region_speeds, \
-    plot_speed_progression, plot_speed_progression_per_peer, calculate_speed_progression_per_peer
-from parse_jsonl import process_experiment_data
+import downsample
+from compute_speed import compute_speeds, resample_speeds, plot_speeds, plot_region_speeds, plot_speed_progression_per_peer, \
+    plot_speed_progression_from_cube, total_regions_speeds_from_cube, total_speeds_from_cube, \
+    speed_progression_per_peer_from_cube, speed_progression_from_cube, aggregate_totals, totals_to_speeds, \
+    PER_PEER_PLOT_FUNCTIONS
+from downsample import PLOT_WIDTH_POINTS
+from instrumentation import stage, start_run, write_report
+from rollups import experiment_rollups, pyramid_digest
+from stage_cache import code_version, memoize_frame, memoize_render, stage_key
 from parse_validators_regions import parse_list_with_regions, parse_ip_to_region
 
 # plot all
@@ -24,38 +30,81 @@ if __name__ == '__main__':
     # experiment_path = 'traces_tm_native_bbr_52_validators'
     # experiment_path = 'traces_quic_52_validators'
     # experiment_path = 'traces_bench_tool'
+    # to compare several experiments in one run, see batch.py
 
     # ips_to_regions = parse_ip_to_region('list_with_regions.txt')
     # ips_to_regions = parse_ip_to_region('quic_tool_list_with_regions.txt')
     ips_to_regions = parse_ip_to_region('list.txt')
     print("finished parsing list with regions")
 
-    received_df, sent_df = process_experiment_data(experiment_path, ips_to_regions)
-    print("finished processing experiment data")
+    # set a budget in MB to build the cube out of core, for experiments whose samples do not fit in memory
+    memory_budget_mb = None
+
+    # stages listed here run under cProfile, e.g. ['ingest', 'render speed progression']
+    profile_stages = []
+    start_run(experiment_path, profile_stages, "plots/"+experiment_path+"/profiles")
+
+    # the rollups are stored with the experiment, the traces are only loaded if they changed
+    traffic_rollups = experiment_rollups(experiment_path, ips_to_regions, memory_budget_mb)
+    print("finished building traffic cube")
+
+    # every stage below is memoized by the rollups it reads, its parameters and its code, see stage_cache.py
+    rollup_key = pyramid_digest(traffic_rollups)
+    output_dir = "plots/"+experiment_path+"/"
+    interval = '10S'
 
     # plot each peer speed progression to all other peers combined
-    plot_speed_progression(sent_df, received_df, "plots/"+experiment_path+"/")
+    with stage('render speed progression', 'render'):
+        memoize_render(experiment_path, 'render_speed_progression',
+                       stage_key(rollup_key, interval, PLOT_WIDTH_POINTS, output_dir,
+                                 code_version(plot_speed_progression_from_cube, speed_progression_from_cube, downsample)),
+                       output_dir,
+                       lambda: plot_speed_progression_from_cube(traffic_rollups, output_dir, interval=interval,
+                                                                max_points=PLOT_WIDTH_POINTS))
     print("finished plotting speed progress")
 
     # plot the speed per region
-    total_speeds = calculate_total_regions_speeds(sent_df, received_df)
+    with stage('aggregate region speeds', 'aggregate'):
+        region_speeds_key = stage_key(rollup_key, code_version(total_regions_speeds_from_cube, aggregate_totals,
+                                                               totals_to_speeds))
+        total_speeds = memoize_frame(experiment_path, 'region_speeds', region_speeds_key,
+                                     lambda: total_regions_speeds_from_cube(traffic_rollups))
     print("finished calculating region speeds")
-    plot_region_speeds(total_speeds, "plots/"+experiment_path+"/")
+    with stage('render region speeds', 'render'):
+        memoize_render(experiment_path, 'render_region_speeds',
+                       stage_key(region_speeds_key, output_dir, code_version(plot_region_speeds)), output_dir,
+                       lambda: plot_region_speeds(total_speeds, output_dir))
 
     # plot average validator speeds
-    total_speeds = calculate_total_speeds(sent_df, received_df)
+    with stage('aggregate validator speeds', 'aggregate'):
+        validator_speeds_key = stage_key(rollup_key, code_version(total_speeds_from_cube, aggregate_totals,
+                                                                  totals_to_speeds))
+        total_speeds = memoize_frame(experiment_path, 'validator_speeds', validator_speeds_key,
+                                     lambda: total_speeds_from_cube(traffic_rollups))
     print("finished calculating total speeds for validators")
-    plot_speeds(total_speeds, "plots/"+experiment_path+"/")
+    with stage('render validator speeds', 'render'):
+        memoize_render(experiment_path, 'render_validator_speeds',
+                       stage_key(validator_speeds_key, output_dir, code_version(plot_speeds)), output_dir,
+                       lambda: plot_speeds(total_speeds, output_dir))
 
     # plot speed progression per peer to each target peer
-    download_speed_data = calculate_speed_progression_per_peer(received_df, interval='10S')
-    print("finished calculating download speeds")
-    plot_speed_progression_per_peer(download_speed_data, ips_to_regions, "plots/"+experiment_path+"/download_speeds/")
-
-    upload_speed_data = calculate_speed_progression_per_peer(sent_df, interval='10S')
-    print("finished calculating upload speeds")
-    plot_speed_progression_per_peer(upload_speed_data, ips_to_regions, "plots/"+experiment_path+"/upload_speeds/")
+    render_per_peer_code = code_version(*PER_PEER_PLOT_FUNCTIONS, downsample)
+    for direction, name in (('received', 'download'), ('sent', 'upload')):
+        with stage(f'aggregate {name} speeds', 'aggregate') as record:
+            speeds_key = stage_key(rollup_key, direction, interval, code_version(speed_progression_per_peer_from_cube))
+            speed_data = memoize_frame(experiment_path, f'{name}_speeds', speeds_key,
+                                       lambda: speed_progression_per_peer_from_cube(traffic_rollups, direction,
+                                                                                    interval=interval))
+            record['rows'] = len(speed_data)
+        print(f"finished calculating {name} speeds")
+        with stage(f'render {name} speeds', 'render', rows=len(speed_data)):
+            speeds_dir = output_dir + name + "_speeds/"
+            memoize_render(experiment_path, f'render_{name}_speeds',
+                           stage_key(speeds_key, PLOT_WIDTH_POINTS, speeds_dir, render_per_peer_code), speeds_dir,
+                           lambda: plot_speed_progression_per_peer(speed_data, ips_to_regions, speeds_dir,
+                                                                   max_points=PLOT_WIDTH_POINTS))
 
+    write_report(output_dir+"run_report_"+pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')+".json")
     print("done")
 
 # this plots the progression of speed for each peer to its target peers
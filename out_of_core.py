@@ -0,0 +1,143 @@
+import os
+import tempfile
+from multiprocessing import cpu_count
+
+import pandas as pd
+
+from address_book import build_address_book
+from instrumentation import add_worker_records, stage, worker_stage
+from parse_jsonl import CHUNK_PROCESSORS, category_dtypes, columns_to_frame, list_trace_files, list_validator_dirs, \
+    worker_pool
+from rollups import ROLLUP_LEVELS, StoredPyramid, build_rollup_pyramid, rollup_cube, rollup_paths, \
+    store_rollup_partitions, store_rollup_pyramid
+from timed_bytes_decoder import iter_timed_bytes
+from trace_cache import CATEGORICAL_COLUMNS, RESOLVED_COLUMNS, sources_digest
+from traffic_cube import ADDRESS_CUBE_KEYS, CUBE_BUCKET, DIRECTIONS, build_traffic_cube
+
+DEFAULT_MEMORY_BUDGET_MB = 2048
+
+# Peak memory of decoding, typing and bucketing a chunk, per byte of trace
+# lines in the chunk. Measured around 3 on the tracer's output, with headroom
+MEMORY_PER_TRACE_BYTE = 5
+
+# Memory of an idle worker (interpreter, numpy, pandas) and smallest chunk worth reading
+WORKER_BASE_MB = 100
+MIN_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def plan_workers(memory_budget_mb, num_files):
+    # Number of workers and chunk size such that all workers parsing at once
+    # stay within the budget. Besides its chunk, a worker holds the cube
+    # partition of its file, one validator and direction at the finest level
+    per_worker_mb = WORKER_BASE_MB + MIN_CHUNK_BYTES * MEMORY_PER_TRACE_BYTE / 2**20
+    workers = max(1, min(max(cpu_count() - 1, 1), num_files, int(memory_budget_mb // per_worker_mb)))
+    chunk_bytes = (memory_budget_mb / workers - WORKER_BASE_MB) * 2**20 / MEMORY_PER_TRACE_BYTE
+    return workers, max(int(chunk_bytes), MIN_CHUNK_BYTES)
+
+
+def fold_trace_file(task):
+    # Pool worker: folds one trace file into its traffic cube partition one
+    # chunk of at most chunk_bytes at a time, rolls the partition up to every
+    # level and spills each level to disk. Chunks only overlap in the second
+    # their boundary falls into, which the re-bucketing merges. The partition
+    # is keyed by peer address, the parent resolves the addresses of all the
+    # partitions with one address book.
+    # Returns {level: spill file} (None if the file had no samples), the
+    # categories of the partition and the worker record
+    source_file, validator, direction, ips_to_regions, chunk_bytes, spill_dir, levels = task
+    with worker_stage(f"fold {direction} {validator}", 'parse') as record:
+        parts = []
+        offset = 0
+        rows = 0
+        for columns, offset in iter_timed_bytes(source_file, 0, chunk_bytes):
+            if len(columns['msg.time']) == 0:
+                continue
+            df = CHUNK_PROCESSORS[direction](columns_to_frame(columns, validator, ips_to_regions), ips_to_regions)
+            rows += len(df)
+            parts.append(build_traffic_cube(df if direction == 'sent' else None,
+                                            df if direction == 'received' else None, keys=ADDRESS_CUBE_KEYS))
+            del columns, df
+
+        spill_files = None
+        categories = {}
+        if parts:
+            cube = rollup_cube(pd.concat(parts, ignore_index=True), CUBE_BUCKET, ADDRESS_CUBE_KEYS)
+            del parts
+            categories = {column: list(dtype.categories) for column, dtype in category_dtypes([cube]).items()}
+            spill_files = {}
+            for level, level_cube in build_rollup_pyramid(cube, levels, ADDRESS_CUBE_KEYS).items():
+                spill_files[level] = os.path.join(spill_dir, f"{validator}_{direction}_{level}.parquet")
+                level_cube.to_parquet(spill_files[level], index=False)
+        record['rows'] = rows
+        record['bytes_read'] = offset
+    return spill_files, categories, record
+
+
+def store_empty_pyramid(experiment_path, ips_to_regions, digest, levels):
+    pyramid = build_rollup_pyramid(build_traffic_cube(None, None), levels)
+    store_rollup_pyramid(experiment_path, ips_to_regions, pyramid, digest)
+    return pyramid
+
+
+def budget_pool_size(memory_budget_mb, processes=None):
+    # Size of a long-lived pool whose workers may all fold a file at once
+    # within the budget, at most processes
+    workers, _ = plan_workers(memory_budget_mb, cpu_count())
+    return min(workers, processes) if processes else workers
+
+
+def build_pyramid_out_of_core(experiment_path, ips_to_regions, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                              validators=None, levels=ROLLUP_LEVELS, pool=None):
+    # Builds and stores the rollup pyramid of the experiment without ever
+    # holding the raw samples or the whole cube: every trace file is folded
+    # into its own partition of every level within the memory budget, then
+    # each stored level is written one partition at a time. The keys of the
+    # partitions never overlap. Peak memory is set by the budget and by the
+    # largest partition, i.e. one validator and direction at the finest
+    # level. Returns the stored pyramid, keyed by the sources_digest.
+    # pool is a long-lived worker pool to fold the files on instead of a new
+    # one, it must be at most budget_pool_size(memory_budget_mb) workers and
+    # only one build may use it at a time
+    trace_files = list_trace_files(experiment_path, list_validator_dirs(experiment_path, validators))
+    digest = sources_digest([source_file for _, _, source_file in trace_files], ips_to_regions)
+    if not trace_files:
+        return store_empty_pyramid(experiment_path, ips_to_regions, digest, levels)
+
+    with tempfile.TemporaryDirectory() as spill_dir:
+        with stage('fold traces', 'parse') as record:
+            workers, chunk_bytes = plan_workers(memory_budget_mb, len(trace_files))
+            print(f"folding {len(trace_files)} files with {workers} workers in chunks of {chunk_bytes / 2**20:.0f}MB")
+            tasks = [(source_file, validator, direction, ips_to_regions, chunk_bytes, spill_dir, levels)
+                     for validator, direction, source_file in trace_files]
+            # A shared pool runs at most as many folds at once as planned, it
+            # is no larger than the budget allows and there are no more tasks
+            with worker_pool(pool, workers) as folders:
+                results = folders.map(fold_trace_file, tasks)
+            worker_records = [worker_record for _, _, worker_record in results]
+            add_worker_records(worker_records)
+            record['rows'] = sum(worker_record['rows'] for worker_record in worker_records)
+            record['bytes_read'] = sum(worker_record['bytes_read'] for worker_record in worker_records)
+
+        # One dictionary per categorical column for the whole experiment,
+        # and one address book built from its distinct peer addresses
+        categories = {column: set() for column in CATEGORICAL_COLUMNS}
+        for _, partition_categories, _ in results:
+            for column, values in partition_categories.items():
+                categories[column].update(values)
+        dtypes = {column: pd.CategoricalDtype(sorted(values)) for column, values in categories.items()
+                  if column not in RESOLVED_COLUMNS}
+        dtypes['direction'] = DIRECTIONS
+        book = build_address_book(dtypes['msg.ip_address'].categories, ips_to_regions)
+
+        # Partitions in canonical (direction, validator) order, so the levels are written in order
+        partitions = [(spill_files, direction, validator)
+                      for (spill_files, _, _), (_, validator, direction, *_) in zip(results, tasks)
+                      if spill_files is not None]
+        partitions.sort(key=lambda partition: (DIRECTIONS.categories.get_loc(partition[1]),
+                                               dtypes['validator'].categories.get_loc(partition[2])))
+        if not partitions:
+            return store_empty_pyramid(experiment_path, ips_to_regions, digest, levels)
+        with stage('store rollups', 'io'):
+            store_rollup_partitions(experiment_path, [spill_files for spill_files, _, _ in partitions],
+                                    dtypes, book, digest, levels)
+    return StoredPyramid(rollup_paths(experiment_path)[0], levels, digest)
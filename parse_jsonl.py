@@ -1,152 +1,458 @@
 import json
 import os
+import re
 from datetime import datetime
+import numpy as np
 import pandas as pd
+import tempfile
+from contextlib import nullcontext
 from multiprocessing import Pool, cpu_count
-from functools import partial
 
-def process_chunk(chunk):
-    return pd.json_normalize(chunk)
+from address_book import build_address_book, lookup_addresses
+from compressed_io import find_trace_file, has_random_access, open_trace, skip_to
+from instrumentation import add_worker_records, stage, worker_stage
+from layout import load_offsets, offset_positions, sort_canonical
+from rfc3339 import rfc3339_to_datetime
+from timed_bytes_decoder import decode_timed_bytes, read_timed_bytes
+from trace_cache import CACHED_COLUMNS, CATEGORICAL_COLUMNS, TIMED_BYTES_COLUMNS, cache_paths, cache_status, \
+    load_cached_frame, read_cache_meta, source_fingerprint, store_cached_frame
+
+# Fields of the timed bytes schema that the pipeline uses
+SOURCE_COLUMNS = ['msg.time', 'msg.bytes', 'msg.peer_id', 'msg.ip_address']
+
+TRACE_FILES = {
+    'received': 'timed_received_bytes.jsonl',
+    'sent': 'timed_sent_bytes.jsonl',
+}
+
+# Trace lines are written by concurrent goroutines and are only roughly in time
+# order, a windowed read stops once it is this far past the end of the window
+ORDER_SLACK = pd.Timedelta(seconds=1)
 
 def read_jsonl_file(file_path):
-    data = []
     print(file_path)
-    count = 0
-    with open(file_path, 'r') as f:
+    data, _ = read_jsonl_tail(file_path)
+    return data
+
+def read_jsonl_tail(file_path, offset=0, max_lines=None):
+    # Parses the complete lines from byte offset onwards and returns them along
+    # with the offset to resume from. A partially written last line is not
+    # consumed, so the next refresh re-reads it once the writer has finished it
+    data = []
+    with open_trace(file_path) as f:
+        skip_to(f, offset)
         for line in f:
-            if count == 300000:
-                return data
+            if max_lines is not None and len(data) >= max_lines:
+                break
+            if not line.endswith(b'\n'):
+                # The file may simply not end with a newline, keep the line if it is complete
+                try:
+                    data.append(json.loads(line))
+                    offset += len(line)
+                except json.JSONDecodeError:
+                    pass
+                break
+            offset += len(line)
             try:
-                json_line = json.loads(line)
-                data.append(json_line)
-                count += 1
+                data.append(json.loads(line))
             except json.JSONDecodeError:
                 continue
-    return data
+    return data, offset
 
-def process_validator_data(validator, experiment_path, ips_to_regions):
-    validator_data = {
-        'received_data': [],
-        'sent_data': [],
-    }
-    validator_path = os.path.join(experiment_path, validator)
-
-    # Process timed_received_bytes.jsonl
-    received_file = os.path.join(validator_path, 'timed_received_bytes.jsonl')
-    if os.path.exists(received_file):
-        received = read_jsonl_file(received_file)
-        for item in received:
-            item['validator'] = validator
-            item['region'] = ips_to_regions.get(validator, 'Unknown')
-        validator_data['received_data'].extend(received)
-
-    # Process timed_sent_bytes.jsonl
-    sent_file = os.path.join(validator_path, 'timed_sent_bytes.jsonl')
-    if os.path.exists(sent_file):
-        sent = read_jsonl_file(sent_file)
-        for item in sent:
-            item['validator'] = validator
-            item['region'] = ips_to_regions.get(validator, 'Unknown')
-        validator_data['sent_data'].extend(sent)
-
-    return validator_data
-
-def process_chunk_dataframe(args):
-    chunk, func_name, ips_to_regions = args
-    if func_name == 'process_received_chunk':
-        return process_received_chunk(chunk, ips_to_regions)
-    elif func_name == 'process_sent_chunk':
-        return process_sent_chunk(chunk, ips_to_regions)
-    else:
-        raise ValueError(f"Unknown function name: {func_name}")
+def time_key(value):
+    # Turns an RFC3339 timestamp into a string that sorts chronologically.
+    # Go trims trailing zeros of the fraction, so the fraction is padded to
+    # nanoseconds. Only UTC ('Z') timestamps are compared as raw strings
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, str) and value.endswith('Z') and value[10:11] == 'T':
+        fraction = value[20:-1] if value[19:20] == '.' else ''
+        return value[:19] + fraction.ljust(9, '0')
+    ts = pd.Timestamp(value)
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert('UTC').tz_localize(None)
+    return ts.strftime('%Y-%m-%dT%H:%M:%S') + f"{ts.microsecond * 1000 + ts.nanosecond:09d}"
+
+def to_utc(value):
+    ts = pd.Timestamp(value)
+    return ts.tz_localize('UTC') if ts.tzinfo is None else ts.tz_convert('UTC')
+
+# Precompiled '"field"\s*:\s*"' markers, one per field name
+FIELD_MARKERS = {}
 
+def find_field(value, field):
+    # First string value of field anywhere in a decoded entry, in the order
+    # the raw marker search would meet it
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == field and isinstance(item, str):
+                return item
+            found = find_field(item, field)
+            if found is not None:
+                return found
+    elif isinstance(value, list):
+        for item in value:
+            found = find_field(item, field)
+            if found is not None:
+                return found
+    return None
 
-def parallel_process_dataframe(df, func_name, ips_to_regions):
-    num_processes = cpu_count()-1
-    chunk_size = int(len(df) / num_processes) + 1
-    df_chunks = [df.iloc[i:i + chunk_size] for i in range(0, len(df), chunk_size)]
+def extract_field(line, field):
+    # Returns the raw value of a string field without decoding the whole line.
+    # Whitespace around the colon is allowed, a line where the marker is not
+    # found is decoded with json.loads, and None means the field is missing
+    marker = FIELD_MARKERS.get(field)
+    if marker is None:
+        marker = FIELD_MARKERS[field] = re.compile(rb'"' + re.escape(field.encode()) + rb'"\s*:\s*"([^"]*)"')
+    match = marker.search(line)
+    if match is not None:
+        return match.group(1)
+    try:
+        value = find_field(json.loads(line), field)
+    except ValueError:
+        return None
+    return value.encode() if value is not None else None
+
+def project_entry(entry, columns):
+    # Keeps only the requested dotted columns, e.g. 'msg.time', as flat keys
+    projected = {}
+    for column in columns:
+        value = entry
+        for key in column.split('.'):
+            if not isinstance(value, dict) or key not in value:
+                value = None
+                break
+            value = value[key]
+        projected[column] = value
+    return projected
+
+def seek_to_time(f, start_key, time_field):
+    # Binary search over byte offsets for the first line at or after start_key.
+    # Returns the offset of a line boundary, lines before it are all earlier
+    f.seek(0, os.SEEK_END)
+    low, high = 0, f.tell()
+    while low < high:
+        mid = (low + high) // 2
+        f.seek(mid)
+        if mid > 0:
+            # Skip the line we landed in the middle of
+            f.readline()
+        # Lines without the time field are skipped up to one that has it
+        value = None
+        while value is None:
+            line_start = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            value = extract_field(line, time_field)
+        if value is None:
+            high = mid
+            continue
+        if time_key(value) < start_key:
+            low = line_start + len(line)
+        else:
+            high = mid
+    return low
+
+def read_jsonl_window(file_path, start=None, end=None, time_field='time', peer_ids=None, columns=None, raw=False):
+    return list(iter_jsonl_window(file_path, start, end, time_field, peer_ids, columns, raw))
+
+def iter_jsonl_window(file_path, start=None, end=None, time_field='time', peer_ids=None, columns=None, raw=False):
+    # Yields only the lines whose time_field is in [start, end) and whose
+    # peer_id is in peer_ids. Filters are checked on the raw line before
+    # json.loads, the file is bisected to start and the scan stops once it has
+    # passed end. columns projects the decoded entries to flat dotted keys,
+    # raw=True returns the matching lines undecoded
+    start_key = time_key(to_utc(start) - ORDER_SLACK) if start is not None else None
+    first_key = time_key(to_utc(start)) if start is not None else None
+    end_key = time_key(to_utc(end)) if end is not None else None
+    stop_key = time_key(to_utc(end) + ORDER_SLACK) if end is not None else None
+    peers = {peer.encode() for peer in peer_ids} if peer_ids is not None else None
+
+    with open_trace(file_path) as f:
+        # Archives without a seek table are scanned from the start
+        if start_key is not None and has_random_access(file_path):
+            f.seek(seek_to_time(f, start_key, time_field))
+        for line in f:
+            if start_key is not None or end_key is not None:
+                value = extract_field(line, time_field)
+                if value is None:
+                    continue
+                key = time_key(value)
+                if stop_key is not None and key >= stop_key:
+                    break
+                if (first_key is not None and key < first_key) or (end_key is not None and key >= end_key):
+                    continue
+            if peers is not None and extract_field(line, 'peer_id') not in peers:
+                continue
+            if raw:
+                yield line if line.endswith(b'\n') else line + b'\n'
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            yield project_entry(entry, columns) if columns is not None else entry
 
-    # Prepare arguments
-    args_list = [(chunk, func_name, ips_to_regions) for chunk in df_chunks]
+def to_categorical(values):
+    # Dictionary-encodes a bytes column, only the distinct values are decoded
+    uniques, codes = np.unique(values, return_inverse=True)
+    return pd.Categorical.from_codes(codes.reshape(-1), uniques.astype(str))
 
-    with Pool(processes=num_processes) as pool:
-        result = pool.map(process_chunk_dataframe, args_list)
+def constant_categorical(value, length):
+    return pd.Categorical.from_codes(np.zeros(length, dtype=np.int8), [value])
 
-    # Concatenate the processed chunks
-    processed_df = pd.concat(result, ignore_index=True)
-    return processed_df
+def columns_to_frame(columns, validator, ips_to_regions):
+    # Turns the decoder's column arrays into a frame tagged with the validator.
+    # msg.time stays raw bytes, which is what parse_rfc3339_ns reads fastest,
+    # the other string columns become categoricals
+    df = pd.DataFrame({
+        name: to_categorical(values) if values.dtype.kind == 'S' and name != 'msg.time' else values
+        for name, values in columns.items()
+    })
+    df['validator'] = constant_categorical(validator, len(df))
+    df['region'] = constant_categorical(ips_to_regions.get(validator, 'Unknown'), len(df))
+    return df
+
+def category_dtypes(frames):
+    # One dictionary per categorical column covering all the given frames
+    dtypes = {}
+    for column in CATEGORICAL_COLUMNS:
+        categories = set()
+        for frame in frames:
+            if column in frame.columns:
+                categories.update(frame[column].astype('category').cat.categories)
+        dtypes[column] = pd.CategoricalDtype(sorted(categories))
+    return dtypes
+
+def unify_categories(frames, dtypes=None):
+    # Gives every categorical column the same dictionary in all frames, so that
+    # codes mean the same thing across validators and, when dtypes come from
+    # category_dtypes over both, across the sent and received frames
+    frames = [frame for frame in frames if not frame.empty]
+    if dtypes is None:
+        dtypes = category_dtypes(frames)
+    return [frame.astype({column: dtype for column, dtype in dtypes.items() if column in frame.columns})
+            for frame in frames]
+
+def filter_frame(df, start=None, end=None, peer_ids=None, offsets=None):
+    # Applies the read_jsonl_window filters to an already typed frame. With
+    # the pair offsets of a canonical frame the peers are read as slices
+    if peer_ids is not None and offsets is not None:
+        df = df.iloc[offset_positions(offsets[offsets['msg.peer_id'].isin(peer_ids)])]
+        peer_ids = None
+    mask = pd.Series(True, index=df.index)
+    if start is not None:
+        mask &= df['msg.time'] >= to_utc(start)
+    if end is not None:
+        mask &= df['msg.time'] < to_utc(end)
+    if peer_ids is not None:
+        mask &= df['msg.peer_id'].isin(peer_ids)
+    return df[mask]
+
+def refresh_trace_file(source_file, validator, direction, ips_to_regions):
+    # Appends the lines written since the cache checkpoint to the cached frame.
+    # Returns None, leaving the cache as is, if the cached frame cannot be read
+    meta = read_cache_meta(source_file)
+    fingerprint = source_fingerprint(source_file)
+    cached = load_cached_frame(source_file)
+    if cached is None:
+        return None
+
+    columns, offset = read_timed_bytes(source_file, meta['offset'])
+    new_df = columns_to_frame(columns, validator, ips_to_regions)
+    print(f"{source_file}: {len(new_df)} new lines")
+    if not new_df.empty:
+        new_df = CHUNK_PROCESSORS[direction](new_df, ips_to_regions)
+        cached = concat_frames([cached, new_df])
+
+    store_cached_frame(source_file, cached, ips_to_regions, fingerprint, offset)
+    return cached
 
 def process_received_chunk(chunk, ips_to_regions):
-    chunk['msg.time'] = pd.to_datetime(chunk['msg.time'])
-    chunk['target_ip'] = chunk['msg.ip_address'].str.split(':').str[0]
-    chunk['target_region'] = chunk['target_ip'].map(ips_to_regions)
+    # Target IPs and regions are resolved once for the whole experiment, see resolve_targets
+    chunk['msg.time'] = rfc3339_to_datetime(chunk['msg.time'].to_numpy())
     return chunk
 
 
 def process_sent_chunk(chunk, ips_to_regions):
-    chunk['msg.time'] = pd.to_datetime(chunk['msg.time'])
-    chunk['target_ip'] = chunk['msg.ip_address'].str.split(':').str[0]
-    chunk['target_region'] = chunk['target_ip'].map(ips_to_regions)
+    chunk['msg.time'] = rfc3339_to_datetime(chunk['msg.time'].to_numpy())
     return chunk
 
-def process_experiment_data(experiment_path, ips_to_regions):
-    # Initialize empty lists to hold data
-    received_data = []
-    sent_data = []
 
-    # Iterate over each validator folder
-    validator_dirs = [
+def resolve_targets(df, book):
+    # Adds the target IP and region of every row from the experiment's address book
+    return df.assign(**lookup_addresses(book, df['msg.ip_address']))[TIMED_BYTES_COLUMNS]
+
+CHUNK_PROCESSORS = {
+    'received': process_received_chunk,
+    'sent': process_sent_chunk,
+}
+
+def ingest_trace_file(task):
+    # Worker stage for one trace file: decode and convert timestamps in one
+    # go. The typed frame is written in Arrow format,
+    # to the cache (mode 'cache' and 'refresh') or to a spill file (mode
+    # 'spill'), and only its path is sent back so no rows are pickled. The
+    # worker's instrumentation record is sent back with it
+    source_file, validator, direction, ips_to_regions, mode, window, spill_dir = task
+    with worker_stage(f"parse {direction} {validator}", 'parse') as record:
+        if mode == 'refresh':
+            meta = read_cache_meta(source_file)
+            if refresh_trace_file(source_file, validator, direction, ips_to_regions) is None:
+                # A truncated or corrupt cache is rebuilt from the whole file,
+                # a windowed read only parses it
+                print(f"{source_file}: cache unreadable, parsing the whole file")
+                mode = 'cache' if window is None else 'spill'
+            else:
+                new_meta = read_cache_meta(source_file)
+                record['rows'] = new_meta['rows'] - meta['rows']
+                record['bytes_read'] = new_meta['offset'] - meta['offset']
+                result = cache_paths(source_file)[0], 'cache'
+        if mode != 'refresh':
+            result = parse_trace_file(source_file, validator, direction, ips_to_regions, mode, window, spill_dir,
+                                      record)
+    return result, record
+
+def parse_trace_file(source_file, validator, direction, ips_to_regions, mode, window, spill_dir, record):
+    print(source_file)
+    # Fingerprint the source before reading it so that a file growing meanwhile stays stale
+    fingerprint = source_fingerprint(source_file)
+    if window is not None:
+        buffer = b''.join(read_jsonl_window(source_file, raw=True, **window))
+        columns = decode_timed_bytes(buffer)
+        offset = None
+        record['bytes_read'] = len(buffer)
+    else:
+        columns, offset = read_timed_bytes(source_file)
+        record['bytes_read'] = offset
+    df = columns_to_frame(columns, validator, ips_to_regions)
+    # Sorted by peer and time, the files of the experiment concatenate into canonical order
+    df = sort_canonical(CHUNK_PROCESSORS[direction](df, ips_to_regions)[CACHED_COLUMNS])
+    record['rows'] = len(df)
+
+    if mode == 'cache':
+        store_cached_frame(source_file, df, ips_to_regions, fingerprint, offset)
+        return cache_paths(source_file)[0], 'cache'
+    spill_file = os.path.join(spill_dir, f"{validator}_{direction}.arrow")
+    df.reset_index(drop=True).to_feather(spill_file)
+    return spill_file, 'spill'
+
+def list_validator_dirs(experiment_path, validators=None):
+    # Every validator has its own folder, hidden folders hold experiment-wide caches
+    return [
         d for d in os.listdir(experiment_path)
         if os.path.isdir(os.path.join(experiment_path, d))
+        and not d.startswith('.')
+        and (validators is None or d in validators)
     ]
 
-    # Use multiprocessing Pool to parallelize processing of validator data
-    with Pool(processes=cpu_count()-1) as pool:
-        # Prepare arguments for the pool
-        func = partial(process_validator_data, experiment_path=experiment_path, ips_to_regions=ips_to_regions)
-        results = pool.map(func, validator_dirs)
-
-    print("aggregating results")
-    # Aggregate results from all processes
-    for validator_data in results:
-        received_data.extend(validator_data['received_data'])
-        sent_data.extend(validator_data['sent_data'])
-
-    print("normalizing files...")
-    # Convert to DataFrames
-    received_df = parallel_json_normalize(received_data)
-    print("normalised received_df")
-    sent_df = parallel_json_normalize(sent_data)
-    print("normalised sent_df")
-
-
-    # Process 'received_df'
-    if not received_df.empty:
-        received_df = parallel_process_dataframe(received_df, 'process_received_chunk', ips_to_regions)
-    else:
-        print("No received data found.")
-    print("processed received_df")
+def list_trace_files(experiment_path, validator_dirs=None):
+    # (validator, direction, path) of every timed bytes trace file of the
+    # experiment, archived files are read without decompressing them to disk
+    if validator_dirs is None:
+        validator_dirs = list_validator_dirs(experiment_path)
+    trace_files = []
+    for validator in validator_dirs:
+        for direction, file_name in TRACE_FILES.items():
+            source_file = find_trace_file(os.path.join(experiment_path, validator), file_name)
+            if source_file is not None:
+                trace_files.append((validator, direction, source_file))
+    return trace_files
 
-    # Process 'sent_df'
-    if not sent_df.empty:
-        sent_df = parallel_process_dataframe(sent_df, 'process_sent_chunk', ips_to_regions)
-    else:
-        print("No sent data found.")
-    print("processed sent_df")
+def load_ingested_frames(results, window=None):
+    # Reads back the Arrow files written by ingest_trace_file, cached frames
+    # hold the whole file and still need the window applied
+    frames = []
+    for path, kind in results:
+        if kind == 'cache':
+            df = pd.read_parquet(path)
+            if window is not None:
+                df = filter_frame(df, offsets=load_offsets(path, len(df)), **window)
+        else:
+            df = pd.read_feather(path)
+        frames.append(df)
+    return frames
 
-    return received_df, sent_df
+def worker_pool(pool, num_tasks):
+    # The given long-lived pool, left open, or a new pool for num_tasks
+    if pool is not None:
+        return nullcontext(pool)
+    return Pool(processes=min(max(cpu_count() - 1, 1), num_tasks))
+
+def process_experiment_data(experiment_path, ips_to_regions, use_cache=True, incremental=False,
+                            start=None, end=None, validators=None, peer_ids=None, pool=None):
+    # With incremental=True, trace files that only grew since they were cached
+    # are refreshed by parsing just the appended bytes. start/end bound
+    # msg.time, validators and peer_ids restrict the validator directories and
+    # target peers. Windowed reads are served from valid caches when possible,
+    # otherwise they are pushed down into the reader and not cached. pool is
+    # a long-lived worker pool to run the files on instead of a new one
+    window = None
+    if start is not None or end is not None or peer_ids is not None:
+        window = {'start': start, 'end': end, 'peer_ids': peer_ids}
 
-def parallel_json_normalize(data_list):
-    # Determine the number of processes to use
-    num_processes = cpu_count()-1
+    with stage('ingest', 'parse') as record:
+        validator_dirs = list_validator_dirs(experiment_path, validators)
 
-    # Split the data into chunks
-    chunk_size = int(len(data_list) / num_processes) + 1
-    data_chunks = [data_list[i:i + chunk_size] for i in range(0, len(data_list), chunk_size)]
+        with tempfile.TemporaryDirectory() as spill_dir:
+            # Valid caches are read directly, every other trace file is one worker task
+            results = {'received': [], 'sent': []}
+            tasks = []
+            worker_records = []
+            cached_bytes = 0
+            for validator, direction, source_file in list_trace_files(experiment_path, validator_dirs):
+                status = cache_status(source_file, ips_to_regions) if use_cache else 'stale'
+                if status == 'valid':
+                    results[direction].append((cache_paths(source_file)[0], 'cache'))
+                    cached_bytes += os.path.getsize(cache_paths(source_file)[0])
+                    continue
+                if status == 'appendable' and incremental:
+                    mode = 'refresh'
+                elif use_cache and window is None:
+                    mode = 'cache'
+                else:
+                    mode = 'spill'
+                tasks.append((source_file, validator, direction, ips_to_regions, mode, window, spill_dir))
+            print(f"loaded {len(results['received']) + len(results['sent'])} cached files, processing {len(tasks)} files")
+
+            if tasks:
+                with worker_pool(pool, len(tasks)) as workers:
+                    for task, (result, worker_record) in zip(tasks, workers.map(ingest_trace_file, tasks)):
+                        results[task[2]].append(result)
+                        worker_records.append(worker_record)
+                add_worker_records(worker_records)
+
+            received_frames = load_ingested_frames(results['received'], window)
+            sent_frames = load_ingested_frames(results['sent'], window)
+
+        # One dictionary per categorical column for the whole experiment, and
+        # one address book built from its distinct peer addresses
+        dtypes = category_dtypes(received_frames + sent_frames)
+        book = build_address_book(dtypes['msg.ip_address'].categories, ips_to_regions)
+        received_df = resolve_targets(concat_frames(received_frames, dtypes), book)
+        print("processed received_df")
+        sent_df = resolve_targets(concat_frames(sent_frames, dtypes), book)
+        print("processed sent_df")
+        record['rows'] = len(received_df) + len(sent_df)
+        # Trace bytes parsed by the workers plus the cache files read as they are
+        record['bytes_read'] = cached_bytes + sum(worker_record['bytes_read'] or 0 for worker_record in worker_records)
+
+    return received_df, sent_df
 
-    with Pool(processes=num_processes) as pool:
-        result = pool.map(process_chunk, data_chunks)
 
-    # Concatenate the results
-    df = pd.concat(result, ignore_index=True)
-    return df
\ No newline at end of file
+def concat_frames(frames, dtypes=None):
+    # Frames in canonical order of one validator each, e.g. the trace files
+    # of an experiment, are concatenated in validator order, so the result is
+    # in canonical order without sorting or checking it again. Other frames,
+    # e.g. a cached frame and the lines appended since, are sorted
+    frames = unify_categories(frames, dtypes)
+    if not frames:
+        return pd.DataFrame(columns=CACHED_COLUMNS)
+    spans = [(frame['validator'].cat.codes.min(), frame['validator'].cat.codes.max()) for frame in frames]
+    order = sorted(range(len(frames)), key=lambda i: spans[i])
+    df = pd.concat([frames[i] for i in order], ignore_index=True)
+    # Each frame one validator and no validator in two frames
+    if any(low != high for low, high in spans) or len({low for low, _ in spans}) < len(spans):
+        df = sort_canonical(df)
+    return df[[column for column in TIMED_BYTES_COLUMNS if column in df.columns]]
@@ -1,17 +1,22 @@
 import json
 import os
-from datetime import datetime
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import re
 
+from compressed_io import find_trace_file, open_trace
+from instrumentation import add_worker_records, worker_stage
+from latency_sketch import LatencySketch, merge_sketches
+from parse_jsonl import extract_field, iter_jsonl_window, list_validator_dirs, read_jsonl_window, worker_pool
 from parse_validators_regions import parse_ip_to_region
+from rfc3339 import parse_rfc3339_ns, valid_ns
 
 
 def read_jsonl_file(file_path):
     data = []
-    with open(file_path, 'r') as f:
+    with open_trace(file_path) as f:
         for line in f:
             line = line.strip()
             if not line:
@@ -25,89 +30,190 @@ def read_jsonl_file(file_path):
     return data
 
 
-def parse_time(timestr):
-    timestr = timestr.replace('Z', '+00:00')
+def latency_ms(send_times, receive_times):
+    # Latency in ms from integer nanosecond timestamps, keeping full precision.
+    # NaN where either timestamp does not parse
+    send_ns = parse_rfc3339_ns(send_times)
+    receive_ns = parse_rfc3339_ns(receive_times)
+    return np.where(valid_ns(send_ns, receive_ns), (receive_ns - send_ns) / 1_000_000, np.nan)
 
-    # Example input: "2024-12-09T20:03:09.030144354+00:00"
-    # We'll truncate the fraction before using strptime.
 
-    if '.' in timestr:
-        main_part, frac_tz = timestr.split('.')
-        # main_part: "2024-12-09T20:03:09"
-        # frac_tz: "030144354+00:00"
+LATENCY_COLUMNS = ['node_id', 'msg.peer_id', 'msg.ip_address', 'msg.send_time', 'msg.receive_time']
 
-        # Separate fraction from timezone
-        sign_index = frac_tz.find('+')
-        if sign_index == -1:
-            sign_index = frac_tz.find('-')
+def process_msg_latency_file(file_path, ip_to_region, start=None, end=None, peer_ids=None):
+    # Reads a msg_latency.jsonl file and returns a DataFrame with:
+    # columns: validator, ip_address (peer), region, latency_ms
+    # start/end bound send_time and are applied while scanning the file
+    if not os.path.exists(file_path):
+        return pd.DataFrame()
 
-        if sign_index != -1:
-            fraction = frac_tz[:sign_index]
-            tz = frac_tz[sign_index:]
-        else:
-            fraction = frac_tz
-            tz = ''
+    entries = read_jsonl_window(file_path, start=start, end=end, time_field='send_time',
+                                peer_ids=peer_ids, columns=LATENCY_COLUMNS)
+    df = pd.DataFrame(entries, columns=LATENCY_COLUMNS)
+    # Drop entries with any of the fields missing or empty
+    df = df[df.notna().all(axis=1) & (df != '').all(axis=1)]
 
-        fraction = fraction[:6]  # Truncate to microseconds
-        new_timestr = f"{main_part}.{fraction}{tz}"
-    else:
-        new_timestr = timestr
+    latency = latency_ms(df['msg.send_time'].to_numpy(), df['msg.receive_time'].to_numpy())
 
-    # Now we know the format is something like: "%Y-%m-%dT%H:%M:%S.%f%z"
-    return datetime.strptime(new_timestr, "%Y-%m-%dT%H:%M:%S.%f%z")
+    return pd.DataFrame({
+        'validator': df['node_id'].to_numpy(),
+        'ip_address': df['msg.ip_address'].to_numpy(),
+        'region': df['msg.ip_address'].map(ip_to_region).fillna('Unknown').to_numpy(),
+        'latency_ms': latency,
+    })
 
-def process_msg_latency_file(file_path, ip_to_region):
-    # Reads a msg_latency.jsonl file and returns a DataFrame with:
-    # columns: validator, peer_id, ip_address (peer), region, latency_ms
-    data = []
+# Lines decoded at once by the streaming reader, memory does not depend on the file size
+SKETCH_BATCH_LINES = 100_000
+
+LATENCY_FIELDS = ['node_id', 'ip_address', 'send_time', 'receive_time']
+
+def add_latency_batch(sketches, lines, relative_accuracy, validator=None):
+    # Adds the latencies of a batch of raw msg_latency lines to the
+    # (validator, peer ip) sketches, lines missing a field are skipped.
+    # validator, e.g. the directory of the file, keys the sketches instead of
+    # the node_id of each line
+    fields = LATENCY_FIELDS if validator is None else LATENCY_FIELDS[1:]
+    rows = [tuple(extract_field(line, field) for field in fields) for line in lines]
+    rows = [row for row in rows if all(row)]
+    if not rows:
+        return
+    columns = [np.array(values) for values in zip(*rows)]
+    if validator is not None:
+        columns.insert(0, np.full(len(rows), validator.encode()))
+    validators, ips, send_times, receive_times = columns
+    # Unparseable timestamps give NaN, which the sketches drop
+    latency = latency_ms(send_times, receive_times)
+
+    batch = pd.DataFrame({'validator': validators, 'ip_address': ips, 'latency_ms': latency})
+    for (line_validator, ip), values in batch.groupby(['validator', 'ip_address'], sort=False)['latency_ms']:
+        key = (line_validator.decode(), ip.decode())
+        if key not in sketches:
+            sketches[key] = LatencySketch(relative_accuracy)
+        sketches[key].add(values.to_numpy())
+
+def stream_msg_latency_sketches(file_path, start=None, end=None, peer_ids=None,
+                                relative_accuracy=0.01, batch_lines=SKETCH_BATCH_LINES, validator=None):
+    # Reads a whole msg_latency.jsonl file in constant memory and returns
+    # {(validator, peer ip): LatencySketch}. start/end bound send_time,
+    # validator replaces the node_id of the lines in the keys
+    sketches = {}
     if not os.path.exists(file_path):
-        return pd.DataFrame()
+        return sketches
 
-    start = 10000
-    end = 30000
-    with open(file_path, 'r') as f:
-        count = 0
-        for line in f:
-            count = count +1
-            if count < start :
-                continue
-            if count > end:
-                break
+    batch = []
+    for line in iter_jsonl_window(file_path, start=start, end=end, time_field='send_time',
+                                  peer_ids=peer_ids, raw=True):
+        batch.append(line)
+        if len(batch) >= batch_lines:
+            add_latency_batch(sketches, batch, relative_accuracy, validator)
+            batch = []
+    add_latency_batch(sketches, batch, relative_accuracy, validator)
+    return sketches
 
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                entry = json.loads(line)
-            except json.JSONDecodeError:
-                continue
+def sketch_summary(sketches, key_columns):
+    # One row per sketch with the key columns, count, mean, p50/p90/p99 and max
+    rows = []
+    for key, sketch in sketches.items():
+        key = key if isinstance(key, tuple) else (key,)
+        rows.append({**dict(zip(key_columns, key)), **sketch.summary()})
+    return pd.DataFrame(rows)
 
+def pair_latency_summary(sketches, ip_to_region):
+    summary = sketch_summary(sketches, ['validator', 'ip_address'])
+    if not summary.empty:
+        summary.insert(2, 'region', summary['ip_address'].map(ip_to_region).fillna('Unknown'))
+    return summary
 
-            msg = entry.get('msg', {})
-            validator = entry.get('node_id')
-            ip_address = msg.get('ip_address')
-            send_time_str = msg.get('send_time')
-            receive_time_str = msg.get('receive_time')
-            peer_id = msg.get('peer_id')
+def region_latency_summary(sketches, ip_to_region):
+    # Merges the pair sketches into source region -> destination region distributions
+    def region_pair(key):
+        validator, ip = key
+        return ip_to_region.get(validator, 'Unknown'), ip_to_region.get(ip, 'Unknown')
+    return sketch_summary(merge_sketches(sketches, region_pair), ['source_region', 'target_region'])
 
-            if not (validator and ip_address and send_time_str and receive_time_str and peer_id):
-                continue
+def network_latency_summary(sketches):
+    return sketch_summary(merge_sketches(sketches, lambda key: 'all'), ['network'])
+
+# Statistics stacked in the latency matrix file, in this order
+MATRIX_STATISTICS = ['count', 'mean', 'p50', 'p90', 'p99', 'max']
 
-            send_time = parse_time(send_time_str)
-            receive_time = parse_time(receive_time_str)
-            latency = (receive_time - send_time).total_seconds() * 1000.0  # latency in ms
+def sketch_latency_file(file_path):
+    # Pool worker, sketches are small so they are cheap to send back along
+    # with the worker's instrumentation record. Rows are keyed by the
+    # validator directory, the IP the matrix columns and regions use
+    validator = os.path.basename(os.path.dirname(file_path))
+    with worker_stage(f"sketch latency {validator}", 'parse', bytes_read=os.path.getsize(file_path)) as record:
+        sketches = stream_msg_latency_sketches(file_path, validator=validator)
+        record['rows'] = sum(sketch.count for sketch in sketches.values())
+    return sketches, record
 
-            region = ip_to_region.get(ip_address, 'Unknown')
+def stream_experiment_sketches(experiment_path, validator_ips, pool=None):
+    # Sketches every validator's msg_latency.jsonl concurrently, one task per
+    # file, and merges them into a single {(validator, peer ip): sketch} dict.
+    # pool is a long-lived worker pool to use instead of a new one
+    files = [find_trace_file(os.path.join(experiment_path, validator_ip), "msg_latency.jsonl")
+             for validator_ip in validator_ips]
+    files = [file_path for file_path in files if file_path is not None]
+    sketches = {}
+    if not files:
+        return sketches
+    with worker_pool(pool, len(files)) as workers:
+        records = []
+        for file_sketches, record in workers.imap_unordered(sketch_latency_file, files):
+            for key, sketch in file_sketches.items():
+                if key in sketches:
+                    sketches[key].merge(sketch)
+                else:
+                    sketches[key] = sketch
+            records.append(record)
+    add_worker_records(records)
+    return sketches
 
-            data.append({
-                'validator': validator,
-                'ip_address': ip_address,
-                'region': region,
-                'latency_ms': latency
-            })
+def sketch_matrix(sketches, labels):
+    # Stacks the MATRIX_STATISTICS of {(row, column): sketch} into an array of
+    # shape (statistics, rows, columns), NaN where a pair has no samples
+    index = {label: i for i, label in enumerate(labels)}
+    matrix = np.full((len(MATRIX_STATISTICS), len(labels), len(labels)), np.nan)
+    for (row, column), sketch in sketches.items():
+        summary = sketch.summary()
+        matrix[:, index[row], index[column]] = [summary[name] for name in MATRIX_STATISTICS]
+    return matrix
 
-    df = pd.DataFrame(data)
-    return df
+def latency_matrices(sketches, ip_to_region):
+    # N x N validator to peer matrix and region x region matrix. Peer addresses
+    # may carry a port, pairs are keyed on the bare IP. Every node, validator
+    # or peer only, gets a row and a column so the matrix stays square
+    pair_sketches = merge_sketches(sketches, lambda key: (key[0], key[1].split(':')[0]))
+    nodes = sorted({node for pair in pair_sketches for node in pair})
+    region_sketches = merge_sketches(pair_sketches, lambda key: tuple(ip_to_region.get(node, 'Unknown') for node in key))
+    regions = sorted({region for pair in region_sketches for region in pair})
+    return {
+        'nodes': np.array(nodes),
+        'node_regions': np.array([ip_to_region.get(node, 'Unknown') for node in nodes]),
+        'regions': np.array(regions),
+        'statistics': np.array(MATRIX_STATISTICS),
+        'node_matrix': sketch_matrix(pair_sketches, nodes),
+        'region_matrix': sketch_matrix(region_sketches, regions),
+    }
+
+def save_latency_matrices(matrices, output_file):
+    np.savez_compressed(output_file, **matrices)
+    print(f"Latency matrices saved at {output_file}")
+
+def plot_latency_heatmap(matrix, labels, title, output_file, statistic='p50'):
+    # Rows are the measuring validators (source regions), columns their peers
+    values = matrix[MATRIX_STATISTICS.index(statistic)]
+    size = max(8, len(labels) * 0.25)
+    plt.figure(figsize=(size + 2, size))
+    sns.heatmap(pd.DataFrame(values, index=labels, columns=labels), cmap='viridis',
+                cbar_kws={'label': f"{statistic} latency (ms)"})
+    plt.title(title)
+    plt.xlabel("Peer")
+    plt.ylabel("Validator")
+    plt.tight_layout()
+    plt.savefig(output_file, bbox_inches='tight')
+    plt.close()
+    print(f"Heatmap saved at {output_file}")
 
 def plot_mean_latency_per_validator(df, validator_ip, ips_to_region, output_dir):
     # Group by peer_id to get mean latency for each peer
@@ -133,6 +239,31 @@ def plot_mean_latency_per_validator(df, validator_ip, ips_to_region, output_dir)
     plt.close()
     print(f"Plot saved for {validator_ip} at {output_file}")
 
+def plot_latency_percentiles_per_validator(summary, validator_ip, ips_to_region, output_dir):
+    # Same as plot_mean_latency_per_validator but from the sketch summary of
+    # one validator, with the mean and p50/p90/p99/max side by side per peer
+    if summary.empty:
+        print(f"No data found for validator {validator_ip}")
+        return
+
+    summary = summary.sort_values('mean')
+    summary = summary.assign(peer_label=summary['ip_address'] + ' (' + summary['region'] + ')')
+    stats_df = summary.melt(id_vars='peer_label', value_vars=['mean', 'p50', 'p90', 'p99', 'max'],
+                            var_name='statistic', value_name='latency_ms')
+
+    plt.figure(figsize=(12, 6))
+    sns.barplot(data=stats_df, x='peer_label', y='latency_ms', hue='statistic', palette='viridis')
+    validator_label = validator_ip + ' (' + ips_to_region.get(validator_ip, 'Unknown') + ')'
+    plt.title(f"Latency Distribution for Validator {validator_label}")
+    plt.xlabel("Peer (Region)")
+    plt.ylabel("Latency (ms)")
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    output_file = os.path.join(output_dir, f"latency_percentiles_{validator_ip}.png")
+    plt.savefig(output_file, bbox_inches='tight')
+    plt.close()
+    print(f"Plot saved for {validator_ip} at {output_file}")
+
 if __name__ == "__main__":
     # Set your root experiment directory and regions file
     experiment_name = "traces_tm_latency"
@@ -146,13 +277,22 @@ if __name__ == "__main__":
 
     # Iterate over each IP directory in the experiment
     # Each IP directory has a msg_latency.jsonl file
-    validator_ips = [d for d in os.listdir(experiment_path) if os.path.isdir(os.path.join(experiment_path, d))]
-
-    separate_plots_dir = "plots/" + experiment_name +"/separate"
-    os.makedirs(separate_plots_dir, exist_ok=True)
-    for validator_ip in validator_ips:
-        msg_latency_file = os.path.join(experiment_path, validator_ip, "msg_latency.jsonl")
-        df = process_msg_latency_file(msg_latency_file, ip_to_region)
-        # Produce a bar plot for this validator
-        plot_mean_latency_per_validator(df, validator_ip,ip_to_region, separate_plots_dir)
+    validator_ips = list_validator_dirs(experiment_path)
+
+    # All files are sketched in parallel, one matrix replaces the per-validator charts
+    sketches = stream_experiment_sketches(experiment_path, validator_ips)
+    matrices = latency_matrices(sketches, ip_to_region)
+    save_latency_matrices(matrices, os.path.join(output_dir, "latency_matrix.npz"))
+    node_labels = [f"{node} ({region})" for node, region in zip(matrices['nodes'], matrices['node_regions'])]
+    plot_latency_heatmap(matrices['node_matrix'], node_labels, "Validator to Peer p50 Latency",
+                         os.path.join(output_dir, "latency_matrix_validators.png"))
+    plot_latency_heatmap(matrices['region_matrix'], list(matrices['regions']), "Region to Region p50 Latency",
+                         os.path.join(output_dir, "latency_matrix_regions.png"))
+
+    # The per-validator sketches merge into region and network-wide distributions
+    pair_latency_summary(sketches, ip_to_region).to_csv(os.path.join(output_dir, "latency_per_peer.csv"), index=False)
+    region_summary = region_latency_summary(sketches, ip_to_region)
+    region_summary.to_csv(os.path.join(output_dir, "latency_per_region.csv"), index=False)
+    print(region_summary)
+    print(network_latency_summary(sketches))
 
@@ -0,0 +1,282 @@
+import argparse
+import asyncio
+import json
+import os
+import traceback
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import pandas as pd
+
+from compute_speed import total_regions_speeds_from_cube, total_speeds_from_cube
+from latency_sketch import merge_sketches
+from layout import offset_positions
+from parse_jsonl import list_validator_dirs, to_utc
+from parse_validators_regions import parse_ip_to_region
+from plot_latency import MATRIX_STATISTICS, stream_experiment_sketches
+from rollups import experiment_rollups, level_offsets, resolve_cube, select_level
+from throughput import cumulative_series, window_throughput
+
+# The server only ever listens on the loopback interface
+HOST = '127.0.0.1'
+DEFAULT_PORT = 8750
+
+# Answers kept per distinct query, least recently used ones are dropped first
+QUERY_CACHE_SIZE = 1024
+
+# Columns a speed query can break its result down by
+SPEED_GROUPS = ['validator', 'region', 'msg.peer_id', 'target_ip', 'target_region']
+
+# Keys a latency query can break its result down by
+LATENCY_GROUPS = ['validator', 'peer_ip', 'source_region', 'target_region']
+
+
+def load_experiment(experiment_path, ips_to_regions, pool=None):
+    # Everything the queries need, loaded once: the rollup pyramid with the
+    # pair offsets of every level and the latency sketches
+    pyramid = experiment_rollups(experiment_path, ips_to_regions, pool=pool)
+    sketches = stream_experiment_sketches(experiment_path, list_validator_dirs(experiment_path), pool)
+    return {
+        'path': experiment_path,
+        'pyramid': pyramid,
+        'offsets': {level: level_offsets(pyramid, level) for level in pyramid},
+        'sketches': sketches,
+        'ips_to_regions': ips_to_regions,
+    }
+
+
+def pair_rows(experiment, level, direction, validator=None, peer=None):
+    # Rows of a level for one direction and optionally one validator and
+    # peer, through the pair offsets. A peer alone matches pairs spread
+    # over every validator, so the rows are gathered pair by pair
+    cube = experiment['pyramid'][level]
+    offsets = experiment['offsets'][level]
+    mask = offsets['direction'] == direction
+    if validator is not None:
+        mask &= offsets['validator'] == validator
+    if peer is not None:
+        mask &= offsets['msg.peer_id'] == peer
+    return cube.iloc[offset_positions(offsets[mask])]
+
+
+def split_list(value):
+    return [item for item in value.split(',') if item] if value else []
+
+
+def speed_query(experiment, params):
+    # Bytes and Mbps per interval between start and end for a direction,
+    # optionally one validator and one peer, broken down by the 'by' columns.
+    # start/end are floored to the rollup level the interval is read from,
+    # without them the range covers the buckets of the matching rows
+    direction = params.get('direction', 'received')
+    interval = params.get('interval', '10s')
+    by = split_list(params.get('by'))
+    unknown = [column for column in by if column not in SPEED_GROUPS]
+    if unknown:
+        raise ValueError(f"Cannot group speeds by {unknown}, use {SPEED_GROUPS}")
+
+    cube = resolve_cube(experiment['pyramid'], interval)
+    level = next(level for level, level_cube in experiment['pyramid'].items() if level_cube is cube)
+    rows = pair_rows(experiment, level, direction, params.get('validator'), params.get('peer'))
+    if 'start' in params:
+        rows = rows[rows['bucket'] >= to_utc(params['start']).floor(level)]
+    if 'end' in params:
+        rows = rows[rows['bucket'] < to_utc(params['end']).floor(level)]
+    if rows.empty:
+        return pd.DataFrame(columns=by + ['window_start', 'window_end', 'bytes', 'duration_s', 'speed_mbps'])
+
+    series = cumulative_series(rows, by, 'bucket', 'bytes')
+    step = pd.to_timedelta(interval).value
+    # [first, last) of the range, the last bucket is whole
+    first = to_utc(params['start']).floor(level).value if 'start' in params else rows['bucket'].min().value
+    last = to_utc(params['end']).floor(level).value if 'end' in params \
+        else rows['bucket'].max().value + pd.to_timedelta(level).value
+    edges = np.arange(first - first % step, last, step)
+    groups = np.repeat(np.arange(len(series['firsts'])), len(edges))
+    starts = np.tile(edges, len(series['firsts']))
+    # Windows are clipped to the range, so a partial window is divided by the time it covers
+    return window_throughput(series, groups, np.maximum(starts, first), np.minimum(starts + step, last))
+
+
+def totals_query(experiment, params):
+    # Upload and download speeds over the whole experiment per validator or region
+    by = params.get('by', 'validator')
+    if by == 'validator':
+        return total_speeds_from_cube(experiment['pyramid'])
+    if by == 'region':
+        return total_regions_speeds_from_cube(experiment['pyramid'])
+    raise ValueError(f"Cannot total speeds by {by}, use validator or region")
+
+
+def latency_key(ips_to_regions, key):
+    validator, ip = key
+    peer_ip = ip.split(':')[0]
+    return {
+        'validator': validator,
+        'peer_ip': peer_ip,
+        'source_region': ips_to_regions.get(validator, 'Unknown'),
+        'target_region': ips_to_regions.get(peer_ip, 'Unknown'),
+    }
+
+
+def latency_query(experiment, params):
+    # Latency stats in ms of the messages matching the validator, peer_ip,
+    # source_region and target_region filters, merged across the matching
+    # pairs or broken down by the 'by' keys. quantiles adds e.g. 0.999
+    by = split_list(params.get('by'))
+    unknown = [key for key in by if key not in LATENCY_GROUPS]
+    if unknown:
+        raise ValueError(f"Cannot group latencies by {unknown}, use {LATENCY_GROUPS}")
+    quantiles = [float(q) for q in split_list(params.get('quantiles'))]
+    filters = {key: params[key] for key in LATENCY_GROUPS if key in params}
+
+    ips_to_regions = experiment['ips_to_regions']
+    matching = {}
+    for key, sketch in experiment['sketches'].items():
+        labels = latency_key(ips_to_regions, key)
+        if all(labels[name] == value for name, value in filters.items()):
+            matching[key] = sketch
+    merged = merge_sketches(matching, lambda key: tuple(latency_key(ips_to_regions, key)[name] for name in by))
+
+    rows = []
+    for key, sketch in merged.items():
+        row = {**dict(zip(by, key)), **sketch.summary()}
+        for q in quantiles:
+            row[f'q{q:g}'] = sketch.quantile(q)
+        rows.append(row)
+    return pd.DataFrame(rows, columns=by + MATRIX_STATISTICS + [f'q{q:g}' for q in quantiles])
+
+
+def experiments_query(experiments, params):
+    rows = []
+    for name, experiment in experiments.items():
+        cube = select_level(experiment['pyramid'])
+        rows.append({
+            'experiment': name,
+            'path': experiment['path'],
+            'levels': list(experiment['pyramid']),
+            'validators': sorted(cube['validator'].astype(str).unique()),
+            'start': cube['first_time'].min(),
+            'end': cube['last_time'].max(),
+            'latency_pairs': len(experiment['sketches']),
+        })
+    return pd.DataFrame(rows)
+
+
+QUERIES = {
+    '/speed': speed_query,
+    '/totals': totals_query,
+    '/latency': latency_query,
+}
+
+
+class QueryServer:
+    # Answers GET /experiments, /speed, /totals and /latency with JSON rows.
+    # Every query but /experiments takes an experiment parameter, which may
+    # be left out when a single experiment is loaded. Answers are cached by
+    # path and parameters, the experiments never change once loaded
+
+    def __init__(self, experiments, cache_size=QUERY_CACHE_SIZE):
+        self.experiments = experiments
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def experiment(self, params):
+        name = params.pop('experiment', None)
+        if name is None and len(self.experiments) == 1:
+            name = next(iter(self.experiments))
+        if name not in self.experiments:
+            raise LookupError(f"Unknown experiment {name}, loaded: {sorted(self.experiments)}")
+        return self.experiments[name]
+
+    def answer(self, path, params):
+        # JSON body of a query, computed once per distinct query
+        key = (path, tuple(sorted(params.items())))
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        if path == '/experiments':
+            result = experiments_query(self.experiments, params)
+        elif path in QUERIES:
+            params = dict(params)
+            result = QUERIES[path](self.experiment(params), params)
+        else:
+            raise LookupError(f"Unknown query {path}, use /experiments or one of {sorted(QUERIES)}")
+        body = ('{"rows": ' + result.to_json(orient='records', date_format='iso') + '}').encode()
+
+        self.cache[key] = body
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return body
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            # Headers are not used, read up to the blank line ending them
+            while (await reader.readline()).strip():
+                pass
+            if len(request_line) < 2 or request_line[0] != 'GET':
+                status, body = 405, json.dumps({'error': "Only GET is supported"}).encode()
+            else:
+                url = urllib.parse.urlsplit(request_line[1])
+                params = dict(urllib.parse.parse_qsl(url.query))
+                try:
+                    # Queries run on a thread so a slow one does not hold up the others
+                    status, body = 200, await asyncio.get_running_loop().run_in_executor(
+                        None, self.answer, url.path, params)
+                except LookupError as e:
+                    status, body = 404, json.dumps({'error': str(e)}).encode()
+                except (ValueError, TypeError) as e:
+                    status, body = 400, json.dumps({'error': str(e)}).encode()
+                except Exception as e:
+                    traceback.print_exc()
+                    status, body = 500, json.dumps({'error': f"{type(e).__name__}: {e}"}).encode()
+            writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                         f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, port=DEFAULT_PORT, unix_socket=None):
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self.handle, path=unix_socket)
+            print(f"serving on {unix_socket}")
+        else:
+            server = await asyncio.start_server(self.handle, HOST, port)
+            print(f"serving on http://{HOST}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def query(path, port=DEFAULT_PORT, **params):
+    # Client for notebooks and scripts, e.g.
+    # query('/speed', validator='10.0.0.1', peer='abc', start='2024-06-01T14:00:00Z', end='2024-06-01T14:05:00Z')
+    url = f"http://{HOST}:{port}{path}?{urllib.parse.urlencode(params)}"
+    with urllib.request.urlopen(url) as response:
+        return pd.DataFrame(json.load(response)['rows'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Keep experiments loaded and answer queries about them on localhost")
+    parser.add_argument('experiments', nargs='+')
+    parser.add_argument('--regions', default='list.txt', help="validator list with regions")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix-socket', help="listen on this Unix socket instead of a TCP port")
+    args = parser.parse_args()
+
+    ips_to_regions = parse_ip_to_region(args.regions)
+    print("finished parsing list with regions")
+
+    experiments = {}
+    with Pool(processes=max(cpu_count() - 1, 1)) as pool:
+        for experiment_path in args.experiments:
+            experiments[os.path.basename(os.path.normpath(experiment_path))] = \
+                load_experiment(experiment_path, ips_to_regions, pool)
+            print(f"loaded {experiment_path}")
+
+    asyncio.run(QueryServer(experiments).serve(args.port, args.unix_socket))
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+# Shortest layout parsed on the fast path, "YYYY-MM-DDTHH:MM:SS" + fraction + "+hh:mm"
+MIN_WIDTH = 36
+
+NAT = np.iinfo(np.int64).min
+
+
+def parse_rfc3339_ns(values):
+    # Parses a column of RFC3339 timestamps, e.g. "2024-12-09T20:03:09.030144354Z",
+    # into int64 nanoseconds since the epoch (UTC) in a single vectorized pass.
+    # The fraction may have 0 to 9 digits (Go trims trailing zeros) and the
+    # offset may be 'Z', '+hh:mm' or '-hh:mm'. Empty or invalid values become
+    # NAT, the int64 minimum that NaT views as, so differences of parsed
+    # columns must mask it first, see valid_ns
+    values = np.asarray(values)
+    if values.dtype.kind != 'S':
+        values = values.astype('S')
+    if len(values) == 0:
+        return np.array([], dtype=np.int64)
+
+    width = max(values.itemsize, MIN_WIDTH)
+    values = values.astype(f'S{width}')
+    chars = values.view(np.uint8).reshape(len(values), width)
+
+    # Whole seconds, numpy parses the fixed "YYYY-MM-DDTHH:MM:SS" prefix in C
+    try:
+        seconds = np.ascontiguousarray(chars[:, :19]).view('S19').ravel().astype('datetime64[s]')
+    except ValueError:
+        return parse_rfc3339_ns_slow(values)
+    missing = np.isnat(seconds)
+
+    # Fraction, as many contiguous digits as follow the '.'
+    has_fraction = chars[:, 19] == ord('.')
+    digits = chars[:, 20:] - np.uint8(ord('0'))
+    is_digit = (digits <= 9) & has_fraction[:, None]
+    is_digit = np.logical_and.accumulate(is_digit, axis=1)
+    num_digits = is_digit.sum(axis=1)
+    weights = 10 ** np.arange(8, -1, -1, dtype=np.int64)
+    fraction = (digits[:, :9] * is_digit[:, :9]).astype(np.int64) @ weights
+
+    # Offset right after the fraction
+    tz_pos = 19 + np.where(has_fraction, num_digits + 1, 0)
+    rows = np.arange(len(values))
+    tz_char = chars[rows, tz_pos]
+    has_offset = (tz_char == ord('+')) | (tz_char == ord('-'))
+    if (~missing & ~has_offset & (tz_char != ord('Z')) & (tz_char != 0)).any():
+        return parse_rfc3339_ns_slow(values)
+    offset = np.zeros(len(values), dtype=np.int64)
+    if has_offset.any():
+        def digit(k):
+            return chars[rows, np.minimum(tz_pos + k, width - 1)].astype(np.int64) - ord('0')
+        minutes = (digit(1) * 10 + digit(2)) * 60 + digit(4) * 10 + digit(5)
+        sign = np.where(tz_char == ord('-'), -1, 1)
+        offset = np.where(has_offset, sign * minutes * 60, 0)
+
+    whole = np.where(missing, 0, seconds.astype(np.int64))
+    ns = (whole - offset) * 1_000_000_000 + fraction
+    ns[missing] = NAT
+    return ns
+
+
+def valid_ns(*columns):
+    # Mask of the rows where none of the parsed columns is NAT
+    mask = np.ones(len(columns[0]), dtype=bool)
+    for ns in columns:
+        mask &= ns != NAT
+    return mask
+
+
+def parse_rfc3339_ns_slow(values):
+    # Fallback for columns with layouts the fast path does not handle
+    strings = pd.Series(values).str.decode('utf-8')
+    parsed = pd.to_datetime(strings, utc=True, format='ISO8601', errors='coerce')
+    return parsed.to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+
+def rfc3339_to_datetime(values):
+    # Same as parse_rfc3339_ns but returns tz-aware UTC timestamps, as
+    # pd.to_datetime does for the 'Z' suffixed trace timestamps
+    index = pd.DatetimeIndex(parse_rfc3339_ns(values).view('datetime64[ns]'))
+    return index.tz_localize('UTC')
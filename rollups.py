@@ -0,0 +1,248 @@
+import json
+import os
+from collections.abc import Mapping
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from address_book import lookup_addresses
+from instrumentation import stage
+from layout import load_offsets, offsets_path, pair_offsets, sort_canonical, store_offsets
+from parse_jsonl import list_trace_files, process_experiment_data
+from trace_cache import experiment_digest, sources_digest
+from traffic_cube import CUBE_BUCKET, CUBE_KEYS, build_traffic_cube, check_interval
+
+# Resolutions of the rollup pyramid, finest first. Each level is derived from
+# the previous one, the finest level is the traffic cube itself
+ROLLUP_LEVELS = ['1s', '10s', '1min', '10min']
+
+ROLLUP_DIR_NAME = '.rollups'
+
+
+def rollup_cube(cube, bucket, keys=CUBE_KEYS):
+    # Re-buckets a cube to a coarser bucket, summing the finer buckets
+    rolled = cube.assign(bucket=cube['bucket'].dt.floor(bucket)).groupby(
+        keys, observed=True, dropna=False, sort=False
+    ).agg(
+        bytes=('bytes', 'sum'),
+        samples=('samples', 'sum'),
+        first_time=('first_time', 'min'),
+        last_time=('last_time', 'max'),
+    ).reset_index()
+    rolled = sort_canonical(rolled, 'bucket')
+    rolled.attrs['bucket'] = bucket
+    return rolled
+
+
+def build_rollup_pyramid(cube, levels=ROLLUP_LEVELS, keys=CUBE_KEYS):
+    # Returns {level: cube}, each level rolled up from the one before it
+    if pd.to_timedelta(levels[0]) != pd.to_timedelta(cube.attrs.get('bucket', CUBE_BUCKET)):
+        raise ValueError(f"The finest rollup level {levels[0]} must be the cube bucket")
+    pyramid = {levels[0]: cube}
+    for finer, coarser in zip(levels, levels[1:]):
+        pyramid[coarser] = rollup_cube(pyramid[finer], coarser, keys)
+    return pyramid
+
+
+def select_level(pyramid, interval=None):
+    # Coarsest level whose bucket evenly divides interval, or the coarsest
+    # level overall when no interval is needed (e.g. for totals)
+    levels = sorted(pyramid, key=pd.to_timedelta)
+    if interval is None:
+        return pyramid[levels[-1]]
+    interval = pd.to_timedelta(interval)
+    usable = [level for level in levels if interval % pd.to_timedelta(level) == pd.Timedelta(0)]
+    if not usable:
+        raise ValueError(f"No rollup level divides the interval {interval}")
+    return pyramid[usable[-1]]
+
+
+def resolve_cube(source, interval=None):
+    # Speed views accept either a cube or a pyramid, from a pyramid they get
+    # the coarsest level that can answer the interval
+    if isinstance(source, Mapping):
+        source = select_level(source, interval)
+    if interval is not None:
+        check_interval(source, interval)
+    return source
+
+
+def rollup_paths(experiment_path):
+    rollup_dir = os.path.join(experiment_path, ROLLUP_DIR_NAME)
+    return rollup_dir, os.path.join(rollup_dir, 'meta.json')
+
+
+def level_path(rollup_dir, level):
+    return os.path.join(rollup_dir, f"rollup_{level}.parquet")
+
+
+class StoredPyramid(Mapping):
+    # {level: cube} of a stored pyramid, each level read the first time it is
+    # used. The views mostly read the coarse levels, so the finest one, which
+    # grows with the duration and the number of pairs, is only loaded by the
+    # views that need it
+
+    def __init__(self, rollup_dir, levels, digest):
+        self.rollup_dir = rollup_dir
+        self.levels = list(levels)
+        self.digest = digest
+        self.loaded = {}
+        self.loaded_offsets = {}
+
+    def __getitem__(self, level):
+        if level not in self.levels:
+            raise KeyError(level)
+        if level not in self.loaded:
+            cube = sort_canonical(pd.read_parquet(level_path(self.rollup_dir, level)), 'bucket')
+            cube.attrs['bucket'] = level
+            cube.attrs['digest'] = self.digest
+            self.loaded[level] = cube
+        return self.loaded[level]
+
+    def offsets(self, level):
+        # Pair offsets of a level, read from next to it when they were stored
+        if level not in self.loaded_offsets:
+            cube = self[level]
+            offsets = load_offsets(level_path(self.rollup_dir, level), len(cube))
+            self.loaded_offsets[level] = offsets if offsets is not None else pair_offsets(cube)
+        return self.loaded_offsets[level]
+
+    def __iter__(self):
+        return iter(self.levels)
+
+    def __len__(self):
+        return len(self.levels)
+
+
+def load_rollup_pyramid(experiment_path, ips_to_regions):
+    # Returns the stored pyramid if it was built from the currently cached
+    # trace files, or None if it is missing or stale. Levels are read on use
+    rollup_dir, meta_path = rollup_paths(experiment_path)
+    source_files = [source_file for _, _, source_file in list_trace_files(experiment_path)]
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Pyramids built out of core are keyed by the trace files, the others by their caches
+    if meta.get('digest') not in (experiment_digest(source_files, ips_to_regions),
+                                  sources_digest(source_files, ips_to_regions)):
+        return None
+    return StoredPyramid(rollup_dir, meta['levels'], meta['digest'])
+
+
+def start_store(experiment_path):
+    # Invalidates the stored pyramid before its levels are overwritten
+    rollup_dir, meta_path = rollup_paths(experiment_path)
+    os.makedirs(rollup_dir, exist_ok=True)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    return rollup_dir
+
+
+def finish_store(experiment_path, digest, levels):
+    # Marks the levels written since start_store as the pyramid of digest
+    _, meta_path = rollup_paths(experiment_path)
+    tmp_path = meta_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'digest': digest, 'levels': list(levels)}, f)
+    os.replace(tmp_path, meta_path)
+
+
+def store_rollup_pyramid(experiment_path, ips_to_regions, pyramid, digest=None):
+    # Stores the pyramid with the experiment, keyed by the digest of the trace
+    # file caches it was built from, or by the given sources_digest. The
+    # pyramid must cover the whole experiment, nothing is stored if the caches
+    # are not all valid
+    if digest is None:
+        source_files = [source_file for _, _, source_file in list_trace_files(experiment_path)]
+        digest = experiment_digest(source_files, ips_to_regions)
+    if digest is None:
+        return False
+
+    rollup_dir = start_store(experiment_path)
+    for level, cube in pyramid.items():
+        cube.to_parquet(level_path(rollup_dir, level), index=False)
+        store_offsets(cube, level_path(rollup_dir, level))
+    finish_store(experiment_path, digest, pyramid)
+    for cube in pyramid.values():
+        cube.attrs['digest'] = digest
+    return True
+
+
+def store_rollup_partitions(experiment_path, partitions, dtypes, book, digest, levels=ROLLUP_LEVELS):
+    # Stores a pyramid given as partitions spilled to disk, {level: parquet
+    # file} each, whose keys never overlap and which are in canonical order.
+    # The partitions are keyed by ADDRESS_CUBE_KEYS, each gets its target IPs
+    # and regions from the experiment's address book and is rolled up by
+    # CUBE_KEYS. Every level is written a partition at a time as one row
+    # group, so only one partition is ever in memory. dtypes are the
+    # categorical dtypes of the whole pyramid
+    rollup_dir = start_store(experiment_path)
+    for level in levels:
+        writer = None
+        # The pair offsets of every partition, shifted past the rows written before it
+        offsets = []
+        rows = 0
+        for partition in partitions:
+            cube = pd.read_parquet(partition[level])
+            cube = cube.astype({column: dtype for column, dtype in dtypes.items() if column in cube.columns})
+            cube = rollup_cube(cube.assign(**lookup_addresses(book, cube['msg.ip_address'])), level)
+            table = pa.Table.from_pandas(cube, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(level_path(rollup_dir, level), table.schema)
+            writer.write_table(table)
+            partition_offsets = pair_offsets(cube)
+            offsets.append(partition_offsets.assign(start=partition_offsets['start'] + rows,
+                                                    stop=partition_offsets['stop'] + rows))
+            rows += len(cube)
+            del cube, table
+        if writer is not None:
+            writer.close()
+            pd.concat(offsets, ignore_index=True).to_parquet(offsets_path(level_path(rollup_dir, level)), index=False)
+    finish_store(experiment_path, digest, levels)
+
+
+def level_offsets(pyramid, level):
+    # Pair offsets of a level (see layout.py), stored pyramids read them from
+    # disk once, in-memory ones compute them
+    if isinstance(pyramid, StoredPyramid):
+        return pyramid.offsets(level)
+    return pair_offsets(pyramid[level])
+
+
+def pyramid_digest(pyramid):
+    # Digest the pyramid was stored or loaded under, None if it was never
+    # stored. Identifies its contents for the memoized stages (see stage_cache.py)
+    return select_level(pyramid).attrs.get('digest')
+
+
+def experiment_rollups(experiment_path, ips_to_regions, memory_budget_mb=None, pool=None):
+    # The stored rollup pyramid of the experiment, built from the traces and
+    # stored first if they changed. With a memory budget the traces are folded
+    # out of core, on pool if given (see build_pyramid_out_of_core for its
+    # size) or on a pool planned within the budget. Stored levels are read
+    # when first used
+    with stage('load rollups', 'io'):
+        traffic_rollups = load_rollup_pyramid(experiment_path, ips_to_regions)
+    if traffic_rollups is None and memory_budget_mb is not None:
+        # out_of_core builds on this module, so it is only imported when used
+        from out_of_core import build_pyramid_out_of_core
+
+        # fold the traces into the stored rollups a bounded chunk and partition at a time,
+        # neither the raw samples nor the whole cube are ever in memory
+        traffic_rollups = build_pyramid_out_of_core(experiment_path, ips_to_regions, memory_budget_mb, pool=pool)
+    elif traffic_rollups is None:
+        received_df, sent_df = process_experiment_data(experiment_path, ips_to_regions, pool=pool)
+        print("finished processing experiment data")
+
+        # sum the bytes per direction, validator, peer and second once, every speed view is derived from it
+        with stage('build traffic cube', 'aggregate', rows=len(received_df) + len(sent_df)):
+            traffic_cube = build_traffic_cube(sent_df, received_df)
+        del received_df, sent_df
+        with stage('build rollups', 'aggregate', rows=len(traffic_cube)):
+            traffic_rollups = build_rollup_pyramid(traffic_cube)
+        with stage('store rollups', 'io'):
+            store_rollup_pyramid(experiment_path, ips_to_regions, traffic_rollups)
+    return traffic_rollups
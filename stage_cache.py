@@ -0,0 +1,89 @@
+import glob
+import hashlib
+import inspect
+import json
+import os
+
+import pandas as pd
+
+# Memoized stage outputs are stored with the experiment, next to the rollups
+STAGE_DIR_NAME = '.stages'
+
+
+def code_version(*objects):
+    # Digest of the source of the functions or modules a stage runs, so that
+    # editing one plot only invalidates that plot
+    digest = hashlib.sha1()
+    for obj in objects:
+        digest.update(inspect.getsource(obj).encode())
+    return digest.hexdigest()
+
+
+def stage_key(*parts):
+    # Digest of everything a stage output depends on: the key of its input,
+    # its parameters and its code version. None if any part is unknown, e.g.
+    # the input was not stored, in which case the stage is not memoized
+    if any(part is None for part in parts):
+        return None
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def stage_dir(experiment_path):
+    return os.path.join(experiment_path, STAGE_DIR_NAME)
+
+
+def memoize_frame(experiment_path, name, key, compute):
+    # Returns the frame stored for key, or computes and stores it. Older
+    # outputs of the same stage are removed
+    if key is None:
+        return compute()
+    directory = stage_dir(experiment_path)
+    path = os.path.join(directory, f"{name}-{key}.parquet")
+    if os.path.exists(path):
+        print(f"{name} is up to date")
+        return pd.read_parquet(path)
+
+    frame = compute()
+    os.makedirs(directory, exist_ok=True)
+    for old_path in glob.glob(os.path.join(directory, f"{name}-*.parquet")):
+        os.remove(old_path)
+    tmp_path = path + '.tmp'
+    frame.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return frame
+
+
+def list_outputs(output_dir):
+    outputs = {}
+    for root, _, files in os.walk(output_dir):
+        for file_name in files:
+            path = os.path.join(root, file_name)
+            outputs[path] = os.stat(path).st_mtime_ns
+    return outputs
+
+
+def memoize_render(experiment_path, name, key, output_dir, render):
+    # Runs render unless it already ran with the same key and the files it
+    # wrote then are all still there. The outputs are the files under
+    # output_dir that render created or modified. Returns whether it ran
+    memo_path = os.path.join(stage_dir(experiment_path), f"{name}.json")
+    if key is not None:
+        try:
+            with open(memo_path, 'r') as f:
+                memo = json.load(f)
+        except (OSError, ValueError):
+            memo = {}
+        if memo.get('key') == key and memo.get('outputs') and all(os.path.exists(path) for path in memo['outputs']):
+            print(f"{name} is up to date")
+            return False
+
+    before = list_outputs(output_dir)
+    render()
+    outputs = sorted(path for path, mtime in list_outputs(output_dir).items() if before.get(path) != mtime)
+    if key is not None:
+        os.makedirs(stage_dir(experiment_path), exist_ok=True)
+        tmp_path = memo_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': key, 'outputs': outputs}, f, indent=2)
+        os.replace(tmp_path, memo_path)
+    return True
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from compute_speed import speed_progression_from_cube, speed_progression_per_peer_from_cube
+from generate_traces import generate_experiment
+from rollups import experiment_rollups
+
+
+@pytest.fixture(scope='module')
+def experiment(tmp_path_factory):
+    # More validators than regions in the first rows of the list, so that a
+    # region shifted by one validator shows up
+    root = tmp_path_factory.mktemp('compute_speed')
+    experiment_path = os.path.join(root, 'synthetic')
+    ips_to_regions, _ = generate_experiment(experiment_path, os.path.join(root, 'list.txt'), num_validators=6,
+                                            num_peers=2, duration=30)
+    return experiment_rollups(experiment_path, ips_to_regions), ips_to_regions
+
+
+@pytest.mark.parametrize('direction', ['sent', 'received'])
+def test_speed_progression_regions_match_the_list(experiment, direction):
+    pyramid, ips_to_regions = experiment
+    progression = speed_progression_from_cube(pyramid, direction, interval='10s')
+    assert progression['validator'].nunique() == 6
+    for validator, region in zip(progression['validator'].astype(str), progression['region'].astype(str)):
+        assert region == ips_to_regions[validator]
+    assert list(progression.columns) == ['validator', 'msg.time', 'total_bytes', 'region', 'time_diff',
+                                         'speed_mbps', 'action']
+
+
+def test_per_peer_target_regions_match_the_list(experiment):
+    pyramid, ips_to_regions = experiment
+    speeds = speed_progression_per_peer_from_cube(pyramid, 'received', interval='10s')
+    for target_ip, region in zip(speeds['target_ip'].astype(str), speeds['target_region'].astype(str)):
+        assert region == ips_to_regions[target_ip]
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from generate_traces import generate_experiment
+from parse_jsonl import process_experiment_data
+from query_server import QueryServer, latency_query, load_experiment, speed_query, totals_query
+
+START = pd.Timestamp('2024-12-09T20:00:00Z')
+
+
+@pytest.fixture(scope='module')
+def experiment(tmp_path_factory):
+    root = tmp_path_factory.mktemp('query_server')
+    experiment_path = os.path.join(root, 'synthetic')
+    ips_to_regions, _ = generate_experiment(experiment_path, os.path.join(root, 'list.txt'), num_validators=4,
+                                            num_peers=2, duration=45, sample_rate=5, latency_rate=2)
+    return load_experiment(experiment_path, ips_to_regions)
+
+
+@pytest.fixture(scope='module')
+def frames(experiment):
+    received_df, sent_df = process_experiment_data(experiment['path'], experiment['ips_to_regions'])
+    return {'received': received_df, 'sent': sent_df}
+
+
+def test_speed_windows_cover_every_byte(experiment, frames):
+    received = frames['received']
+    validator = received['validator'].iloc[0]
+    speeds = speed_query(experiment, {'direction': 'received', 'validator': validator, 'interval': '10s'})
+    assert speeds['bytes'].sum() == received.loc[received['validator'] == validator, 'msg.bytes'].sum()
+    # The last window is whole, not cut at the start of the last bucket
+    assert (speeds['duration_s'] == 10).all()
+    assert speeds['window_end'].max() == received['msg.time'].max().floor('10s') + pd.Timedelta('10s')
+
+
+def test_speed_range_is_clipped(experiment, frames):
+    # 20s windows are read from the 10s level, start and end are floored to it
+    sent = frames['sent']
+    params = {'direction': 'sent', 'start': str(START + pd.Timedelta('14s')), 'end': str(START + pd.Timedelta('40s')),
+              'interval': '20s'}
+    speeds = speed_query(experiment, params)
+    in_range = (sent['msg.time'] >= START + pd.Timedelta('10s')) & (sent['msg.time'] < START + pd.Timedelta('40s'))
+    assert speeds['bytes'].sum() == sent.loc[in_range, 'msg.bytes'].sum()
+    assert speeds['window_start'].min() == START + pd.Timedelta('10s')
+    assert speeds['window_end'].max() == START + pd.Timedelta('40s')
+    # The window cut by the start is divided by the time it covers
+    assert speeds['duration_s'].tolist() == [10.0, 20.0]
+
+
+def test_speed_of_a_peer_spans_every_validator(experiment, frames):
+    received = frames['received']
+    peer = received['msg.peer_id'].iloc[0]
+    speeds = speed_query(experiment, {'peer': peer, 'by': 'validator'})
+    expected = received[received['msg.peer_id'] == peer].groupby('validator', observed=True)['msg.bytes'].sum()
+    assert speeds.groupby('validator', observed=True)['bytes'].sum().to_dict() == expected.to_dict()
+
+
+def test_empty_and_invalid_speed_queries(experiment):
+    speeds = speed_query(experiment, {'validator': 'no such validator', 'by': 'region'})
+    assert speeds.empty and list(speeds.columns[:2]) == ['region', 'window_start']
+    with pytest.raises(ValueError):
+        speed_query(experiment, {'by': 'bucket'})
+    with pytest.raises(ValueError):
+        totals_query(experiment, {'by': 'peer'})
+
+
+def test_latency_counts_every_line(experiment):
+    validator = sorted(experiment['sketches'])[0][0]
+    with open(os.path.join(experiment['path'], validator, 'msg_latency.jsonl')) as f:
+        lines = sum(1 for _ in f)
+    latencies = latency_query(experiment, {'validator': validator, 'quantiles': '0.5,0.999'})
+    assert latencies['count'].tolist() == [lines]
+    assert list(latencies.columns[-2:]) == ['q0.5', 'q0.999']
+
+    by_peer = latency_query(experiment, {'validator': validator, 'by': 'peer_ip'})
+    assert by_peer['count'].sum() == lines and len(by_peer) == 2
+    with pytest.raises(ValueError):
+        latency_query(experiment, {'by': 'node_id'})
+
+
+def test_answers_are_cached_and_unknown_queries_fail(experiment):
+    server = QueryServer({'synthetic': experiment}, cache_size=1)
+    body = server.answer('/totals', {'by': 'region'})
+    assert server.answer('/totals', {'by': 'region'}) is body
+    assert json.loads(body)['rows']
+    server.answer('/experiments', {})
+    assert len(server.cache) == 1
+    with pytest.raises(LookupError):
+        server.answer('/nothing', {})
+    with pytest.raises(LookupError):
+        server.answer('/totals', {'experiment': 'other'})
+
+
+def request(server, target, method='GET'):
+    # Status and JSON body of one request to the server on an ephemeral port
+    async def run():
+        listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        async with listener:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(f"{method} {target} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+        head, body = response.split(b'\r\n\r\n', 1)
+        return int(head.split()[1]), json.loads(body)
+    return asyncio.run(run())
+
+
+def test_http_statuses(experiment, monkeypatch):
+    server = QueryServer({'synthetic': experiment})
+    status, body = request(server, '/totals?by=validator')
+    assert status == 200 and len(body['rows']) == 4
+    assert request(server, '/totals?by=peer')[0] == 400
+    assert request(server, '/nothing')[0] == 404
+    assert request(server, '/totals', method='POST')[0] == 405
+
+    def fail(path, params):
+        raise RuntimeError("broken")
+    monkeypatch.setattr(server, 'answer', fail)
+    status, body = request(server, '/totals')
+    assert status == 500 and body['error'] == "RuntimeError: broken"
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+from rfc3339 import NAT, parse_rfc3339_ns, rfc3339_to_datetime, valid_ns
+
+
+def reference_ns(values):
+    return [pd.Timestamp(value).value for value in values]
+
+
+def test_fraction_digits_from_none_to_nanoseconds():
+    # Go trims trailing zeros, so the fraction may have any number of digits
+    values = [
+        '2024-12-09T20:03:09Z',
+        '2024-12-09T20:03:09.5Z',
+        '2024-12-09T20:03:09.03Z',
+        '2024-12-09T20:03:09.030144Z',
+        '2024-12-09T20:03:09.030144354Z',
+    ]
+    assert parse_rfc3339_ns(np.array(values, dtype='S')).tolist() == reference_ns(values)
+
+
+def test_offsets_are_converted_to_utc():
+    values = [
+        '2024-12-09T20:03:09.1+02:00',
+        '2024-12-09T20:03:09-05:30',
+        '2024-12-31T23:59:59.999999999+00:00',
+        '2024-01-01T00:00:00.000000001-00:45',
+    ]
+    assert parse_rfc3339_ns(np.array(values, dtype='S')).tolist() == reference_ns(values)
+
+
+def test_str_input_and_empty_column():
+    assert parse_rfc3339_ns(np.array(['2024-12-09T20:03:09Z'])).tolist() == reference_ns(['2024-12-09T20:03:09Z'])
+    assert parse_rfc3339_ns(np.array([], dtype='S1')).dtype == np.int64
+
+
+def test_invalid_values_become_nat():
+    values = np.array([b'2024-12-09T20:03:09Z', b'', b'not a time', b'2024-12-09T20:03:10Z'])
+    ns = parse_rfc3339_ns(values)
+    assert ns[0] == pd.Timestamp('2024-12-09T20:03:09Z').value
+    assert ns[3] == pd.Timestamp('2024-12-09T20:03:10Z').value
+    assert ns[1] == NAT and ns[2] == NAT
+
+
+def test_other_layouts_use_the_slow_path():
+    values = ['2024-12-09 20:03:09.25Z', '2024-12-09T20:03:09.25Z']
+    assert parse_rfc3339_ns(np.array(values, dtype='S')).tolist() == reference_ns(values)
+
+
+def test_valid_ns_masks_nat_in_any_column():
+    send = parse_rfc3339_ns(np.array([b'2024-12-09T20:03:09Z', b'', b'2024-12-09T20:03:09Z']))
+    receive = parse_rfc3339_ns(np.array([b'2024-12-09T20:03:10Z', b'2024-12-09T20:03:10Z', b'bad']))
+    assert valid_ns(send, receive).tolist() == [True, False, False]
+
+
+def test_datetimes_are_utc_and_nat_stays_nat():
+    index = rfc3339_to_datetime(np.array([b'2024-12-09T21:03:09.030144354+01:00', b'']))
+    assert str(index.tz) == 'UTC'
+    assert index[0] == pd.Timestamp('2024-12-09T20:03:09.030144354Z')
+    assert pd.isna(index[1])
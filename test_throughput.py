@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from throughput import cumulative_series, fixed_windows, rolling_sums, sliding_windows, window_sums, \
+    window_throughput
+
+
+@pytest.fixture
+def samples():
+    # Unsorted samples of a few (validator, peer) series, with repeated times
+    rng = np.random.default_rng(7)
+    n = 2000
+    return pd.DataFrame({
+        'validator': rng.choice(['10.0.0.1', '10.0.0.2', '10.0.0.3'], n),
+        'msg.peer_id': rng.choice(['a', 'b', 'c', 'd'], n),
+        'msg.time': pd.Timestamp('2024-12-09T20:00:00Z') + pd.to_timedelta(rng.integers(0, 600, n) * 250, 'ms'),
+        'msg.bytes': rng.integers(1, 10_000, n),
+    })
+
+
+@pytest.mark.parametrize('interval', ['1s', '10s', '7s', '1min'])
+def test_fixed_windows_match_resample(samples, interval):
+    keys = ['validator', 'msg.peer_id']
+    series = cumulative_series(samples, keys)
+    groups, starts, ends = fixed_windows(series, interval)
+    result = series['keys'].iloc[groups].reset_index(drop=True)
+    result['msg.time'] = pd.to_datetime(starts, utc=True)
+    result['msg.bytes'] = window_sums(series, groups, starts, ends)
+
+    # Windows are aligned on multiples of interval since the epoch, the same
+    # as resample's day start for intervals dividing a day
+    expected = samples.set_index('msg.time').groupby(keys)['msg.bytes'].resample(
+        interval, origin='epoch').sum().reset_index()
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_sliding_windows_match_summing_every_window(samples):
+    series = cumulative_series(samples, ['validator'])
+    groups, starts, ends = sliding_windows(series, '30s', '10s')
+    sums = window_sums(series, groups, starts, ends)
+    times = samples['msg.time'].astype('int64').to_numpy()
+    validators = series['keys']['validator'].to_numpy()
+    for group, start, end, total in zip(groups, starts, ends, sums):
+        in_window = (samples['validator'].to_numpy() == validators[group]) & (times >= start) & (times < end)
+        assert total == samples['msg.bytes'].to_numpy()[in_window].sum()
+
+
+def test_rolling_sums_match_rolling(samples):
+    keys = ['validator', 'msg.peer_id']
+    series = cumulative_series(samples, keys)
+    ordered = samples.iloc[series['order']].reset_index(drop=True)
+    expected = ordered.groupby(keys, sort=False).rolling('5s', on='msg.time')['msg.bytes'].sum()
+    assert np.array_equal(rolling_sums(series, '5s'), expected.to_numpy())
+
+
+def test_windows_outside_a_series_are_empty(samples):
+    series = cumulative_series(samples, ['validator'])
+    first, step = samples['msg.time'].min().value, pd.Timedelta('1h').value
+    groups = np.array([0, 1, 2])
+    sums = window_sums(series, groups, np.full(3, first - step), np.full(3, first))
+    assert sums.tolist() == [0, 0, 0]
+    sums = window_sums(series, groups, np.full(3, first), np.full(3, first + step))
+    assert sums.sum() == samples['msg.bytes'].sum()
+
+
+def test_partial_windows_divide_by_their_length():
+    df = pd.DataFrame({
+        'validator': ['10.0.0.1'] * 2,
+        'msg.time': pd.to_datetime(['2024-12-09T20:00:01Z', '2024-12-09T20:00:03Z']),
+        'msg.bytes': [1_000_000, 1_000_000],
+    })
+    series = cumulative_series(df, ['validator'])
+    start = pd.Timestamp('2024-12-09T20:00:00Z').value
+    throughput = window_throughput(series, np.array([0]), np.array([start]), np.array([start + 4 * 10 ** 9]))
+    assert throughput['bytes'].tolist() == [2_000_000]
+    assert throughput['speed_mbps'].tolist() == [4.0]
+
+
+def test_empty_frame():
+    df = pd.DataFrame({'validator': pd.Series([], dtype=str), 'msg.time': pd.to_datetime([], utc=True),
+                       'msg.bytes': pd.Series([], dtype=np.int64)})
+    series = cumulative_series(df, ['validator'])
+    assert len(window_sums(series, *fixed_windows(series, '10s'))) == 0
+    assert len(rolling_sums(series, '10s')) == 0
@@ -0,0 +1,58 @@
+import numpy as np
+
+from timed_bytes_decoder import decode_timed_bytes, read_timed_bytes
+
+
+def record(time, size, peer, ip):
+    return ('{"level":"info","msg":{"time":"%s","bytes":%d,"peer_id":"%s","ip_address":"%s"}}\n'
+            % (time, size, peer, ip)).encode()
+
+
+def test_compact_lines_decode_with_the_pattern():
+    buffer = record('2024-12-09T20:00:00Z', 10, 'a', '10.0.0.1:26656') + \
+        record('2024-12-09T20:00:01.5Z', 20, 'b', '10.0.0.2:26656')
+    columns = decode_timed_bytes(buffer)
+    assert columns['msg.time'].tolist() == [b'2024-12-09T20:00:00Z', b'2024-12-09T20:00:01.5Z']
+    assert columns['msg.bytes'].tolist() == [10, 20]
+    assert columns['msg.peer_id'].tolist() == [b'a', b'b']
+    assert columns['msg.ip_address'].tolist() == [b'10.0.0.1:26656', b'10.0.0.2:26656']
+
+
+def test_lines_off_the_pattern_fall_back_to_json():
+    # Whitespace, reordered fields and escapes do not match the pattern built
+    # from the first line, they are decoded with json.loads in file order
+    buffer = record('2024-12-09T20:00:00Z', 10, 'a', '10.0.0.1') + \
+        b'{"msg": {"time": "2024-12-09T20:00:01Z", "bytes": 20, "peer_id": "b", "ip_address": "10.0.0.2"}}\n' + \
+        b'{"msg":{"bytes":30,"time":"2024-12-09T20:00:02Z","ip_address":"10.0.0.3","peer_id":"c"}}\n' + \
+        b'{"msg":{"time":"2024-12-09T20:00:03Z","bytes":40,"peer_id":"d\\u0065","ip_address":"10.0.0.4"}}\n' + \
+        record('2024-12-09T20:00:04Z', 50, 'e', '10.0.0.5')
+    columns = decode_timed_bytes(buffer)
+    assert columns['msg.bytes'].tolist() == [10, 20, 30, 40, 50]
+    assert columns['msg.peer_id'].tolist() == [b'a', b'b', b'c', b'de', b'e']
+    assert columns['msg.ip_address'].tolist() == [b'10.0.0.1', b'10.0.0.2', b'10.0.0.3', b'10.0.0.4', b'10.0.0.5']
+
+
+def test_unusable_lines_are_skipped():
+    buffer = record('2024-12-09T20:00:00Z', 10, 'a', '10.0.0.1') + \
+        b'not json\n' + \
+        b'{"msg":{"time":"2024-12-09T20:00:01Z"}}\n' + \
+        b'\n' + \
+        record('2024-12-09T20:00:02Z', 30, 'c', '10.0.0.3')
+    columns = decode_timed_bytes(buffer)
+    assert columns['msg.bytes'].tolist() == [10, 30]
+
+
+def test_no_line_with_the_schema_decodes_with_json():
+    buffer = b'{"msg": {"time": "2024-12-09T20:00:00Z", "bytes": 10, "peer_id": "a", "ip_address": "10.0.0.1"}}\n'
+    columns = decode_timed_bytes(buffer)
+    assert columns['msg.bytes'].tolist() == [10]
+    assert decode_timed_bytes(b'')['msg.bytes'].dtype == np.int64
+
+
+def test_partial_last_line_is_left_for_the_next_read(tmp_path):
+    first = record('2024-12-09T20:00:00Z', 10, 'a', '10.0.0.1')
+    path = tmp_path / 'timed_received_bytes.jsonl'
+    path.write_bytes(first + b'{"msg":{"time":"2024-12-09T20:00:01Z","by')
+    columns, offset = read_timed_bytes(str(path))
+    assert columns['msg.bytes'].tolist() == [10]
+    assert offset == len(first)
@@ -0,0 +1,113 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from generate_traces import generate_experiment
+from layout import load_offsets
+from parse_jsonl import process_experiment_data
+from trace_cache import cache_paths, cache_status, load_cached_frame, source_fingerprint, store_cached_frame
+
+REGIONS = {'10.0.0.1': 'Europe'}
+
+
+def line(i):
+    return ('{"msg":{"time":"2024-12-09T20:00:%02dZ","bytes":%d,"peer_id":"a","ip_address":"10.0.0.2"}}\n'
+            % (i, i)).encode()
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'timed_received_bytes.jsonl'
+    path.write_bytes(line(0) + line(1))
+    return str(path)
+
+
+def store(source_file, rows=2):
+    df = pd.DataFrame({'validator': ['10.0.0.1'] * rows, 'msg.peer_id': ['a'] * rows, 'msg.bytes': range(rows)})
+    store_cached_frame(source_file, df, REGIONS)
+    return df
+
+
+def test_missing_cache_is_stale(source):
+    assert cache_status(source, REGIONS) == 'stale'
+    assert load_cached_frame(source, REGIONS) is None
+
+
+def test_stored_cache_is_valid(source):
+    df = store(source)
+    assert cache_status(source, REGIONS) == 'valid'
+    pd.testing.assert_frame_equal(load_cached_frame(source, REGIONS), df)
+    offsets = load_offsets(cache_paths(source)[0], len(df))
+    assert offsets[['start', 'stop']].values.tolist() == [[0, 2]]
+
+
+def test_appended_source_is_appendable(source):
+    store(source)
+    with open(source, 'ab') as f:
+        f.write(line(2))
+    assert cache_status(source, REGIONS) == 'appendable'
+    assert load_cached_frame(source, REGIONS) is None
+    # Refreshing it checkpoints the new end of the file
+    store(source, rows=3)
+    assert cache_status(source, REGIONS) == 'valid'
+
+
+def test_rewritten_source_is_stale(source):
+    store(source)
+    with open(source, 'wb') as f:
+        f.write(line(5) + line(6) + line(7))
+    assert cache_status(source, REGIONS) == 'stale'
+
+
+def test_truncated_source_is_stale(source):
+    store(source)
+    with open(source, 'wb') as f:
+        f.write(line(0))
+    assert cache_status(source, REGIONS) == 'stale'
+
+
+def test_other_regions_or_version_are_stale(source):
+    store(source)
+    assert cache_status(source, {'10.0.0.1': 'Asia'}) == 'stale'
+
+    _, meta_path = cache_paths(source)
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta['version'] -= 1
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    assert cache_status(source, REGIONS) == 'stale'
+
+
+def test_fingerprint_taken_before_a_growing_read_stays_appendable(source):
+    # The source grew while it was being parsed, only the bytes up to the
+    # checkpoint are in the cache
+    fingerprint = source_fingerprint(source)
+    offset = fingerprint['size']
+    with open(source, 'ab') as f:
+        f.write(line(2))
+    df = pd.DataFrame({'validator': ['10.0.0.1'] * 2, 'msg.peer_id': ['a'] * 2, 'msg.bytes': range(2)})
+    store_cached_frame(source, df, REGIONS, fingerprint, offset)
+    assert cache_status(source, REGIONS) == 'appendable'
+
+
+def test_unreadable_appendable_cache_is_parsed_again(tmp_path):
+    experiment_path = str(tmp_path / 'experiment')
+    ips_to_regions, _ = generate_experiment(experiment_path, str(tmp_path / 'list.txt'), num_validators=2,
+                                            num_peers=1, duration=5)
+    received_df, _ = process_experiment_data(experiment_path, ips_to_regions)
+    source_file = os.path.join(experiment_path, '10.0.0.1', 'timed_received_bytes.jsonl')
+    with open(source_file, 'rb') as f:
+        first_line = f.readline()
+    with open(source_file, 'ab') as f:
+        f.write(first_line)
+    data_path, _ = cache_paths(source_file)
+    with open(data_path, 'r+b') as f:
+        f.truncate(100)
+    assert cache_status(source_file, ips_to_regions) == 'appendable'
+
+    refreshed_df, _ = process_experiment_data(experiment_path, ips_to_regions, incremental=True)
+    assert len(refreshed_df) == len(received_df) + 1
+    assert cache_status(source_file, ips_to_regions) == 'valid'
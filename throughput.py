@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+
+from layout import canonical_order, key_arrays
+
+# Throughput over arbitrary time windows from cumulative byte counts. The
+# samples of every series, e.g. every (validator, peer), are sorted once and
+# summed cumulatively; the bytes of any window [start, end) are then the
+# difference of the cumulative counts at the two edges, found by searchsorted.
+# Window speeds divide by the exact window length, so idle time inside a
+# window counts as idle and the first window of a series is not lost
+
+
+def to_timestamps(ns):
+    return pd.to_datetime(ns, utc=True)
+
+
+def cumulative_series(df, keys, time_column='msg.time', value_column='msg.bytes'):
+    # Sorts the samples by keys then time once and builds the cumulative sum
+    # of value_column. Returns the series: one row of keys per series, the
+    # [first, last) sample indices of each, the sorted times and sums and the
+    # order, the row of df at each sorted position.
+    # cumulative has one more element than times, cumulative[i] is the sum
+    # of the samples before i
+    # Frames in canonical order (see layout.py) are already sorted
+    arrays = key_arrays(df, time_column, keys)
+    order = canonical_order(arrays)
+    if order is None:
+        order = np.arange(len(df))
+    codes = [code[order] for code in arrays[:-1]]
+    times = arrays[-1][order]
+    values = df[value_column].to_numpy()[order]
+
+    boundary = np.zeros(len(times), dtype=bool)
+    boundary[:1] = True
+    for code in codes:
+        boundary[1:] |= code[1:] != code[:-1]
+    firsts = np.flatnonzero(boundary)
+    lasts = np.r_[firsts[1:], len(times)]
+
+    key_rows = df[keys].iloc[order[firsts]].reset_index(drop=True) if len(times) else df[keys].iloc[:0]
+    return {
+        'keys': key_rows,
+        'firsts': firsts,
+        'lasts': lasts,
+        'times': times,
+        'cumulative': np.r_[0, np.cumsum(values)],
+        'order': order,
+    }
+
+
+def series_spans(series):
+    # First and last sample time of every series
+    if not len(series['times']):
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return series['times'][series['firsts']], series['times'][series['lasts'] - 1]
+
+
+def fixed_windows(series, interval):
+    # Back to back windows of interval, aligned on multiples of it like
+    # resample(origin='epoch'), covering each series from its first to its
+    # last sample.
+    # Returns the series index, start and end of every window
+    step = pd.to_timedelta(interval).value
+    first, last = series_spans(series)
+    first = first - first % step
+    counts = (last - first) // step + 1
+    groups = np.repeat(np.arange(len(counts)), counts)
+    # Position of every window within its series
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    starts = np.repeat(first, counts) + positions * step
+    return groups, starts, starts + step
+
+
+def sliding_windows(series, window, step):
+    # Windows of length window every step, aligned on multiples of step, from
+    # the first window holding a series' first sample to the one starting
+    # at or before its last sample
+    length = pd.to_timedelta(window).value
+    step = pd.to_timedelta(step).value
+    first, last = series_spans(series)
+    # Earliest aligned start whose window still covers the first sample
+    first = first - length + step
+    first = first - first % step
+    counts = (last - first) // step + 1
+    groups = np.repeat(np.arange(len(counts)), counts)
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    starts = np.repeat(first, counts) + positions * step
+    return groups, starts, starts + length
+
+
+def series_search(series, groups, values, side='left'):
+    # searchsorted of every value among the sorted times of its series, as
+    # positions into the samples of all series. The times are laid out on one
+    # axis where each series has its own range, offset past the ones before
+    # it, so one searchsorted answers all series at once, O(samples + values)
+    times, firsts, lasts = series['times'], series['firsts'], series['lasts']
+    if not len(groups):
+        return np.array([], dtype=np.int64)
+    counts = lasts - firsts
+    spans = times[lasts - 1].astype(np.float64) - times[firsts] + 3
+    if spans.sum() >= np.iinfo(np.int64).max:
+        # The spans of the series do not fit one int64 axis, times are
+        # replaced by their rank among all times, which the search preserves
+        distinct = np.unique(times)
+        times = np.searchsorted(distinct, times)
+        values = np.searchsorted(distinct, values, side=side)
+        side = 'left'
+    low = times[firsts] - 1
+    high = times[lasts - 1] + 1
+    # One spare slot below and above every series, a value outside the span
+    # of its series is clipped to them and lands on its first or past its
+    # last sample
+    base = np.r_[0, np.cumsum(high - low + 1)[:-1]] - low
+    sample_keys = times + np.repeat(base, counts)
+    value_keys = np.clip(values, low[groups], high[groups]) + base[groups]
+    return np.searchsorted(sample_keys, value_keys, side=side)
+
+
+def window_sums(series, groups, starts, ends):
+    # Sum of the samples in [start, end) of each window, windows are given as
+    # arrays of the series index, start and end ns, e.g. from fixed_windows
+    cumulative = series['cumulative']
+    begin = series_search(series, groups, starts)
+    finish = series_search(series, groups, ends)
+    return cumulative[finish] - cumulative[begin]
+
+
+def window_throughput(series, groups, starts, ends):
+    # Bytes and Mbps of every window, with the keys of its series. The speed
+    # is over the exact window length
+    window_bytes = window_sums(series, groups, starts, ends)
+    duration_s = (ends - starts) / 1e9
+    throughput = series['keys'].iloc[groups].reset_index(drop=True)
+    throughput['window_start'] = to_timestamps(starts)
+    throughput['window_end'] = to_timestamps(ends)
+    throughput['bytes'] = window_bytes
+    throughput['duration_s'] = duration_s
+    throughput['speed_mbps'] = window_bytes * 8 / (duration_s * 1_000_000)
+    return throughput
+
+
+def rolling_sums(series, window):
+    # Sum of the samples in (t - window, t] for every sample t, in the sorted
+    # order of the series
+    length = pd.to_timedelta(window).value
+    times, cumulative = series['times'], series['cumulative']
+    groups = np.repeat(np.arange(len(series['firsts'])), series['lasts'] - series['firsts'])
+    begin = series_search(series, groups, times - length, side='right')
+    return cumulative[1:] - cumulative[begin]
+
+
+def sample_gaps(series):
+    # Seconds since the previous sample of the same series, NaN for the first
+    gaps = np.diff(series['times'], prepend=0).astype(np.float64) / 1e9
+    gaps[series['firsts']] = np.nan
+    return gaps
@@ -0,0 +1,165 @@
+import json
+import re
+
+import numpy as np
+
+from compressed_io import open_trace, skip_to
+
+# Fields of the msg object of timed_sent_bytes/timed_received_bytes records
+TIMED_BYTES_FIELDS = ['time', 'bytes', 'peer_id', 'ip_address']
+
+# Value patterns for the fields above, strings with escapes fall back to json.loads
+FIELD_PATTERNS = {
+    'time': rb'"([^"\\\n]*)"',
+    'bytes': rb'(-?\d+)',
+    'peer_id': rb'"([^"\\\n]*)"',
+    'ip_address': rb'"([^"\\\n]*)"',
+}
+
+# Size of the blocks of complete lines decoded at once
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def build_pattern(block, max_samples=100):
+    # Builds a regex matching a msg object that has exactly the timed bytes
+    # fields, in the order the tracer writes them. The order is
+    # taken from the first decodable line of the block. Returns None if none
+    # of the sampled lines has that schema
+    for sample_line in block[:1 << 16].splitlines()[:max_samples]:
+        try:
+            entry = json.loads(sample_line)
+        except json.JSONDecodeError:
+            continue
+        msg = entry.get('msg') if isinstance(entry, dict) else None
+        if not isinstance(msg, dict) or sorted(msg) != sorted(TIMED_BYTES_FIELDS):
+            continue
+
+        fields = list(msg)
+        body = rb','.join(b'"' + field.encode() + b'":' + FIELD_PATTERNS[field] for field in fields)
+        pattern = re.compile(rb'"msg":\{' + body + rb'\}')
+        return pattern, fields
+    return None
+
+
+def decode_line_generic(line, fields):
+    # Fallback for lines the pattern does not match, returns the raw values in
+    # the same shape as the pattern groups or None if the line is unusable
+    try:
+        msg = json.loads(line)['msg']
+        return tuple(str(int(msg[field]) if field == 'bytes' else msg[field]).encode() for field in fields)
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def decode_block(block, compiled):
+    # Decodes a block of complete lines into column arrays. If every line
+    # matches the pattern the whole block is decoded by a single findall (no
+    # value pattern crosses a newline, so a match never spans two lines),
+    # otherwise it is decoded line by line with json.loads for the misfits
+    if compiled is not None:
+        pattern, fields = compiled
+        matches = pattern.findall(block)
+        if len(matches) == block.count(b'\n') + (0 if block.endswith(b'\n') else 1):
+            return columns_from_rows(matches, fields)
+    else:
+        pattern, fields = None, TIMED_BYTES_FIELDS
+
+    rows = []
+    for line in block.splitlines():
+        match = pattern.search(line) if pattern is not None else None
+        if match is not None:
+            rows.append(match.groups())
+            continue
+        row = decode_line_generic(line, fields) if line.strip() else None
+        if row is not None:
+            rows.append(row)
+    return columns_from_rows(rows, fields)
+
+
+def empty_columns():
+    return {
+        'msg.time': np.array([], dtype='S1'),
+        'msg.bytes': np.array([], dtype=np.int64),
+        'msg.peer_id': np.array([], dtype='S1'),
+        'msg.ip_address': np.array([], dtype='S1'),
+    }
+
+
+def columns_from_rows(rows, fields):
+    # rows are tuples of raw bytes values ordered like fields
+    if not rows:
+        return empty_columns()
+    values = dict(zip(fields, zip(*rows)))
+    return {
+        'msg.time': np.array(values['time']),
+        'msg.bytes': np.array(values['bytes']).astype(np.int64),
+        'msg.peer_id': np.array(values['peer_id']),
+        'msg.ip_address': np.array(values['ip_address']),
+    }
+
+
+def concat_columns(parts):
+    if not parts:
+        return empty_columns()
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+def decode_timed_bytes(buffer):
+    # Decodes a buffer of complete timed bytes lines, e.g. the raw lines kept by
+    # a windowed read. String columns are returned as fixed width bytes arrays
+    return decode_block(buffer, build_pattern(buffer))
+
+
+def read_timed_bytes(file_path, offset=0, max_bytes=None):
+    # Decodes the complete lines from byte offset onwards, returns the columns
+    # and the offset to resume from (see parse_jsonl.read_jsonl_tail). With
+    # max_bytes it stops after about that many bytes of complete lines, so a
+    # large file can be decoded one bounded chunk at a time
+    for columns, next_offset in iter_timed_bytes(file_path, offset, max_bytes):
+        return columns, next_offset
+
+
+def iter_timed_bytes(file_path, offset=0, max_bytes=None):
+    # Yields the columns of successive chunks of about max_bytes of complete
+    # lines, and the offset after each, from a single read of the file. This
+    # is how archives are chunked, they are only decompressed once. Offsets
+    # of archives count decompressed bytes. Yields at least once
+    compiled = None
+    with open_trace(file_path) as f:
+        skip_to(f, offset)
+        pending = b''
+        at_end = False
+        while not at_end:
+            parts = []
+            start = offset
+            while True:
+                size = BLOCK_SIZE
+                if max_bytes is not None:
+                    if offset - start >= max_bytes:
+                        break
+                    size = max(min(BLOCK_SIZE, max_bytes - (offset - start) - len(pending)), 1 << 16)
+                chunk = f.read(size)
+                if not chunk:
+                    at_end = True
+                    break
+                chunk = pending + chunk
+                cut = chunk.rfind(b'\n') + 1
+                block, pending = chunk[:cut], chunk[cut:]
+                if not block:
+                    continue
+                if compiled is None:
+                    compiled = build_pattern(block)
+                parts.append(decode_block(block, compiled))
+                offset += len(block)
+
+            # The file may simply not end with a newline, keep the line if it is complete
+            if at_end and pending:
+                try:
+                    json.loads(pending)
+                except json.JSONDecodeError:
+                    pending = b''
+                if pending:
+                    parts.append(decode_block(pending, compiled))
+                    offset += len(pending)
+
+            yield concat_columns(parts), offset
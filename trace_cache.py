@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from compressed_io import compression
+from layout import store_offsets
+
+# Bump whenever the layout or the dtypes of the cached frames change
+CACHE_VERSION = 7
+
+# Number of bytes before the checkpoint used to detect a rewritten source
+TAIL_DIGEST_BYTES = 4096
+
+# Columns kept in the final typed frame of a timed_*_bytes trace
+TIMED_BYTES_COLUMNS = [
+    'msg.time',
+    'msg.bytes',
+    'msg.peer_id',
+    'msg.ip_address',
+    'target_ip',
+    'target_region',
+    'validator',
+    'region',
+]
+
+# Columns resolved from msg.ip_address through the experiment's address book
+# once the files are combined (see address_book.py), they are not cached
+RESOLVED_COLUMNS = ['target_ip', 'target_region']
+
+# Columns of a trace file's cached or spilled frame
+CACHED_COLUMNS = [column for column in TIMED_BYTES_COLUMNS if column not in RESOLVED_COLUMNS]
+
+# Columns stored as categoricals sharing one dictionary across an experiment
+CATEGORICAL_COLUMNS = [
+    'validator',
+    'region',
+    'msg.peer_id',
+    'msg.ip_address',
+    'target_ip',
+    'target_region',
+]
+
+
+def cache_paths(source_file):
+    # The cache lives next to the JSONL file it was built from
+    return source_file + '.cache.parquet', source_file + '.cache.json'
+
+
+def regions_digest(ips_to_regions):
+    # The cached frames embed the regions, so a different list.txt invalidates them
+    encoded = json.dumps(sorted(ips_to_regions.items())).encode()
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def source_fingerprint(source_file):
+    stat = os.stat(source_file)
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
+def read_cache_meta(source_file):
+    _, meta_path = cache_paths(source_file)
+    try:
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def tail_digest(source_file, offset):
+    # Hash of the bytes just before offset, used to check that a grown file was only appended to
+    start = max(offset - TAIL_DIGEST_BYTES, 0)
+    with open(source_file, 'rb') as f:
+        f.seek(start)
+        return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+
+def cache_status(source_file, ips_to_regions):
+    # 'valid' if the cache matches the source, 'appendable' if the source only
+    # grew since the cache was written and 'stale' otherwise
+    data_path, _ = cache_paths(source_file)
+    meta = read_cache_meta(source_file)
+    if meta is None or not os.path.exists(data_path):
+        return 'stale'
+    if meta.get('version') != CACHE_VERSION or meta.get('regions') != regions_digest(ips_to_regions):
+        return 'stale'
+
+    fingerprint = source_fingerprint(source_file)
+    if meta.get('source') == fingerprint:
+        return 'valid'
+    # Offsets into archives count decompressed bytes, an archive is never appended to
+    offset = meta.get('offset', 0)
+    if compression(source_file) is not None:
+        return 'stale'
+    if fingerprint['size'] >= offset and meta.get('tail') == tail_digest(source_file, offset):
+        return 'appendable'
+    return 'stale'
+
+
+def is_cache_valid(source_file, ips_to_regions):
+    return cache_status(source_file, ips_to_regions) == 'valid'
+
+
+def load_cached_frame(source_file, ips_to_regions=None):
+    # Returns the cached typed frame, or None if it is missing or stale.
+    # Pass ips_to_regions=None to skip validation, e.g. before appending to it
+    if ips_to_regions is not None and not is_cache_valid(source_file, ips_to_regions):
+        return None
+    data_path, _ = cache_paths(source_file)
+    try:
+        return pd.read_parquet(data_path)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read cache {data_path}: {e}")
+        return None
+
+
+def store_cached_frame(source_file, df, ips_to_regions, fingerprint=None, offset=None):
+    # fingerprint should be taken before the source was read, so that a file
+    # which grew while being parsed is detected as stale on the next run.
+    # offset is the checkpoint just past the last complete line that was parsed
+    if fingerprint is None:
+        fingerprint = source_fingerprint(source_file)
+    if offset is None:
+        offset = fingerprint['size']
+    data_path, meta_path = cache_paths(source_file)
+
+    # Drop the old metadata first so a half-written cache is never picked up
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    df = df.reset_index(drop=True)
+    df.to_parquet(data_path, index=False)
+    # The frame is in canonical order, its pair offsets are stored with it
+    store_offsets(df, data_path)
+
+    meta = {
+        'version': CACHE_VERSION,
+        'regions': regions_digest(ips_to_regions),
+        'source': fingerprint,
+        'offset': offset,
+        'tail': tail_digest(source_file, offset) if compression(source_file) is None else None,
+        'rows': len(df),
+    }
+    tmp_path = meta_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+
+def experiment_digest(source_files, ips_to_regions):
+    # Identifies the cached contents of a set of trace files, derived data such
+    # as rollups is only reused while the digest stays the same. Returns None
+    # if any of the caches is not valid, i.e. the digest cannot be trusted
+    states = []
+    for source_file in sorted(source_files):
+        if not is_cache_valid(source_file, ips_to_regions):
+            return None
+        meta = read_cache_meta(source_file)
+        states.append([source_name(source_file), meta['source'], meta['offset']])
+    encoded = json.dumps([CACHE_VERSION, regions_digest(ips_to_regions), states]).encode()
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def sources_digest(source_files, ips_to_regions):
+    # Same as experiment_digest for data derived straight from the trace files,
+    # without going through the caches (see out_of_core.py). Taken before the
+    # files are read, so that a file growing meanwhile changes the digest
+    states = [[source_name(source_file), source_fingerprint(source_file)] for source_file in sorted(source_files)]
+    encoded = json.dumps([CACHE_VERSION, regions_digest(ips_to_regions), 'sources', states]).encode()
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def source_name(source_file):
+    # validator/file name, so the digests do not depend on where the experiment lives
+    return os.path.join(os.path.basename(os.path.dirname(source_file)), os.path.basename(source_file))
@@ -1,10 +1,28 @@
+import json
 import os
+import re
+from multiprocessing import Pool, cpu_count
+
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 
+from compressed_io import find_trace_file, open_trace
+from rfc3339 import rfc3339_to_datetime
+
+# Inferred table schemas are cached per chain in this directory
+SCHEMA_DIR_NAME = '.schemas'
+
+# Lines sampled to infer a table's schema
+SCHEMA_SAMPLE_LINES = 1000
+
+# Bytes of a trace file projected at once by read_projected_jsonl
+PROJECTION_BLOCK_BYTES = 64 * 1024 * 1024
 
-def read_jsonl(root, chainID, nodeID, table):
+RFC3339_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})$')
+
+
+def read_jsonl(root, chainID, nodeID, table, columns=None, schema=None):
     """
     Reads a JSONL file and returns a DataFrame.
 
@@ -13,8 +31,15 @@ def read_jsonl(root, chainID, nodeID, table):
     chainID (str): The chain ID.
     nodeID (str): The node ID.
     table (str): The table name.
+    columns (list): Optional projection, only these flattened columns are
+        kept while the file is read. Fields of the msg object are named
+        without the msg prefix, as in the unprojected frame.
+    schema (dict): Optional column dtypes, see infer_table_schema.
     """
-    path = os.path.join(root, chainID, nodeID, table + ".jsonl")
+    path = table_path(root, chainID, nodeID, table) or os.path.join(root, chainID, nodeID, table + ".jsonl")
+
+    if columns is not None:
+        return read_projected_jsonl(path, columns, schema)
 
     try:
         df = pd.read_json(path, lines=True)
@@ -29,6 +54,324 @@ def read_jsonl(root, chainID, nodeID, table):
     return df.join(pd.json_normalize(df['msg'])).drop(columns=['msg'])
 
 
+def table_path(root, chainID, nodeID, table):
+    """
+    Returns the path of a node's table file, plain or archived as .jsonl.gz
+    or .jsonl.zst, None if the node does not have the table.
+    """
+    return find_trace_file(os.path.join(root, chainID, nodeID), table + ".jsonl")
+
+
+def flatten_entry(entry):
+    """
+    Flattens a trace line the way read_jsonl does: top-level fields as they
+    are and the fields of msg without the prefix, nested objects dotted.
+    """
+    flat = {}
+
+    def add(prefix, value):
+        if isinstance(value, dict):
+            for key, inner in value.items():
+                add(f"{prefix}.{key}" if prefix else key, inner)
+        else:
+            flat[prefix] = value
+
+    for key, value in entry.items():
+        if key == 'msg' and isinstance(value, dict):
+            add('', value)
+        else:
+            flat[key] = value
+    return flat
+
+
+def read_projected_jsonl(path, columns, schema=None):
+    """
+    Reads only the given columns of a JSONL trace file, no frame holding the
+    other fields is ever built. The file is read in blocks of whole lines of
+    about PROJECTION_BLOCK_BYTES. Scalar columns are extracted from the raw
+    bytes of a block with one regex pass each, blocks where that is
+    ambiguous are decoded line by line. Lines that cannot be decoded are
+    skipped.
+
+    Args:
+    path (str): The JSONL file.
+    columns (list): The flattened column names to keep.
+    schema (dict): Optional column dtypes, see infer_table_schema.
+
+    Returns:
+    DataFrame: One column per projected name, missing fields are null.
+    """
+    frames = []
+    try:
+        with open_trace(path) as f:
+            for block in iter_line_blocks(f):
+                frames.append(project_lines(block, columns, schema))
+    except OSError as e:
+        print(f"Failed to read data from {path}: {e}")
+        return pd.DataFrame(columns=columns)
+
+    if not frames:
+        return project_lines(b'', columns, schema)
+    return pd.concat(frames, ignore_index=True)
+
+
+def iter_line_blocks(f, block_bytes=PROJECTION_BLOCK_BYTES):
+    """
+    Yields the content of a binary file in blocks of about block_bytes that
+    end at a line boundary.
+    """
+    rest = b''
+    while True:
+        data = f.read(block_bytes)
+        if not data:
+            break
+        data = rest + data
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            rest = data
+            continue
+        rest = data[end:]
+        yield data[:end]
+    if rest:
+        yield rest
+
+
+def project_lines(buffer, columns, schema=None):
+    """
+    Projects the columns of a block of whole lines, see read_projected_jsonl.
+    """
+    values = extract_columns(buffer, columns, schema)
+    if values is None:
+        values = {column: [] for column in columns}
+        for line in buffer.splitlines():
+            try:
+                entry = flatten_entry(json.loads(line))
+            except (json.JSONDecodeError, AttributeError):
+                continue
+            for column in columns:
+                values[column].append(entry.get(column))
+
+    return apply_schema(pd.DataFrame(values), schema)
+
+
+def extract_columns(buffer, columns, schema=None):
+    """
+    Extracts scalar columns straight from the raw bytes of a trace file.
+    Returns None unless every column occurs exactly once on every line with
+    a plain value (a number, a literal or a string without escapes).
+    """
+    if not buffer or b'\n\n' in buffer or buffer.startswith(b'\n'):
+        return None
+    line_starts = np.r_[0, np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == ord('\n')) + 1]
+    if buffer.endswith(b'\n'):
+        line_starts = line_starts[:-1]
+    num_lines = len(line_starts)
+
+    values = {}
+    for column in columns:
+        if '.' in column:
+            return None
+        pattern = re.compile(rb'"' + re.escape(column.encode()) + rb'":(?:"([^"\\\n]*)"|([^,}\]\s"]+))')
+        matches = list(pattern.finditer(buffer))
+        if len(matches) != num_lines:
+            return None
+        # Exactly one match per line: the i-th match must lie on the i-th line
+        positions = np.fromiter((match.start() for match in matches), dtype=np.int64, count=num_lines)
+        if (np.searchsorted(line_starts, positions, side='right') - 1 != np.arange(num_lines)).any():
+            return None
+        strings, literals = (np.array(group) for group in zip(*(match.groups(b'') for match in matches)))
+        if not literals.any():
+            column_type = schema['columns'].get(column) if schema is not None else None
+            # RFC3339 bytes are what rfc3339_to_datetime parses fastest
+            values[column] = rfc3339_to_datetime(strings) if column_type == 'datetime' else strings.astype(str)
+        elif literals.all():
+            try:
+                values[column] = literals.astype(np.int64)
+            except ValueError:
+                try:
+                    values[column] = literals.astype(np.float64)
+                except ValueError:
+                    return None
+        else:
+            return None
+    return values
+
+
+def value_type(value):
+    """
+    Returns the schema type of a decoded JSON value.
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int64'
+    if isinstance(value, float):
+        return 'float64'
+    if isinstance(value, str):
+        return 'datetime' if RFC3339_PATTERN.match(value) else 'string'
+    return 'object'
+
+
+def merge_types(current, new):
+    if current is None or current == new:
+        return new
+    if new is None:
+        return current
+    if {current, new} == {'int64', 'float64'}:
+        return 'float64'
+    return 'object'
+
+
+def apply_schema(df, schema=None):
+    """
+    Converts the columns of a frame to the types of the schema. Timestamps
+    become UTC datetimes, integers with missing values nullable integers.
+    """
+    if schema is None:
+        return df
+    for column in df.columns:
+        column_type = schema['columns'].get(column)
+        if column_type == 'datetime' and not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = rfc3339_to_datetime(df[column].fillna('').to_numpy(dtype=str))
+        elif column_type == 'int64':
+            df[column] = df[column].astype('Int64' if df[column].isna().any() else 'int64')
+        elif column_type == 'float64':
+            df[column] = df[column].astype('float64')
+        elif column_type == 'bool' and not df[column].isna().any():
+            df[column] = df[column].astype('bool')
+    return df
+
+
+def schema_path(root, chainID, table):
+    return os.path.join(root, chainID, SCHEMA_DIR_NAME, table + ".json")
+
+
+def infer_table_schema(root, chainID, table, node_ids=None, refresh=False):
+    """
+    Infers the flattened columns of a table and their types from the first
+    lines of the first node that has the table. The schema is cached with
+    the chain, so it is only inferred once.
+
+    Args:
+    root (str): The root path of the traces.
+    chainID (str): The chain ID.
+    table (str): The table name.
+    node_ids (list): Optional nodes to sample from, all of them by default.
+    refresh (bool): Infers the schema again even if it is cached.
+
+    Returns:
+    dict: {'table': table, 'columns': {column: type}}, None if no node has the table.
+    """
+    path = schema_path(root, chainID, table)
+    if not refresh and os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    if node_ids is None:
+        node_ids = list_node_id_directories(os.path.join(root, chainID))
+    types = {}
+    for nodeID in node_ids:
+        table_file = table_path(root, chainID, nodeID, table)
+        if table_file is None:
+            continue
+        with open_trace(table_file) as f:
+            for line_number, line in enumerate(f):
+                if line_number >= SCHEMA_SAMPLE_LINES:
+                    break
+                try:
+                    entry = flatten_entry(json.loads(line))
+                except (json.JSONDecodeError, AttributeError):
+                    continue
+                for column, value in entry.items():
+                    types[column] = merge_types(types.get(column), value_type(value))
+        if types:
+            break
+    if not types:
+        return None
+
+    schema = {'table': table, 'columns': {column: column_type or 'object' for column, column_type in types.items()}}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(schema, f, indent=2)
+    return schema
+
+
+def load_node_table(task):
+    """
+    Pool worker, reads one node's table.
+    """
+    root, chainID, nodeID, table, columns, schema = task
+    df = read_jsonl(root, chainID, nodeID, table, columns, schema)
+    if columns is None:
+        df = apply_schema(df, schema)
+    return nodeID, df
+
+
+def iter_table(root, chainID, table, columns=None, node_ids=None, processes=None):
+    """
+    Lazily loads a table across the nodes of a chain, in parallel. Nodes are
+    read ahead by the pool workers and yielded in order, so only a few of them
+    are in memory at once.
+
+    Args:
+    root (str): The root path of the traces.
+    chainID (str): The chain ID.
+    table (str): The table name, e.g. consensus_block or mempool_tx.
+    columns (list): Optional projection, see read_jsonl.
+    node_ids (list): Optional nodes to load, all of them by default.
+    processes (int): Number of workers, one less than the cores by default.
+
+    Yields:
+    tuple: (node ID, DataFrame) for every node that has the table.
+    """
+    if node_ids is None:
+        node_ids = list_node_id_directories(os.path.join(root, chainID))
+    node_ids = [nodeID for nodeID in node_ids if table_path(root, chainID, nodeID, table) is not None]
+    if not node_ids:
+        return
+
+    schema = infer_table_schema(root, chainID, table, node_ids)
+    if columns is not None and schema is not None:
+        unknown = [column for column in columns if column not in schema['columns']]
+        if unknown:
+            raise ValueError(f"Unknown columns for table {table}: {unknown}")
+
+    if processes is None:
+        processes = min(max(cpu_count() - 1, 1), len(node_ids))
+    tasks = [(root, chainID, nodeID, table, columns, schema) for nodeID in node_ids]
+    with Pool(processes=processes) as pool:
+        for nodeID, df in pool.imap(load_node_table, tasks):
+            yield nodeID, df
+
+
+def load_table(root, chainID, table, columns=None, node_ids=None, processes=None):
+    """
+    Loads a table across the nodes of a chain into a single DataFrame, with
+    the node's directory name in a categorical 'node' column.
+
+    Args:
+    See iter_table.
+
+    Returns:
+    DataFrame: The rows of all nodes, empty if no node has the table.
+    """
+    frames = []
+    node_ids_loaded = []
+    for nodeID, df in iter_table(root, chainID, table, columns, node_ids, processes):
+        if not df.empty:
+            frames.append(df)
+            node_ids_loaded.append(nodeID)
+    if not frames:
+        return pd.DataFrame(columns=(columns or []) + ['node'])
+
+    lengths = [len(df) for df in frames]
+    df = pd.concat(frames, ignore_index=True)
+    df['node'] = pd.Categorical.from_codes(np.repeat(np.arange(len(frames)), lengths), node_ids_loaded)
+    return df
+
+
 def list_directories(path):
     """
     Returns a list of directories found in the specified path.
@@ -40,7 +383,7 @@ def list_directories(path):
     list: A list of directories found in the specified path.
     """
     if not os.path.isdir(path):
-        return NotADirectoryError("The specified path is not a directory.")
+        raise NotADirectoryError("The specified path is not a directory.")
 
     directories = []
 
@@ -53,10 +396,29 @@ def list_directories(path):
     return directories
 
 
-root = "/home/evan/traces/quic"
-chainID = "1"
-path = os.path.join(root, chainID)
-node_ids = list_node_id_directories(path)
-df = read_jsonl(root, chainID, "validator-0", "consensus_block")
+def list_node_id_directories(path):
+    """
+    Returns the node directories of a chain, sorted. Hidden directories hold
+    caches such as the table schemas and are skipped.
+
+    Args:
+    path (str): The chain directory, i.e. root/chainID.
+
+    Returns:
+    list: The node IDs.
+    """
+    return sorted(directory for directory in list_directories(path) if not directory.startswith('.'))
+
+
+if __name__ == '__main__':
+    root = "/home/evan/traces/quic"
+    chainID = "1"
+    path = os.path.join(root, chainID)
+    node_ids = list_node_id_directories(path)
+    df = read_jsonl(root, chainID, "validator-0", "consensus_block")
+
+    print(df.info())
 
-print(df.info())
\ No newline at end of file
+    # a single column of a table across all nodes, nothing else is kept
+    heights = load_table(root, chainID, "consensus_block", columns=["height"], node_ids=node_ids)
+    print(heights.info())
@@ -0,0 +1,64 @@
+import pandas as pd
+
+from layout import sort_canonical
+
+# Finest time bucket of the cube, every speed view interval must be a multiple of it
+CUBE_BUCKET = '1s'
+
+# Keys of a cube row, region/target_ip/target_region depend on validator and
+# peer so they do not split the groups further but keep the labels at hand
+CUBE_KEYS = ['direction', 'validator', 'region', 'msg.peer_id', 'target_ip', 'target_region', 'bucket']
+
+# Keys of a cube built before the target IPs and regions are resolved, e.g. per
+# trace file out of core, rolling it up by CUBE_KEYS once they are added
+# merges the addresses of the same IP
+ADDRESS_CUBE_KEYS = ['direction', 'validator', 'region', 'msg.peer_id', 'msg.ip_address', 'bucket']
+
+DIRECTIONS = pd.CategoricalDtype(['sent', 'received'])
+
+ACTIONS = {
+    'sent': 'Send',
+    'received': 'Receive',
+}
+
+
+def build_traffic_cube(sent_df, received_df, bucket=CUBE_BUCKET, keys=CUBE_KEYS):
+    # Sums the bytes of the raw sent/received frames by (direction, validator,
+    # peer, time bucket) in one pass, keeping the sample count and the first
+    # and last timestamps of each bucket. Either frame may be None
+    cubes = []
+    for direction, df in (('sent', sent_df), ('received', received_df)):
+        if df is None or df.empty:
+            continue
+        cube = df.assign(
+            direction=pd.Categorical([direction] * len(df), dtype=DIRECTIONS),
+            bucket=df['msg.time'].dt.floor(bucket),
+        ).groupby(keys, observed=True, dropna=False, sort=False).agg(
+            bytes=('msg.bytes', 'sum'),
+            samples=('msg.bytes', 'size'),
+            first_time=('msg.time', 'min'),
+            last_time=('msg.time', 'max'),
+        ).reset_index()
+        cubes.append(cube)
+
+    if not cubes:
+        return pd.DataFrame(columns=keys + ['bytes', 'samples', 'first_time', 'last_time'])
+    # In canonical order, every (direction, validator, peer) series is a contiguous slice
+    cube = sort_canonical(pd.concat(cubes, ignore_index=True), 'bucket')
+    cube.attrs['bucket'] = bucket
+    return cube
+
+
+def cube_slice(cube, direction=None):
+    # Rows of one direction, or of the whole cube if direction is None
+    if direction is None:
+        return cube
+    return cube[cube['direction'] == direction]
+
+
+def check_interval(cube, interval):
+    # Views can only be derived at multiples of the cube bucket
+    bucket = pd.to_timedelta(cube.attrs.get('bucket', CUBE_BUCKET))
+    interval = pd.to_timedelta(interval)
+    if interval < bucket or interval % bucket != pd.Timedelta(0):
+        raise ValueError(f"Interval {interval} is not a multiple of the cube bucket {bucket}")